@@ -0,0 +1,8 @@
+"""Banco de pruebas de rendimiento de GestorTaxi
+
+Se ejecuta desde La-Gestoria/:
+
+    python -m benchmarks.generate --db bench.db --users 5 --income-rows 1000000
+    python -m benchmarks.run --db bench.db --mode client --output baseline.json
+    python -m benchmarks.run --db bench.db --mode http --processes 4 --baseline baseline.json
+"""
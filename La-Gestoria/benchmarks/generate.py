@@ -0,0 +1,188 @@
+"""Genera una base de datos gestortaxi.db sintética con volúmenes realistas
+
+Los usuarios se llaman bench{n}@example.com con contraseña BENCHMARK_PASSWORD.
+Las fechas siguen el patrón del sector: más servicios en fin de semana y en
+diciembre/verano, gastos de combustible frecuentes y seguros o ITV puntuales.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import uuid
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+BENCHMARK_PASSWORD = 'benchmark'
+INSERT_BATCH_SIZE = 10000
+
+# Peso relativo por día de la semana (lunes=0) y por mes
+WEEKDAY_WEIGHTS = (0.8, 0.8, 0.9, 1.0, 1.4, 1.6, 1.1)
+MONTH_WEIGHTS = (0.85, 0.85, 0.95, 1.0, 1.0, 1.05, 1.15, 1.1, 1.0, 1.0, 1.05, 1.3)
+
+INCOME_SOURCES = (('Uber', 35), ('Cabify', 25), ('Bolt', 15), ('FreeNow', 10), ('Taxímetro', 15))
+PAYMENT_METHODS = (('app', 60), ('tarjeta', 30), ('efectivo', 10))
+# (categoría, peso, media del importe, proveedor)
+EXPENSE_CATEGORIES = (
+    ('combustible', 45, 55, 'Repsol'),
+    ('lavado', 15, 12, 'Lavacar'),
+    ('mantenimiento', 10, 180, 'Taller Hermanos García'),
+    ('neumaticos', 3, 320, 'Norauto'),
+    ('peajes', 12, 9, 'Autopistas'),
+    ('parking', 10, 6, 'Empark'),
+    ('seguro', 2, 900, 'Mutua Madrileña'),
+    ('itv', 1, 45, 'ITV Madrid'),
+    ('telefonia', 2, 30, 'Movistar'),
+)
+BRANDS = (('Toyota', 'Prius'), ('Toyota', 'Corolla'), ('Skoda', 'Octavia'), ('Kia', 'Niro'), ('Hyundai', 'Ioniq'))
+
+def weighted(pairs):
+    values = [value for value, _ in pairs]
+    cumulative, total = [], 0
+    for _, weight in pairs:
+        total += weight
+        cumulative.append(total)
+    return values, cumulative
+
+def day_weights(start, days):
+    dates, cumulative, total = [], [], 0
+    for offset in range(days):
+        day = start + timedelta(days=offset)
+        total += WEEKDAY_WEIGHTS[day.weekday()] * MONTH_WEIGHTS[day.month - 1]
+        dates.append(day.isoformat())
+        cumulative.append(total)
+    return dates, cumulative
+
+def insert_many(conn, sql, rows):
+    conn.execute('BEGIN')
+    conn.executemany(sql, rows)
+    conn.execute('COMMIT')
+
+def generate(database, users=3, companies=2, vehicles=5, employees=6, income_rows=100000,
+             expense_rows=30000, years=3, seed=42, verbose=True):
+    rng = random.Random(seed)
+    started = time.perf_counter()
+    # Sin instrumentación: cada lote de 10.000 filas saldría en el log de consultas lentas
+    main.init_app({'DATABASE': database, 'SQL_INSTRUMENTATION': False})
+    conn = main.open_db_connection(database)
+    
+    # Sin triggers durante la carga masiva: el resumen mensual y la búsqueda se reconstruyen al final
+    trigger_statements = (main.rollup_trigger_statements() + main.data_version_trigger_statements()
+                          + main.ledger_month_trigger_statements() + main.search_trigger_statements())
+    for statement in trigger_statements:
+        if statement.startswith('DROP TRIGGER'):
+            conn.execute(statement)
+    
+    end = date.today()
+    start = end - timedelta(days=365 * years)
+    dates, date_weights = day_weights(start, (end - start).days + 1)
+    sources, source_weights = weighted(INCOME_SOURCES)
+    payments, payment_weights = weighted(PAYMENT_METHODS)
+    categories, category_weights = weighted([(c, w) for c, w, _, _ in EXPENSE_CATEGORIES])
+    expense_profile = {c: (mean, supplier) for c, _, mean, supplier in EXPENSE_CATEGORIES}
+    
+    fleet = []  # (user_id, company_id, vehicle_id)
+    for u in range(users):
+        user_id = str(uuid.uuid4())
+        conn.execute('''
+            INSERT INTO users (id, email, password_hash, plan) VALUES (?, ?, ?, 'pro')
+            ON CONFLICT (email) DO NOTHING
+        ''', (user_id, f'bench{u}@example.com', main.hash_password(BENCHMARK_PASSWORD)))
+        user_id = conn.execute('SELECT id FROM users WHERE email = ?', (f'bench{u}@example.com',)).fetchone()[0]
+        for c in range(companies):
+            company_id = str(uuid.uuid4())
+            conn.execute('''
+                INSERT INTO companies (id, user_id, name, cif, sector) VALUES (?, ?, ?, ?, 'taxi')
+            ''', (company_id, user_id, f'Flota {u}-{c} S.L.', f'B{rng.randrange(10**7, 10**8)}'))
+            drivers = []
+            for e in range(employees):
+                employee_id = str(uuid.uuid4())
+                drivers.append(employee_id)
+                conn.execute('''
+                    INSERT INTO employees (id, user_id, company_id, name, surname, position, salary, start_date)
+                    VALUES (?, ?, ?, ?, ?, 'conductor', ?, ?)
+                ''', (employee_id, user_id, company_id, f'Conductor {e}', f'Flota {u}-{c}',
+                      round(rng.uniform(1300, 2100), 2), rng.choice(dates)))
+            for v in range(vehicles):
+                vehicle_id = str(uuid.uuid4())
+                brand, model = rng.choice(BRANDS)
+                conn.execute('''
+                    INSERT INTO vehicles (id, user_id, company_id, plate, brand, model, year, type, driver_id)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, 'taxi', ?)
+                ''', (vehicle_id, user_id, company_id, f'{rng.randrange(10000):04d}-{uuid.uuid4().hex[:3].upper()}',
+                      brand, model, rng.randrange(2016, 2025), rng.choice(drivers)))
+                fleet.append((user_id, company_id, vehicle_id))
+    
+    def income_batch(size):
+        for _ in range(size):
+            user_id, company_id, vehicle_id = rng.choice(fleet)
+            amount = round(rng.lognormvariate(2.6, 0.5), 2)
+            yield (
+                str(uuid.uuid4()), user_id, company_id, vehicle_id,
+                rng.choices(dates, cum_weights=date_weights)[0], amount, 'servicio',
+                rng.choices(sources, cum_weights=source_weights)[0], 'Servicio de taxi',
+                10, round(amount * 0.1, 2), rng.choices(payments, cum_weights=payment_weights)[0]
+            )
+    
+    def expense_batch(size):
+        for _ in range(size):
+            user_id, company_id, vehicle_id = rng.choice(fleet)
+            category = rng.choices(categories, cum_weights=category_weights)[0]
+            mean, supplier = expense_profile[category]
+            amount = round(rng.lognormvariate(0, 0.35) * mean, 2)
+            yield (
+                str(uuid.uuid4()), user_id, company_id, vehicle_id, rng.choice(dates), amount,
+                'operativo', category, category.title(), supplier, 21, round(amount * 0.21, 2)
+            )
+    
+    for label, total, batch, sql in (
+        ('income', income_rows, income_batch, '''
+            INSERT INTO income (id, user_id, company_id, vehicle_id, date, amount, type, source,
+                                description, vat_rate, vat_amount, payment_method)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        '''),
+        ('expenses', expense_rows, expense_batch, '''
+            INSERT INTO expenses (id, user_id, company_id, vehicle_id, date, amount, type, category,
+                                  description, supplier, vat_rate, vat_amount)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        '''),
+    ):
+        for offset in range(0, total, INSERT_BATCH_SIZE):
+            insert_many(conn, sql, batch(min(INSERT_BATCH_SIZE, total - offset)))
+            if verbose:
+                print(f'\r{label}: {min(offset + INSERT_BATCH_SIZE, total)}/{total}', end='', flush=True)
+        if verbose and total:
+            print()
+    conn.execute('DELETE FROM monthly_rollups')
+    conn.execute('DELETE FROM search_docs')
+    # Sin los triggers de versión por mes los modelos calculados quedarían desfasados
+    conn.execute("DELETE FROM fiscal_documents WHERE type = 'modelo' AND status != 'submitted'")
+    conn.execute('ANALYZE')
+    conn.close()
+    
+    # init_db restaura los triggers y, con el resumen y el índice vacíos, los reconstruye
+    main.init_db()
+    if verbose:
+        print(f'{database}: {len(fleet)} vehículos, {income_rows} ingresos, {expense_rows} gastos '
+              f'en {time.perf_counter() - started:.1f} s')
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Genera una base de datos sintética para benchmarks')
+    parser.add_argument('--db', default='bench.db')
+    parser.add_argument('--users', type=int, default=3)
+    parser.add_argument('--companies', type=int, default=2, help='empresas por usuario')
+    parser.add_argument('--vehicles', type=int, default=5, help='vehículos por empresa')
+    parser.add_argument('--employees', type=int, default=6, help='empleados por empresa')
+    parser.add_argument('--income-rows', type=int, default=100000)
+    parser.add_argument('--expense-rows', type=int, default=30000)
+    parser.add_argument('--years', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=42)
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    args = parse_args()
+    generate(args.db, args.users, args.companies, args.vehicles, args.employees,
+             args.income_rows, args.expense_rows, args.years, args.seed)
@@ -0,0 +1,272 @@
+"""Mide latencias (p50/p95/p99) y rendimiento de las rutas principales
+
+Dos modos:
+  client  recorre los escenarios con el cliente de pruebas de Flask (sin red)
+  http    varios procesos lanzan peticiones HTTP contra --url o contra un
+          servidor werkzeug que se arranca en segundo plano
+
+El resultado se guarda en JSON (--output) y se puede comparar con una línea
+base anterior (--baseline); con --fail-on-regression termina con código 1 si
+algún p95 empeora más de --threshold.
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import platform
+import socket
+import statistics
+import sys
+import time
+from datetime import date, datetime, timedelta
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.generate import BENCHMARK_PASSWORD
+
+def _invoice_body(i):
+    return {'series': 'F', 'date': date.today().isoformat(), 'subtotal': 100, 'vat_amount': 10,
+            'total': 110, 'notes': f'benchmark {i}'}
+
+def _month_start():
+    return date.today().replace(day=1).isoformat()
+
+# (nombre, método, ruta, cuerpo JSON(i) o None, peso en el modo http)
+SCENARIOS = (
+    ('dashboard', 'GET', lambda: '/dashboard', None, 1),
+    ('analytics_dashboard', 'GET', lambda: '/api/analytics/dashboard', None, 4),
+    ('income_page', 'GET', lambda: '/api/income?limit=50', None, 4),
+    ('income_month', 'GET', lambda: f'/api/income?start_date={_month_start()}', None, 2),
+    ('export_income_csv', 'GET',
+     lambda: f'/api/reports/export/income?format=csv&start_date={(date.today() - timedelta(days=90)).isoformat()}',
+     None, 1),
+    ('invoice_post', 'POST', lambda: '/api/invoices', _invoice_body, 2),
+)
+
+def summarize(latencies, elapsed):
+    """Percentiles en milisegundos y peticiones por segundo"""
+    if not latencies:
+        return {'count': 0}
+    ordered = sorted(latencies)
+    cuts = statistics.quantiles(ordered, n=100, method='inclusive') if len(ordered) > 1 else ordered * 99
+    return {
+        'count': len(ordered),
+        'mean_ms': round(statistics.fmean(ordered) * 1000, 3),
+        'p50_ms': round(cuts[49] * 1000, 3),
+        'p95_ms': round(cuts[94] * 1000, 3),
+        'p99_ms': round(cuts[98] * 1000, 3),
+        'max_ms': round(ordered[-1] * 1000, 3),
+        'rps': round(len(ordered) / elapsed, 2) if elapsed else None,
+    }
+
+def select_scenarios(names):
+    if not names:
+        return SCENARIOS
+    selected = [scenario for scenario in SCENARIOS if scenario[0] in names]
+    unknown = set(names) - {scenario[0] for scenario in selected}
+    if unknown:
+        raise SystemExit(f'Escenarios desconocidos: {", ".join(sorted(unknown))}')
+    return selected
+
+# Modo client: cliente de pruebas de Flask, un escenario detrás de otro
+def run_client(database, scenarios, iterations, warmup, user=0):
+    import main
+
+    app = main.init_app({'DATABASE': database})
+    client = app.test_client()
+    response = client.post('/login', json={'email': f'bench{user}@example.com', 'password': BENCHMARK_PASSWORD})
+    if not response.json.get('success'):
+        raise SystemExit(f'No se pudo iniciar sesión con bench{user}@example.com; ¿se generó la base de datos?')
+
+    results = {}
+    for name, method, path, body, _ in scenarios:
+        latencies, errors = [], 0
+        started = time.perf_counter()
+        for i in range(warmup + iterations):
+            request_started = time.perf_counter()
+            response = client.open(path(), method=method, json=body(i) if body else None)
+            response.get_data()  # consume el cuerpo aunque sea streaming
+            elapsed = time.perf_counter() - request_started
+            if i < warmup:
+                started = time.perf_counter()
+                continue
+            if response.status_code >= 400:
+                errors += 1
+            latencies.append(elapsed)
+        results[name] = summarize(latencies, time.perf_counter() - started)
+        results[name]['errors'] = errors
+    return results
+
+# Modo http: varios procesos, conexiones keep-alive, escenarios mezclados por peso
+def _login(conn, user):
+    conn.request('POST', '/login', body=json.dumps({'email': f'bench{user}@example.com', 'password': BENCHMARK_PASSWORD}),
+                 headers={'Content-Type': 'application/json'})
+    response = conn.getresponse()
+    response.read()
+    cookie = response.getheader('Set-Cookie')
+    if response.status != 200 or not cookie:
+        raise RuntimeError(f'No se pudo iniciar sesión con bench{user}@example.com')
+    return cookie.split(';', 1)[0]
+
+def _http_worker(args):
+    url, worker, users, duration, scenario_names = args
+    scenarios = select_scenarios(scenario_names)
+    target = urlsplit(url)
+    conn = http.client.HTTPConnection(target.hostname, target.port or 80, timeout=60)
+    cookie = _login(conn, worker % users)
+    plan = [scenario for scenario in scenarios for _ in range(scenario[4])]
+    latencies = {scenario[0]: [] for scenario in scenarios}
+    errors = dict.fromkeys(latencies, 0)
+    deadline = time.perf_counter() + duration
+    i = 0
+    while time.perf_counter() < deadline:
+        name, method, path, body, _ = plan[i % len(plan)]
+        headers = {'Cookie': cookie}
+        payload = None
+        if body:
+            payload = json.dumps(body(i))
+            headers['Content-Type'] = 'application/json'
+        started = time.perf_counter()
+        try:
+            conn.request(method, path(), body=payload, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            conn = http.client.HTTPConnection(target.hostname, target.port or 80, timeout=60)
+            status = 599
+        latencies[name].append(time.perf_counter() - started)
+        if status >= 400:
+            errors[name] += 1
+        i += 1
+    conn.close()
+    return latencies, errors
+
+def _serve(database, port):
+    import logging
+    import main
+    from werkzeug.serving import run_simple
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)  # sin una línea por petición
+    run_simple('127.0.0.1', port, main.init_app({'DATABASE': database}), threaded=True)
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def run_http(database, scenarios, processes, duration, users, url=None):
+    server = None
+    if url is None:
+        port = _free_port()
+        server = multiprocessing.get_context('spawn').Process(target=_serve, args=(database, port), daemon=True)
+        server.start()
+        url = f'http://127.0.0.1:{port}'
+        for _ in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+    try:
+        names = [scenario[0] for scenario in scenarios]
+        started = time.perf_counter()
+        with multiprocessing.get_context('spawn').Pool(processes) as pool:
+            outcomes = pool.map(_http_worker, [(url, worker, users, duration, names) for worker in range(processes)])
+        elapsed = time.perf_counter() - started
+    finally:
+        if server is not None:
+            server.terminate()
+            server.join()
+
+    results = {}
+    for name in names:
+        latencies = [value for outcome, _ in outcomes for value in outcome[name]]
+        results[name] = summarize(latencies, elapsed)
+        results[name]['errors'] = sum(errors[name] for _, errors in outcomes)
+    all_latencies = [value for outcome, _ in outcomes for values in outcome.values() for value in values]
+    results['total'] = summarize(all_latencies, elapsed)
+    results['total']['errors'] = sum(sum(errors.values()) for _, errors in outcomes)
+    return results
+
+# Informe y comparación con la línea base
+def compare(results, baseline, threshold):
+    """Devuelve las filas de comparación y los escenarios cuyo p95 ha empeorado"""
+    rows, regressions = [], []
+    for name, current in results.items():
+        previous = baseline.get('results', {}).get(name)
+        if not previous or not previous.get('p95_ms') or not current.get('p95_ms'):
+            rows.append((name, current, None))
+            continue
+        change = current['p95_ms'] / previous['p95_ms'] - 1
+        rows.append((name, current, change))
+        if change > threshold:
+            regressions.append(name)
+    return rows, regressions
+
+def print_report(rows):
+    print(f'{"escenario":<22}{"n":>7}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"req/s":>10}{"errores":>9}{"Δp95":>9}')
+    for name, stats, change in rows:
+        if not stats.get('count'):
+            print(f'{name:<22}{0:>7}')
+            continue
+        delta = f'{change:+.1%}' if change is not None else '-'
+        print(f'{name:<22}{stats["count"]:>7}{stats["p50_ms"]:>10.2f}{stats["p95_ms"]:>10.2f}'
+              f'{stats["p99_ms"]:>10.2f}{stats["rps"] or 0:>10.1f}{stats["errors"]:>9}{delta:>9}')
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark de las rutas de GestorTaxi')
+    parser.add_argument('--db', default='bench.db')
+    parser.add_argument('--mode', choices=('client', 'http'), default='client')
+    parser.add_argument('--scenario', action='append', help='limita la ejecución a estos escenarios')
+    parser.add_argument('--iterations', type=int, default=50, help='peticiones por escenario (modo client)')
+    parser.add_argument('--warmup', type=int, default=5, help='peticiones descartadas por escenario (modo client)')
+    parser.add_argument('--processes', type=int, default=4, help='procesos cliente (modo http)')
+    parser.add_argument('--duration', type=float, default=20, help='segundos de carga (modo http)')
+    parser.add_argument('--users', type=int, default=1, help='usuarios bench{n} entre los que repartir la carga')
+    parser.add_argument('--url', help='servidor ya arrancado (modo http); si no, se lanza uno local')
+    parser.add_argument('--output', help='fichero JSON donde guardar los resultados')
+    parser.add_argument('--baseline', help='resultados anteriores con los que comparar')
+    parser.add_argument('--threshold', type=float, default=0.10, help='empeoramiento de p95 tolerado (0.10 = 10%%)')
+    parser.add_argument('--fail-on-regression', action='store_true')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    scenarios = select_scenarios(args.scenario)
+    if args.mode == 'client':
+        results = run_client(os.path.abspath(args.db), scenarios, args.iterations, args.warmup)
+    else:
+        results = run_http(os.path.abspath(args.db), scenarios, args.processes, args.duration, args.users, args.url)
+
+    report = {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'mode': args.mode,
+        'database': os.path.basename(args.db),
+        'python': platform.python_version(),
+        'machine': platform.platform(),
+        'settings': {key: getattr(args, key) for key in ('iterations', 'warmup', 'processes', 'duration', 'users')},
+        'results': results,
+    }
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('mode') != args.mode:
+            print(f'Aviso: la línea base es del modo {baseline.get("mode")}, no comparable con {args.mode}')
+    rows, regressions = compare(results, baseline, args.threshold)
+    print_report(rows)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    if regressions:
+        print(f'p95 empeora más de un {args.threshold:.0%} en: {", ".join(regressions)}')
+        if args.fail_on_regression:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
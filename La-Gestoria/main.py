@@ -1,29 +1,31 @@
-
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for, send_file
-from datetime import datetime, timedelta
+from flask import (Flask, render_template, request, jsonify, session, redirect, url_for, send_file, g,
+                   has_app_context, has_request_context, Response, stream_with_context, before_render_template, template_rendered)
+from datetime import datetime, date, timedelta
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import csv
 import json
 import uuid
 import os
+import queue
+import re
 import sqlite3
+import unicodedata
 import hashlib
-import jwt
-from functools import wraps
-import pandas as pd
-from werkzeug.utils import secure_filename
+import hmac
+import click
+from functools import lru_cache, wraps
 import io
+import tempfile
 import base64
-try:
-    from email.mime.text import MIMEText as MimeText
-    from email.mime.multipart import MIMEMultipart as MimeMultipart
-except ImportError:
-    # Fallback for problematic installations
-    MimeText = None
-    MimeMultipart = None
-import smtplib
+import bisect
+import itertools
+import binascii
+import socket
+import socketserver
 import threading
-import schedule
 import time
-import requests
 
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-here-change-in-production'
@@ -31,13 +33,551 @@ app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=30)  # Sesiones de 30 días
 
-# Crear directorio de uploads si no existe
-if not os.path.exists(app.config['UPLOAD_FOLDER']):
-    os.makedirs(app.config['UPLOAD_FOLDER'])
+# Configuración de SQLite (pool de conexiones y pragmas)
+app.config['DATABASE'] = os.environ.get('GESTORTAXI_DB', 'gestortaxi.db')
+app.config['DB_POOL_SIZE'] = int(os.environ.get('GESTORTAXI_DB_POOL_SIZE', 8))
+app.config['DB_POOL_TIMEOUT'] = 30  # segundos esperando una conexión libre
+app.config['SQLITE_JOURNAL_MODE'] = 'WAL'
+app.config['SQLITE_SYNCHRONOUS'] = os.environ.get('GESTORTAXI_SQLITE_SYNCHRONOUS', 'NORMAL')
+app.config['SQLITE_CACHE_SIZE'] = int(os.environ.get('GESTORTAXI_SQLITE_CACHE_SIZE', -16000))  # negativo = KiB
+app.config['SQLITE_MMAP_SIZE'] = int(os.environ.get('GESTORTAXI_SQLITE_MMAP_SIZE', 128 * 1024 * 1024))
+app.config['SQLITE_BUSY_TIMEOUT'] = int(os.environ.get('GESTORTAXI_SQLITE_BUSY_TIMEOUT', 5000))  # ms
+
+# Un fichero por cliente: con SHARDS_FOLDER definido, DATABASE actúa de directorio (usuarios,
+# tenant_shards, tareas programadas) y cada usuario nuevo estrena su propio fichero en la carpeta.
+# Los usuarios sin entrada en el directorio siguen en DATABASE (flask --app main rebalance-shards).
+app.config['SHARDS_FOLDER'] = os.environ.get('GESTORTAXI_SHARDS_FOLDER') or None
+app.config['SHARD_POOL_SIZE'] = int(os.environ.get('GESTORTAXI_SHARD_POOL_SIZE', 4))
+# Cada conexión reserva su mmap: solo los pools de los shards usados hace poco siguen abiertos
+app.config['SHARD_POOLS_MAX'] = int(os.environ.get('GESTORTAXI_SHARD_POOLS_MAX', 32))
+app.config['SHARD_POOL_IDLE_TIMEOUT'] = 300  # segundos sin uso antes de cerrar el pool de un shard
+app.config['TENANT_CACHE_SIZE'] = 10000  # usuarios cuyo fichero se recuerda en memoria
+
+# Envío de recordatorios
+app.config['REMINDER_BATCH_SIZE'] = 500
+
+# Conciliación bancaria: días de diferencia admitidos entre el movimiento y el apunte
+app.config['BANK_MATCH_TOLERANCE_DAYS'] = int(os.environ.get('GESTORTAXI_BANK_MATCH_TOLERANCE_DAYS', 5))
+
+# Correo saliente (outbox). MAIL_BACKEND: console | smtp | memory (pruebas)
+app.config['MAIL_BACKEND'] = os.environ.get('GESTORTAXI_MAIL_BACKEND', 'console')
+app.config['MAIL_SERVER'] = os.environ.get('GESTORTAXI_MAIL_SERVER', 'localhost')
+app.config['MAIL_PORT'] = int(os.environ.get('GESTORTAXI_MAIL_PORT', 1025))
+app.config['MAIL_USE_TLS'] = os.environ.get('GESTORTAXI_MAIL_USE_TLS', '') == '1'
+app.config['MAIL_USERNAME'] = os.environ.get('GESTORTAXI_MAIL_USERNAME')
+app.config['MAIL_PASSWORD'] = os.environ.get('GESTORTAXI_MAIL_PASSWORD')
+app.config['MAIL_FROM'] = os.environ.get('GESTORTAXI_MAIL_FROM', 'notificaciones@gestortaxi.es')
+app.config['MAIL_SEND_WORKERS'] = 4  # también es el máximo de conexiones SMTP abiertas
+app.config['MAIL_SMTP_IDLE_TIMEOUT'] = 60  # segundos que una conexión SMTP ociosa sigue abierta
+app.config['MAIL_BATCH_SIZE'] = 200
+app.config['MAIL_RATE_PER_DOMAIN'] = 5  # mensajes por segundo a un mismo dominio
+app.config['MAIL_RETRY_BASE'] = 60  # segundos, se duplica en cada intento
+app.config['MAIL_RETRY_MAX'] = 6 * 3600
+app.config['MAIL_MAX_ATTEMPTS'] = 8
+app.config['MAIL_SENDING_TIMEOUT'] = 600  # un envío 'sending' más antiguo se reintenta
+
+# Worker de tareas programadas (flask --app main run-worker)
+app.config['JOB_POLL_INTERVAL'] = 5  # segundos entre comprobaciones
+app.config['JOB_LEASE_TTL'] = 60  # segundos de validez del liderazgo del worker
+app.config['JOB_LOCK_TIMEOUT'] = 3600  # una tarea bloqueada más tiempo se da por caída
+app.config['JOB_RETRY_BASE'] = 60  # primer reintento tras un fallo, se duplica en cada uno
+app.config['JOB_RETRY_MAX'] = 3600
+app.config['JOB_MAX_ATTEMPTS'] = 5
+
+# Caché en proceso de las configuraciones de usuario
+app.config['SETTINGS_CACHE_SIZE'] = 1024  # usuarios
+app.config['SETTINGS_CACHE_TTL'] = 60  # segundos; acota el desfase entre procesos
+
+# Informes en segundo plano (pool de procesos y ficheros cacheados en disco)
+app.config['REPORTS_FOLDER'] = os.environ.get('GESTORTAXI_REPORTS_FOLDER', os.path.join('uploads', 'reports'))
+app.config['REPORT_WORKERS'] = int(os.environ.get('GESTORTAXI_REPORT_WORKERS', 2))
+app.config['REPORT_JOB_TIMEOUT'] = 3600  # un trabajo sin terminar más tiempo se da por perdido
+app.config['REPORT_RETENTION_DAYS'] = 7
+
+# Métricas (/metrics). Solo se sirven con METRICS_TOKEN definido y 'Authorization: Bearer <token>';
+# sin token no existen (404): tras un proxy local todas las peticiones parecerían locales
+app.config['SQL_INSTRUMENTATION'] = os.environ.get('GESTORTAXI_SQL_INSTRUMENTATION', '1') == '1'
+app.config['SLOW_QUERY_MS'] = int(os.environ.get('GESTORTAXI_SLOW_QUERY_MS', 100))
+app.config['METRICS_TOKEN'] = os.environ.get('GESTORTAXI_METRICS_TOKEN')
+
+# Listados grandes: JSON/NDJSON generado por bloques desde el cursor
+app.config['JSON_FAST_ENCODER'] = os.environ.get('GESTORTAXI_JSON_FAST_ENCODER', '1') == '1'
+
+# /api/batch: hilos para resolver en paralelo las subpeticiones GET (cada uno usa una conexión)
+app.config['BATCH_WORKERS'] = int(os.environ.get('GESTORTAXI_BATCH_WORKERS', 4))
+
+# Presupuesto de `python -X importtime -c "import main"` (flask --app main import-time)
+app.config['IMPORT_TIME_BUDGET_MS'] = int(os.environ.get('GESTORTAXI_IMPORT_TIME_BUDGET_MS', 300))
+
+# Instrumentación (métricas en memoria por proceso, expuestas en /metrics)
+METRIC_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class MetricsRegistry:
+    """Contadores e histogramas con etiquetas en formato de exposición de Prometheus
+
+    Cada proceso (worker de gunicorn, worker de tareas) tiene su propio registro.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help = {}
+        self._counters = {}
+        self._histograms = {}
+
+    def describe(self, name, kind, help_text):
+        self._help[name] = (kind, help_text)
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, tuple(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(METRIC_BUCKETS), 0, 0.0]
+            for i, bound in enumerate(METRIC_BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += 1
+            histogram[2] += value
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        escaped = []
+        for key, value in pairs:
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            escaped.append(f'{key}="{value}"')
+        return '{' + ','.join(escaped) + '}'
+
+    def render(self, gauges=()):
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, ([*buckets], count, total))
+                                for key, (buckets, count, total) in self._histograms.items())
+        lines = []
+        described = set()
+        
+        def header(name):
+            if name not in described and name in self._help:
+                kind, help_text = self._help[name]
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {kind}')
+                described.add(name)
+        
+        for (name, labels), value in counters:
+            header(name)
+            lines.append(f'{name}{self._labels(labels)} {value}')
+        for (name, labels), (buckets, count, total) in histograms:
+            header(name)
+            for bound, bucket_count in zip(METRIC_BUCKETS, buckets):
+                lines.append(f'{name}_bucket{self._labels(labels, [("le", bound)])} {bucket_count}')
+            lines.append(f'{name}_bucket{self._labels(labels, [("le", "+Inf")])} {count}')
+            lines.append(f'{name}_count{self._labels(labels)} {count}')
+            lines.append(f'{name}_sum{self._labels(labels)} {total:.6f}')
+        for name, labels, value in gauges:
+            header(name)
+            lines.append(f'{name}{self._labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+metrics.describe('sqlite_statement_duration_seconds', 'histogram', 'Tiempo de execute() por huella de SQL')
+metrics.describe('sqlite_fetch_seconds_total', 'counter', 'Tiempo dedicado a fetch* por huella de SQL')
+metrics.describe('sqlite_rows_total', 'counter', 'Filas devueltas (fetch*) o modificadas por huella de SQL')
+metrics.describe('sqlite_statement_errors_total', 'counter', 'Sentencias que terminaron en error')
+metrics.describe('sqlite_lock_wait_seconds', 'histogram', 'Espera hasta obtener el bloqueo de escritura (BEGIN IMMEDIATE)')
+metrics.describe('sqlite_lock_timeouts_total', 'counter', 'Sentencias abortadas con "database is locked"')
+metrics.describe('sqlite_slow_queries_total', 'counter', 'Sentencias por encima de SLOW_QUERY_MS')
+metrics.describe('sqlite_statement_info', 'gauge', 'SQL normalizado de cada huella')
+metrics.describe('db_pool_wait_seconds', 'histogram', 'Espera para obtener una conexión del pool')
+metrics.describe('db_pool_connections', 'gauge', 'Conexiones del pool por estado')
+metrics.describe('http_request_duration_seconds', 'histogram', 'Duración de las peticiones por ruta (sin el cuerpo en streaming)')
+metrics.describe('flask_template_render_seconds', 'histogram', 'Tiempo de renderizado de plantillas')
+
+_SQL_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_SQL_IN_LISTS = re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)+\s*\)', re.IGNORECASE)
+_sql_fingerprints = {}
+slow_queries = deque(maxlen=100)
+
+def sql_fingerprint(sql):
+    """Huella estable de una sentencia: literales como ?, listas IN colapsadas y espacios normalizados"""
+    fingerprint = _sql_fingerprints.get(sql)
+    if fingerprint is None:
+        normalized = ' '.join(_SQL_LITERALS.sub('?', sql).split())
+        normalized = _SQL_IN_LISTS.sub('IN (?+)', normalized)
+        fingerprint = (hashlib.sha1(normalized.encode()).hexdigest()[:12], normalized)
+        if len(_sql_fingerprints) < 10000:
+            _sql_fingerprints[sql] = fingerprint
+    return fingerprint
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor que mide cada sentencia y cuenta las filas leídas"""
+    _fingerprint = None
+
+    def _record(self, sql, parameters, started, many=False):
+        elapsed = time.perf_counter() - started
+        fingerprint, normalized = sql_fingerprint(sql)
+        self._fingerprint = fingerprint
+        labels = (('fingerprint', fingerprint),)
+        metrics.observe('sqlite_statement_duration_seconds', labels, elapsed)
+        if self.rowcount > 0:
+            metrics.inc('sqlite_rows_total', labels + (('kind', 'affected'),), self.rowcount)
+        verb = normalized.split(' ', 1)[0].upper()
+        if verb == 'BEGIN':
+            metrics.observe('sqlite_lock_wait_seconds', (), elapsed)
+        if elapsed * 1000 >= app.config['SLOW_QUERY_MS'] and verb in ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE'):
+            metrics.inc('sqlite_slow_queries_total', labels)
+            plan = []
+            if not many:
+                try:
+                    plan = [row[-1] for row in sqlite3.Connection.execute(
+                        self.connection, f'EXPLAIN QUERY PLAN {sql}', parameters
+                    ).fetchall()]
+                except sqlite3.Error:
+                    pass
+            slow_queries.append({
+                'at': datetime.now().isoformat(timespec='seconds'),
+                'fingerprint': fingerprint,
+                'sql': normalized,
+                'duration_ms': round(elapsed * 1000, 2),
+                'plan': plan,
+            })
+            app.logger.warning('Consulta lenta (%.1f ms) %s: %s | plan: %s',
+                               elapsed * 1000, fingerprint, normalized, ' / '.join(plan))
+
+    def _record_error(self, sql, error):
+        fingerprint, _ = sql_fingerprint(sql)
+        metrics.inc('sqlite_statement_errors_total', (('fingerprint', fingerprint),))
+        if 'locked' in str(error):
+            metrics.inc('sqlite_lock_timeouts_total')
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            super().execute(sql, parameters)
+        except sqlite3.Error as e:
+            self._record_error(sql, e)
+            raise
+        self._record(sql, parameters, started)
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            super().executemany(sql, seq_of_parameters)
+        except sqlite3.Error as e:
+            self._record_error(sql, e)
+            raise
+        self._record(sql, (), started, many=True)
+        return self
+
+    def _record_fetch(self, rows, started):
+        if self._fingerprint is not None:
+            labels = (('fingerprint', self._fingerprint),)
+            metrics.inc('sqlite_fetch_seconds_total', labels, time.perf_counter() - started)
+            metrics.inc('sqlite_rows_total', labels + (('kind', 'returned'),), rows)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._record_fetch(0 if row is None else 1, started)
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._record_fetch(len(rows), started)
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._record_fetch(len(rows), started)
+        return rows
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Conexión cuyos atajos execute/executemany pasan por InstrumentedCursor"""
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+# Funciones de utilidad para base de datos
+def open_db_connection(database=None):
+    """Abre una conexión nueva con WAL y los pragmas configurados"""
+    conn = sqlite3.connect(
+        database or app.config['DATABASE'],
+        timeout=app.config['SQLITE_BUSY_TIMEOUT'] / 1000,
+        isolation_level=None,  # autocommit; las transacciones se abren con transaction()
+        check_same_thread=False,  # el pool reparte conexiones entre hilos (nunca a la vez)
+        factory=InstrumentedConnection if app.config['SQL_INSTRUMENTATION'] else sqlite3.Connection,
+    )
+    conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA journal_mode = {app.config['SQLITE_JOURNAL_MODE']}")
+    conn.execute(f"PRAGMA synchronous = {app.config['SQLITE_SYNCHRONOUS']}")
+    conn.execute(f"PRAGMA cache_size = {int(app.config['SQLITE_CACHE_SIZE'])}")
+    conn.execute(f"PRAGMA mmap_size = {int(app.config['SQLITE_MMAP_SIZE'])}")
+    conn.execute(f"PRAGMA busy_timeout = {int(app.config['SQLITE_BUSY_TIMEOUT'])}")
+    return conn
+
+class ConnectionPool:
+    """Pool acotado de conexiones SQLite reutilizables"""
+
+    def __init__(self, database, max_size):
+        self.database = database
+        self.max_size = max_size
+        self.closed = False
+        self.last_used = time.monotonic()
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout=None):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.max_size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return open_db_connection(self.database)
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        try:
+            return self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise RuntimeError('No hay conexiones libres en el pool de base de datos')
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        if self.closed:
+            conn.close()
+            with self._lock:
+                self._created -= 1
+            return
+        self._idle.put(conn)
+
+    def close(self):
+        """Retira el pool: cierra ya las conexiones libres y las prestadas al devolverlas"""
+        self.closed = True
+        self.close_all()
+
+    def close_all(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+_db_pools = OrderedDict()  # del menos al más recientemente usado; DATABASE no se desaloja
+_db_pools_lock = threading.Lock()
+_db_local = threading.local()
+
+def get_db_pool(database=None):
+    database = database or app.config['DATABASE']
+    with _db_pools_lock:
+        pool = _db_pools.get(database)
+        if pool is None:
+            size = app.config['DB_POOL_SIZE' if database == app.config['DATABASE'] else 'SHARD_POOL_SIZE']
+            pool = _db_pools[database] = ConnectionPool(database, size)
+        _db_pools.move_to_end(database)
+        pool.last_used = time.monotonic()
+        evicted = _evict_shard_pools()
+    for stale in evicted:
+        stale.close()
+    return pool
+
+def _evict_shard_pools():
+    """Saca del registro los pools de shard que sobran (LRU) u ociosos; se llama con el lock"""
+    now = time.monotonic()
+    shards = [pool for name, pool in _db_pools.items() if name != app.config['DATABASE']]
+    excess = len(shards) - app.config['SHARD_POOLS_MAX']
+    evicted = []
+    for pool in shards:
+        if len(evicted) >= excess and now - pool.last_used < app.config['SHARD_POOL_IDLE_TIMEOUT']:
+            break
+        evicted.append(_db_pools.pop(pool.database))
+    return evicted
+
+def _db_holder():
+    # Dentro de una petición la conexión vive en g; fuera (scheduler, CLI) en el hilo
+    return g if has_app_context() else _db_local
+
+# Enrutado por cliente: usuario -> fichero, leído del directorio y recordado (LRU acotado)
+_tenant_databases = OrderedDict()
+_tenant_databases_lock = threading.Lock()
+_initialized_databases = set()
+_schema_lock = threading.Lock()
+
+def shard_database(shard):
+    """Ruta del fichero de un shard ('' es la base principal)"""
+    if not shard:
+        return app.config['DATABASE']
+    return os.path.join(app.config['SHARDS_FOLDER'], f'{shard}.db')
+
+def ensure_schema(database):
+    """Crea o migra el esquema de un fichero la primera vez que se usa en el proceso"""
+    if database in _initialized_databases:
+        return
+    with _schema_lock:
+        if database not in _initialized_databases:
+            init_db(database)
+            _initialized_databases.add(database)
+
+def remember_tenant(user_id, database):
+    with _tenant_databases_lock:
+        _tenant_databases[user_id] = database
+        _tenant_databases.move_to_end(user_id)
+        while len(_tenant_databases) > app.config['TENANT_CACHE_SIZE']:
+            _tenant_databases.popitem(last=False)
+
+def tenant_database(user_id):
+    """Fichero donde viven los datos del usuario"""
+    if not app.config['SHARDS_FOLDER'] or not user_id:
+        return app.config['DATABASE']
+    with _tenant_databases_lock:
+        database = _tenant_databases.get(user_id)
+        if database is not None:
+            _tenant_databases.move_to_end(user_id)
+    if database is None:
+        with shard_scope(app.config['DATABASE']):
+            row = execute_query('SELECT shard FROM tenant_shards WHERE user_id = ?', (user_id,), fetch=True)
+        database = shard_database(row[0]['shard'] if row else '')
+        ensure_schema(database)
+        remember_tenant(user_id, database)
+    return database
+
+def current_database(user_id=None):
+    """Base de datos del contexto: la del usuario indicado, la fijada con shard_scope,
+    la del usuario de la sesión o, si no hay ninguno, el directorio (DATABASE)"""
+    if user_id is None:
+        scoped = getattr(_db_holder(), 'db_scope', None)
+        if scoped:
+            return scoped
+        if has_request_context():
+            user_id = session.get('user_id')
+    return tenant_database(user_id)
+
+@contextmanager
+def shard_scope(database):
+    """Dirige las consultas del bloque a un fichero concreto (directorio, shard de un usuario...)"""
+    holder = _db_holder()
+    previous = getattr(holder, 'db_scope', None)
+    holder.db_scope = database
+    try:
+        yield database
+    finally:
+        holder.db_scope = previous
+
+def get_db_connection(user_id=None):
+    """Conexión del contexto actual: una por petición y fichero, devuelta al pool en el teardown"""
+    database = current_database(user_id)
+    holder = _db_holder()
+    conns = getattr(holder, 'db_conns', None)
+    if conns is None:
+        conns = holder.db_conns = {}
+        holder.db_tx_depths = {}
+        holder.db_conn_pools = {}
+    conn = conns.get(database)
+    if conn is None:
+        started = time.perf_counter()
+        # Se devuelve al pool del que salió aunque entretanto se haya desalojado
+        pool = holder.db_conn_pools[database] = get_db_pool(database)
+        conn = pool.acquire(timeout=app.config['DB_POOL_TIMEOUT'])
+        metrics.observe('db_pool_wait_seconds', (), time.perf_counter() - started)
+        conns[database] = conn
+        holder.db_tx_depths[database] = 0
+    return conn
+
+@app.teardown_appcontext
+def release_db_connection(exception=None, database=None):
+    holder = _db_holder()
+    conns = getattr(holder, 'db_conns', None) or {}
+    for name in ([database] if database else list(conns)):
+        conn = conns.pop(name, None)
+        if conn is not None:
+            holder.db_tx_depths.pop(name, None)
+            holder.db_conn_pools.pop(name).release(conn)
+
+@contextmanager
+def _scoped_connection():
+    # Fuera de una petición, libera la conexión si la hemos abierto aquí
+    database = current_database()
+    owns = not has_app_context() and database not in (getattr(_db_local, 'db_conns', None) or {})
+    try:
+        yield get_db_connection()
+    finally:
+        if owns:
+            release_db_connection(database=database)
+
+@contextmanager
+def transaction():
+    """Agrupa varias sentencias en una única transacción (un solo commit)"""
+    with _scoped_connection() as conn:
+        depths = _db_holder().db_tx_depths
+        database = current_database()
+        depth = depths[database]
+        savepoint = f'sp_{depth}'
+        conn.execute('BEGIN IMMEDIATE' if depth == 0 else f'SAVEPOINT {savepoint}')
+        depths[database] = depth + 1
+        try:
+            yield conn
+        except BaseException:
+            depths[database] = depth
+            if depth == 0:
+                conn.rollback()
+            else:
+                conn.execute(f'ROLLBACK TO {savepoint}')
+                conn.execute(f'RELEASE {savepoint}')
+            raise
+        depths[database] = depth
+        conn.execute('COMMIT' if depth == 0 else f'RELEASE {savepoint}')
+
+def execute_query(query, params=None, fetch=False):
+    with _scoped_connection() as conn:
+        cursor = conn.cursor()
+        if params:
+            cursor.execute(query, params)
+        else:
+            cursor.execute(query)
+
+        if fetch:
+            return cursor.fetchall()
+        # En autocommit cada sentencia se confirma sola salvo dentro de transaction()
+        return cursor.lastrowid
 
 # Configuración de base de datos
-def init_db():
-    conn = sqlite3.connect('gestortaxi.db')
+def init_db(database=None):
+    database = database or app.config['DATABASE']
+    if os.path.dirname(database):
+        os.makedirs(os.path.dirname(database), exist_ok=True)
+    conn = open_db_connection(database)
     cursor = conn.cursor()
     
     # Tabla de usuarios
@@ -168,14 +708,14 @@ def init_db():
         )
     ''')
     
-    # Tabla de facturas
+    # Tabla de facturas (el número es único por usuario y empresa, ver idx_invoices_number)
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS invoices (
             id TEXT PRIMARY KEY,
             user_id TEXT,
             company_id TEXT,
             client_id TEXT,
-            invoice_number TEXT UNIQUE,
+            invoice_number TEXT,
             date DATE,
             due_date DATE,
             subtotal DECIMAL(10,2),
@@ -190,6 +730,24 @@ def init_db():
             FOREIGN KEY (company_id) REFERENCES companies (id)
         )
     ''')
+    migrate_invoice_number_uniqueness(cursor)
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_invoices_number
+        ON invoices (user_id, COALESCE(company_id, ''), invoice_number)
+    ''')
+    
+    # Secuencias de numeración de facturas por usuario, empresa, serie y año
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS invoice_sequences (
+            user_id TEXT NOT NULL,
+            company_id TEXT NOT NULL DEFAULT '',
+            series TEXT NOT NULL,
+            year INTEGER NOT NULL,
+            last_number INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, company_id, series, year)
+        ) WITHOUT ROWID
+    ''')
     
     # Tabla de clientes
     cursor.execute('''
@@ -233,6 +791,77 @@ def init_db():
         )
     ''')
     
+    # Nóminas calculadas: una por empleado y mes, se rehacen al repetir el cálculo del periodo
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS payslips (
+            id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            company_id TEXT,
+            employee_id TEXT NOT NULL,
+            period TEXT NOT NULL,
+            days INTEGER NOT NULL,
+            gross DECIMAL(10,2) NOT NULL,
+            ss_base DECIMAL(10,2) NOT NULL,
+            ss_employee DECIMAL(10,2) NOT NULL,
+            irpf_rate DECIMAL(5,2) NOT NULL,
+            irpf DECIMAL(10,2) NOT NULL,
+            deductions DECIMAL(10,2) NOT NULL DEFAULT 0,
+            net DECIMAL(10,2) NOT NULL,
+            ss_employer DECIMAL(10,2) NOT NULL,
+            total_cost DECIMAL(10,2) NOT NULL,
+            run_id TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (company_id) REFERENCES companies (id),
+            FOREIGN KEY (employee_id) REFERENCES employees (id)
+        )
+    ''')
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_payslips_employee_period ON payslips (employee_id, period)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_payslips_user_period ON payslips (user_id, period)')
+    
+    # Extractos bancarios importados (Norma 43 o CSV); amount con signo: negativo = cargo
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS bank_movements (
+            id TEXT PRIMARY KEY,
+            user_id TEXT,
+            company_id TEXT,
+            account TEXT,
+            date DATE,
+            value_date DATE,
+            amount DECIMAL(10,2),
+            concept TEXT,
+            reference TEXT,
+            source TEXT,
+            import_key TEXT,
+            status TEXT DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (company_id) REFERENCES companies (id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_bank_movements_import_key
+        ON bank_movements (user_id, import_key) WHERE import_key IS NOT NULL
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_bank_movements_user_status_date ON bank_movements (user_id, status, date)')
+    
+    # Conciliación: cada movimiento con como mucho un apunte y cada apunte con un movimiento
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS reconciliations (
+            movement_id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            ledger TEXT NOT NULL,
+            record_id TEXT NOT NULL,
+            method TEXT NOT NULL DEFAULT 'auto',
+            day_diff INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (movement_id) REFERENCES bank_movements (id)
+        )
+    ''')
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_reconciliations_record ON reconciliations (ledger, record_id)')
+    for trigger_sql in reconciliation_trigger_statements():
+        cursor.execute(trigger_sql)
+    
     # Tabla de recordatorios
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS reminders (
@@ -280,12 +909,705 @@ def init_db():
             FOREIGN KEY (user_id) REFERENCES users (id)
         )
     ''')
+    # Outbox de correo: se escribe en la misma transacción que el cambio que lo origina
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS email_outbox (
+            id TEXT PRIMARY KEY,
+            user_id TEXT,
+            to_email TEXT NOT NULL,
+            subject TEXT NOT NULL,
+            body TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            sent_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_email_outbox_due ON email_outbox (status, next_attempt_at)')
+    
+    # Tareas programadas y liderazgo del worker
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS scheduled_jobs (
+            name TEXT PRIMARY KEY,
+            next_run_at TIMESTAMP NOT NULL,
+            last_run_at TIMESTAMP,
+            last_success_at TIMESTAMP,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            locked_by TEXT,
+            locked_until TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS worker_leases (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    ''')
+    
+    # Directorio de shards (solo se usa en DATABASE): usuario -> fichero de sus datos
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS tenant_shards (
+            user_id TEXT PRIMARY KEY,
+            shard TEXT NOT NULL,
+            moved_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_tenant_shards_shard ON tenant_shards (shard)')
+    
+    has_settings_key = cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_settings_user_key'"
+    ).fetchone()
+    if not has_settings_key:
+        # Bases antiguas: INSERT OR REPLACE con UUID nuevo duplicaba claves; se conserva la última
+        cursor.execute('''
+            DELETE FROM settings WHERE rowid NOT IN (
+                SELECT MAX(rowid) FROM settings GROUP BY user_id, category, key
+            )
+        ''')
+        cursor.execute('CREATE UNIQUE INDEX idx_settings_user_key ON settings (user_id, category, key)')
+    
+    # Índices compuestos para los filtros por usuario/vehículo y rango de fechas.
+    # Incluyen amount para que los SUM mensuales se resuelvan solo con el índice.
+    indexes = [
+        'CREATE INDEX IF NOT EXISTS idx_income_user_date ON income (user_id, date, amount)',
+        'CREATE INDEX IF NOT EXISTS idx_income_vehicle_date ON income (vehicle_id, date, amount)',
+        'CREATE INDEX IF NOT EXISTS idx_expenses_user_date ON expenses (user_id, date, amount)',
+        'CREATE INDEX IF NOT EXISTS idx_expenses_vehicle_date ON expenses (vehicle_id, date, amount)',
+        'CREATE INDEX IF NOT EXISTS idx_expenses_user_category_date ON expenses (user_id, category, date, amount)',
+        'CREATE INDEX IF NOT EXISTS idx_analytics_user_date ON analytics (user_id, date, metric_type, metric_value)',
+        'CREATE INDEX IF NOT EXISTS idx_reminders_user_status_due ON reminders (user_id, status, due_date)',
+        'CREATE INDEX IF NOT EXISTS idx_reminders_dispatch ON reminders (status, notification_sent, due_date)',
+        'DROP INDEX IF EXISTS idx_vehicles_user_status',
+        'CREATE INDEX IF NOT EXISTS idx_vehicles_user_status_created ON vehicles (user_id, status, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_employees_user_status_created ON employees (user_id, status, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_invoices_user_created ON invoices (user_id, created_at)',
+    ]
+    for index in indexes:
+        cursor.execute(index)
+    
+    # Resumen mensual por (usuario, empresa, vehículo, mes) mantenido por triggers
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS monthly_rollups (
+            user_id TEXT NOT NULL,
+            month TEXT NOT NULL,
+            company_id TEXT NOT NULL DEFAULT '',
+            vehicle_id TEXT NOT NULL DEFAULT '',
+            income_total DECIMAL(15,2) NOT NULL DEFAULT 0,
+            income_vat DECIMAL(15,2) NOT NULL DEFAULT 0,
+            income_count INTEGER NOT NULL DEFAULT 0,
+            expenses_total DECIMAL(15,2) NOT NULL DEFAULT 0,
+            expenses_vat DECIMAL(15,2) NOT NULL DEFAULT 0,
+            expenses_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, month, company_id, vehicle_id)
+        ) WITHOUT ROWID
+    ''')
+    for trigger_sql in rollup_trigger_statements():
+        cursor.execute(trigger_sql)
+    rollups_empty = cursor.execute('SELECT 1 FROM monthly_rollups LIMIT 1').fetchone() is None
+    
+    # Versión de los datos de cada usuario por tabla (ETags y claves de caché de informes)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS data_versions (
+            user_id TEXT NOT NULL,
+            table_name TEXT NOT NULL,
+            version INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP,
+            PRIMARY KEY (user_id, table_name)
+        ) WITHOUT ROWID
+    ''')
+    ensure_column(cursor, 'data_versions', 'updated_at', 'TIMESTAMP')
+    for trigger_sql in data_version_trigger_statements():
+        cursor.execute(trigger_sql)
+    
+    # Versión de los libros por usuario y mes: invalida solo los trimestres fiscales con cambios
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ledger_month_versions (
+            user_id TEXT NOT NULL,
+            month TEXT NOT NULL,
+            version INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, month)
+        ) WITHOUT ROWID
+    ''')
+    for trigger_sql in ledger_month_trigger_statements():
+        cursor.execute(trigger_sql)
+    
+    # Modelos calculados: uno por usuario, empresa, modelo y periodo
+    ensure_column(cursor, 'fiscal_documents', 'data_version', 'TEXT')
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_fiscal_documents_model_period
+        ON fiscal_documents (user_id, COALESCE(company_id, ''), model_number, year, period)
+        WHERE type = 'modelo'
+    ''')
+    
+    # Índice de búsqueda de texto completo (owner y kind se indexan para filtrar dentro del MATCH)
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+            owner, kind, title, body, record_id UNINDEXED, doc_date UNINDEXED,
+            tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS search_docs (
+            kind TEXT NOT NULL,
+            record_id TEXT NOT NULL,
+            docid INTEGER NOT NULL,
+            PRIMARY KEY (kind, record_id)
+        ) WITHOUT ROWID
+    ''')
+    for trigger_sql in search_trigger_statements():
+        cursor.execute(trigger_sql)
+    search_empty = cursor.execute('SELECT 1 FROM search_docs LIMIT 1').fetchone() is None
+    
+    # Trabajos de informes en segundo plano
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS report_jobs (
+            id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            report_type TEXT NOT NULL,
+            format TEXT NOT NULL,
+            filters TEXT NOT NULL,
+            cache_key TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            rows_written INTEGER NOT NULL DEFAULT 0,
+            total_rows INTEGER,
+            file_path TEXT,
+            file_size INTEGER,
+            error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    # Un único trabajo vivo (en cola, en curso o terminado) por clave de caché
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_report_jobs_cache
+        ON report_jobs (cache_key) WHERE status IN ('queued', 'running', 'done')
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_report_jobs_user_created ON report_jobs (user_id, created_at)')
+    
+    # Clave natural de los apuntes importados (evita duplicados al reimportar)
+    for ledger in ('income', 'expenses'):
+        ensure_column(cursor, ledger, 'import_key', 'TEXT')
+        cursor.execute(f'''
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_{ledger}_import_key
+            ON {ledger} (user_id, import_key) WHERE import_key IS NOT NULL
+        ''')
+    cursor.execute('PRAGMA optimize')
     
     conn.commit()
     conn.close()
+    
+    # Primera migración: poblar el resumen y el índice de búsqueda con el histórico existente
+    with shard_scope(database):
+        if rollups_empty:
+            rebuild_monthly_rollups()
+        if search_empty:
+            rebuild_search_index()
+
+def migrate_invoice_number_uniqueness(cursor):
+    """Sustituye el UNIQUE global de invoice_number (bases antiguas) por uno por usuario y empresa"""
+    table_sql = cursor.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'invoices'"
+    ).fetchone()[0]
+    if 'invoice_number TEXT UNIQUE' not in table_sql:
+        return
+    cursor.execute('BEGIN IMMEDIATE')
+    cursor.execute(table_sql.replace('CREATE TABLE invoices', 'CREATE TABLE invoices_migrated', 1)
+                            .replace('invoice_number TEXT UNIQUE', 'invoice_number TEXT', 1))
+    cursor.execute('INSERT INTO invoices_migrated SELECT * FROM invoices')
+    cursor.execute('DROP TABLE invoices')
+    cursor.execute('ALTER TABLE invoices_migrated RENAME TO invoices')
+    cursor.execute('COMMIT')
+
+def ensure_column(cursor, table, column, definition):
+    """Añade una columna a una tabla existente si todavía no la tiene"""
+    existing = [row[1] for row in cursor.execute(f'PRAGMA table_info({table})')]
+    if column not in existing:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+def _rollup_add_sql(ledger, row):
+    return f'''
+        INSERT INTO monthly_rollups (user_id, month, company_id, vehicle_id,
+                                     {ledger}_total, {ledger}_vat, {ledger}_count)
+        SELECT {row}.user_id, substr({row}.date, 1, 7), COALESCE({row}.company_id, ''),
+               COALESCE({row}.vehicle_id, ''), COALESCE({row}.amount, 0),
+               COALESCE({row}.vat_amount, 0), 1
+        WHERE {row}.user_id IS NOT NULL AND {row}.date IS NOT NULL
+        ON CONFLICT (user_id, month, company_id, vehicle_id) DO UPDATE SET
+            {ledger}_total = {ledger}_total + excluded.{ledger}_total,
+            {ledger}_vat = {ledger}_vat + excluded.{ledger}_vat,
+            {ledger}_count = {ledger}_count + 1;
+    '''
+
+def _rollup_remove_sql(ledger, row):
+    return f'''
+        UPDATE monthly_rollups SET
+            {ledger}_total = {ledger}_total - COALESCE({row}.amount, 0),
+            {ledger}_vat = {ledger}_vat - COALESCE({row}.vat_amount, 0),
+            {ledger}_count = {ledger}_count - 1
+        WHERE user_id = {row}.user_id AND month = substr({row}.date, 1, 7)
+        AND company_id = COALESCE({row}.company_id, '') AND vehicle_id = COALESCE({row}.vehicle_id, '');
+    '''
+
+def rollup_trigger_statements():
+    """Triggers que mantienen monthly_rollups en la misma transacción que cada escritura"""
+    statements = []
+    for ledger in ('income', 'expenses'):
+        statements += [
+            f'DROP TRIGGER IF EXISTS trg_{ledger}_rollup_insert',
+            f'DROP TRIGGER IF EXISTS trg_{ledger}_rollup_delete',
+            f'DROP TRIGGER IF EXISTS trg_{ledger}_rollup_update',
+            f'''CREATE TRIGGER trg_{ledger}_rollup_insert AFTER INSERT ON {ledger} BEGIN
+                {_rollup_add_sql(ledger, 'NEW')}
+            END''',
+            f'''CREATE TRIGGER trg_{ledger}_rollup_delete AFTER DELETE ON {ledger} BEGIN
+                {_rollup_remove_sql(ledger, 'OLD')}
+            END''',
+            f'''CREATE TRIGGER trg_{ledger}_rollup_update
+                AFTER UPDATE OF user_id, company_id, vehicle_id, date, amount, vat_amount ON {ledger} BEGIN
+                {_rollup_remove_sql(ledger, 'OLD')}
+                {_rollup_add_sql(ledger, 'NEW')}
+            END''',
+        ]
+    return statements
+
+DATA_VERSION_TABLES = (
+    'income', 'expenses', 'vehicles', 'companies', 'employees', 'clients',
+    'invoices', 'invoice_sequences', 'reminders', 'settings', 'bank_movements', 'reconciliations',
+    'payslips',
+)
+REPORT_DATA_TABLES = ('income', 'expenses', 'vehicles', 'companies')
+
+def _data_version_bump_sql(table, row):
+    return f'''
+        INSERT INTO data_versions (user_id, table_name, version, updated_at)
+        SELECT {row}.user_id, '{table}', 1, CURRENT_TIMESTAMP WHERE {row}.user_id IS NOT NULL
+        ON CONFLICT (user_id, table_name) DO UPDATE SET
+            version = version + 1, updated_at = excluded.updated_at;
+    '''
+
+def data_version_trigger_statements():
+    """Triggers que incrementan data_versions con cada escritura en las tablas versionadas"""
+    statements = []
+    for table in DATA_VERSION_TABLES:
+        statements += [
+            f'DROP TRIGGER IF EXISTS trg_{table}_version_insert',
+            f'DROP TRIGGER IF EXISTS trg_{table}_version_delete',
+            f'DROP TRIGGER IF EXISTS trg_{table}_version_update',
+            f'''CREATE TRIGGER trg_{table}_version_insert AFTER INSERT ON {table} BEGIN
+                {_data_version_bump_sql(table, 'NEW')}
+            END''',
+            f'''CREATE TRIGGER trg_{table}_version_delete AFTER DELETE ON {table} BEGIN
+                {_data_version_bump_sql(table, 'OLD')}
+            END''',
+            f'''CREATE TRIGGER trg_{table}_version_update AFTER UPDATE ON {table} BEGIN
+                {_data_version_bump_sql(table, 'OLD')}
+                {_data_version_bump_sql(table, 'NEW')}
+            END''',
+        ]
+    return statements
+
+def _ledger_month_bump_sql(row):
+    return f'''
+        INSERT INTO ledger_month_versions (user_id, month, version)
+        SELECT {row}.user_id, substr({row}.date, 1, 7), 1
+        WHERE {row}.user_id IS NOT NULL AND {row}.date IS NOT NULL
+        ON CONFLICT (user_id, month) DO UPDATE SET version = version + 1;
+    '''
+
+def ledger_month_trigger_statements():
+    """Triggers que incrementan la versión del mes afectado por cada escritura en los libros"""
+    statements = []
+    for ledger in ('income', 'expenses'):
+        statements += [
+            f'DROP TRIGGER IF EXISTS trg_{ledger}_month_insert',
+            f'DROP TRIGGER IF EXISTS trg_{ledger}_month_delete',
+            f'DROP TRIGGER IF EXISTS trg_{ledger}_month_update',
+            f'''CREATE TRIGGER trg_{ledger}_month_insert AFTER INSERT ON {ledger} BEGIN
+                {_ledger_month_bump_sql('NEW')}
+            END''',
+            f'''CREATE TRIGGER trg_{ledger}_month_delete AFTER DELETE ON {ledger} BEGIN
+                {_ledger_month_bump_sql('OLD')}
+            END''',
+            f'''CREATE TRIGGER trg_{ledger}_month_update AFTER UPDATE ON {ledger} BEGIN
+                {_ledger_month_bump_sql('OLD')}
+                {_ledger_month_bump_sql('NEW')}
+            END''',
+        ]
+    return statements
+
+def reconciliation_trigger_statements():
+    """Al borrar un apunte o un movimiento se deshace su conciliación"""
+    statements = []
+    for ledger in ('income', 'expenses'):
+        statements += [
+            f'DROP TRIGGER IF EXISTS trg_{ledger}_reconciliation_delete',
+            f'''CREATE TRIGGER trg_{ledger}_reconciliation_delete AFTER DELETE ON {ledger} BEGIN
+                UPDATE bank_movements SET status = 'pending' WHERE id IN (
+                    SELECT movement_id FROM reconciliations WHERE ledger = '{ledger}' AND record_id = OLD.id
+                );
+                DELETE FROM reconciliations WHERE ledger = '{ledger}' AND record_id = OLD.id;
+            END''',
+        ]
+    statements += [
+        'DROP TRIGGER IF EXISTS trg_bank_movements_reconciliation_delete',
+        '''CREATE TRIGGER trg_bank_movements_reconciliation_delete AFTER DELETE ON bank_movements BEGIN
+            DELETE FROM reconciliations WHERE movement_id = OLD.id;
+        END''',
+    ]
+    return statements
+
+def get_data_versions(user_id, tables=REPORT_DATA_TABLES):
+    """Versión actual de cada tabla para el usuario (0 si nunca se ha escrito)"""
+    placeholders = ', '.join('?' * len(tables))
+    rows = execute_query(f'''
+        SELECT table_name, version FROM data_versions
+        WHERE user_id = ? AND table_name IN ({placeholders})
+    ''', [user_id, *tables], fetch=True)
+    versions = dict.fromkeys(tables, 0)
+    versions.update((row['table_name'], row['version']) for row in rows)
+    return versions
+
+# Búsqueda de texto completo (FTS5). search_docs enlaza cada registro con su fila del índice
+# para que los triggers puedan actualizarla o borrarla sin recorrer el índice. El propietario
+# se guarda sin guiones para que sea un único token.
+SEARCH_ENTITIES = {
+    'income': {
+        'title': ['source'],
+        'body': ['description', 'invoice_number', 'payment_method'],
+        'date': 'date',
+    },
+    'expenses': {
+        'title': ['supplier'],
+        'body': ['description', 'category', 'invoice_number'],
+        'date': 'date',
+    },
+    'invoices': {
+        'title': ['invoice_number'],
+        'body': ['notes', 'status'],
+        'date': 'date',
+    },
+    'clients': {
+        'title': ['name'],
+        'body': ['cif_nif', 'email', 'phone'],
+        'date': 'created_at',
+    },
+}
+
+def _search_text_sql(columns, row):
+    return " || ' ' || ".join(f"COALESCE({row}.{column}, '')" for column in columns)
+
+def _search_add_sql(entity, row):
+    spec = SEARCH_ENTITIES[entity]
+    return f'''
+        INSERT INTO search_index (owner, kind, title, body, record_id, doc_date)
+        SELECT replace({row}.user_id, '-', ''), '{entity}', {_search_text_sql(spec['title'], row)},
+               {_search_text_sql(spec['body'], row)}, {row}.id, {row}.{spec['date']}
+        WHERE {row}.user_id IS NOT NULL;
+        INSERT INTO search_docs (kind, record_id, docid)
+        SELECT '{entity}', {row}.id, last_insert_rowid() WHERE {row}.user_id IS NOT NULL;
+    '''
+
+def _search_remove_sql(entity, row):
+    return f'''
+        DELETE FROM search_index WHERE rowid = (
+            SELECT docid FROM search_docs WHERE kind = '{entity}' AND record_id = {row}.id
+        );
+        DELETE FROM search_docs WHERE kind = '{entity}' AND record_id = {row}.id;
+    '''
+
+def search_trigger_statements():
+    """Triggers que mantienen search_index en la misma transacción que cada escritura"""
+    statements = []
+    for entity, spec in SEARCH_ENTITIES.items():
+        indexed = ', '.join(['user_id', spec['date']] + spec['title'] + spec['body'])
+        statements += [
+            f'DROP TRIGGER IF EXISTS trg_{entity}_search_insert',
+            f'DROP TRIGGER IF EXISTS trg_{entity}_search_delete',
+            f'DROP TRIGGER IF EXISTS trg_{entity}_search_update',
+            f'''CREATE TRIGGER trg_{entity}_search_insert AFTER INSERT ON {entity} BEGIN
+                {_search_add_sql(entity, 'NEW')}
+            END''',
+            f'''CREATE TRIGGER trg_{entity}_search_delete AFTER DELETE ON {entity} BEGIN
+                {_search_remove_sql(entity, 'OLD')}
+            END''',
+            f'''CREATE TRIGGER trg_{entity}_search_update AFTER UPDATE OF {indexed} ON {entity} BEGIN
+                {_search_remove_sql(entity, 'OLD')}
+                {_search_add_sql(entity, 'NEW')}
+            END''',
+        ]
+    return statements
+
+def rebuild_search_index():
+    """Regenera search_index y search_docs desde las tablas de origen"""
+    with transaction() as conn:
+        conn.execute('DELETE FROM search_index')
+        conn.execute('DELETE FROM search_docs')
+        for entity, spec in SEARCH_ENTITIES.items():
+            conn.execute(f'''
+                INSERT INTO search_index (owner, kind, title, body, record_id, doc_date)
+                SELECT replace(user_id, '-', ''), '{entity}', {_search_text_sql(spec['title'], entity)},
+                       {_search_text_sql(spec['body'], entity)}, id, {spec['date']}
+                FROM {entity} WHERE user_id IS NOT NULL
+            ''')
+        conn.execute('''
+            INSERT INTO search_docs (kind, record_id, docid)
+            SELECT kind, record_id, rowid FROM search_index
+        ''')
+    execute_query("INSERT INTO search_index (search_index) VALUES ('optimize')")
+
+@app.cli.command('rebuild-search')
+def rebuild_search_command():
+    """Regenera el índice de búsqueda (p. ej. tras un VACUUM o una carga sin triggers)"""
+    init_app()
+    rebuild_search_index()
+    total = execute_query('SELECT COUNT(*) FROM search_docs', fetch=True)[0][0]
+    click.echo(f'Índice de búsqueda regenerado: {total} documentos')
+
+def rebuild_monthly_rollups(user_id=None):
+    """Regenera monthly_rollups desde los libros de ingresos y gastos"""
+    user_filter = 'AND user_id = ?' if user_id else ''
+    params = (user_id,) if user_id else ()
+    with transaction() as conn:
+        conn.execute(f'DELETE FROM monthly_rollups WHERE 1 = 1 {user_filter}', params)
+        conn.execute(f'''
+            INSERT INTO monthly_rollups (user_id, month, company_id, vehicle_id,
+                                         income_total, income_vat, income_count,
+                                         expenses_total, expenses_vat, expenses_count)
+            SELECT user_id, month, company_id, vehicle_id,
+                   SUM(income_total), SUM(income_vat), SUM(income_count),
+                   SUM(expenses_total), SUM(expenses_vat), SUM(expenses_count)
+            FROM (
+                SELECT user_id, substr(date, 1, 7) as month, COALESCE(company_id, '') as company_id,
+                       COALESCE(vehicle_id, '') as vehicle_id,
+                       COALESCE(amount, 0) as income_total, COALESCE(vat_amount, 0) as income_vat,
+                       1 as income_count, 0 as expenses_total, 0 as expenses_vat, 0 as expenses_count
+                FROM income WHERE user_id IS NOT NULL AND date IS NOT NULL {user_filter}
+                UNION ALL
+                SELECT user_id, substr(date, 1, 7), COALESCE(company_id, ''), COALESCE(vehicle_id, ''),
+                       0, 0, 0, COALESCE(amount, 0), COALESCE(vat_amount, 0), 1
+                FROM expenses WHERE user_id IS NOT NULL AND date IS NOT NULL {user_filter}
+            )
+            GROUP BY user_id, month, company_id, vehicle_id
+        ''', params * 2)
+
+@app.cli.command('rebuild-rollups')
+@click.option('--user', 'user_id', default=None, help='Regenerar solo este usuario')
+def rebuild_rollups_command(user_id):
+    """Regenera la tabla monthly_rollups desde income y expenses"""
+    init_app()
+    rebuild_monthly_rollups(user_id)
+    click.echo('Resumen mensual regenerado')
+
+# Shards por cliente: alta de usuarios, tareas que recorren todos los ficheros y reparto
+# Tablas que mantienen los triggers: al mover un usuario se regeneran al copiar sus datos
+SHARD_DERIVED_TABLES = ('monthly_rollups', 'data_versions', 'ledger_month_versions')
+
+def _copy_user_row(conn, user):
+    columns = list(user.keys())
+    conn.execute(f'''
+        INSERT OR REPLACE INTO users ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})
+    ''', tuple(user))
 
-# Inicializar base de datos al arrancar
-init_db()
+def place_new_tenant(user_id):
+    """Fichero del usuario recién registrado: uno propio si hay shards, si no DATABASE
+
+    Se llama dentro de la transacción del alta en el directorio. La fila de users se copia
+    también al shard para las consultas que la cruzan (recordatorios).
+    """
+    if not app.config['SHARDS_FOLDER']:
+        return app.config['DATABASE']
+    database = shard_database(user_id)
+    ensure_schema(database)
+    with shard_scope(app.config['DATABASE']):
+        user = execute_query('SELECT * FROM users WHERE id = ?', (user_id,), fetch=True)[0]
+        execute_query('INSERT INTO tenant_shards (user_id, shard) VALUES (?, ?)', (user_id, user_id))
+    with shard_scope(database), transaction() as conn:
+        _copy_user_row(conn, user)
+    remember_tenant(user_id, database)
+    return database
+
+def all_databases():
+    """DATABASE y todos los shards con algún usuario"""
+    databases = [app.config['DATABASE']]
+    if app.config['SHARDS_FOLDER']:
+        with shard_scope(app.config['DATABASE']):
+            rows = execute_query("SELECT DISTINCT shard FROM tenant_shards WHERE shard != ''", fetch=True)
+        databases += [shard_database(row['shard']) for row in rows]
+    return databases
+
+def across_shards(func):
+    """Ejecuta una tarea en cada fichero por turnos y suma los resúmenes que devuelva"""
+    @wraps(func)
+    def run_everywhere(*args, **kwargs):
+        summary = None
+        for database in all_databases():
+            ensure_schema(database)
+            with shard_scope(database):
+                result = func(*args, **kwargs)
+            if isinstance(result, dict):
+                summary = summary or {}
+                for key, value in result.items():
+                    summary[key] = summary.get(key, 0) + value
+        return summary
+    return run_everywhere
+
+def tenant_tables(conn, schema='main'):
+    """Tablas con datos por usuario (columna user_id), en orden de creación"""
+    tables = []
+    for row in conn.execute(f"SELECT name FROM {schema}.sqlite_master WHERE type = 'table' ORDER BY rowid"):
+        name = row['name']
+        if name in SHARD_DERIVED_TABLES or name in ('users', 'tenant_shards') or name.startswith('sqlite_'):
+            continue
+        columns = [column['name'] for column in conn.execute(f'PRAGMA {schema}.table_info({name})')]
+        if 'user_id' in columns:
+            tables.append((name, columns))
+    return tables
+
+def move_tenant(user_id, shard):
+    """Copia los datos de un usuario a otro shard ('' = DATABASE) y los borra del origen
+
+    Orden seguro ante fallos: copia confirmada, cambio en el directorio y borrado del
+    origen. Repetirlo tras un fallo vuelve a copiar desde cero. Con la aplicación parada.
+    """
+    source = tenant_database(user_id)
+    target = shard_database(shard)
+    if os.path.abspath(source) == os.path.abspath(target):
+        return 0
+    ensure_schema(target)
+    
+    copied = 0
+    conn = open_db_connection(target)
+    try:
+        conn.execute('ATTACH DATABASE ? AS source', (source,))
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            source_tables = dict(tenant_tables(conn, 'source'))
+            for table, columns in tenant_tables(conn):
+                shared = ', '.join(column for column in columns if column in source_tables.get(table, ()))
+                if not shared:
+                    continue
+                conn.execute(f'DELETE FROM main.{table} WHERE user_id = ?', (user_id,))
+                copied += conn.execute(f'''
+                    INSERT INTO main.{table} ({shared}) SELECT {shared} FROM source.{table} WHERE user_id = ?
+                ''', (user_id,)).rowcount
+            user = conn.execute('SELECT * FROM source.users WHERE id = ?', (user_id,)).fetchone()
+            if user is not None:
+                _copy_user_row(conn, user)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.execute('DETACH DATABASE source')
+    finally:
+        conn.close()
+    
+    with shard_scope(app.config['DATABASE']):
+        execute_query('''
+            INSERT INTO tenant_shards (user_id, shard) VALUES (?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET shard = excluded.shard, moved_at = CURRENT_TIMESTAMP
+        ''', (user_id, shard))
+    remember_tenant(user_id, target)
+    
+    # Los triggers del origen descuentan resúmenes e índice de búsqueda al borrar
+    with shard_scope(source), transaction() as conn:
+        for table, _ in tenant_tables(conn):
+            conn.execute(f'DELETE FROM {table} WHERE user_id = ?', (user_id,))
+        for table in SHARD_DERIVED_TABLES:
+            conn.execute(f'DELETE FROM {table} WHERE user_id = ?', (user_id,))
+        if source != app.config['DATABASE']:
+            conn.execute('DELETE FROM users WHERE id = ?', (user_id,))
+    invalidate_user_settings(user_id)
+    return copied
+
+@app.cli.command('rebalance-shards')
+@click.option('--user', 'user_ids', multiple=True, help='Usuario a mover (por defecto, todos los que siguen en DATABASE)')
+@click.option('--to', 'shard', default=None, help="Shard destino; por defecto uno propio por usuario ('' vuelve a DATABASE)")
+@click.option('--dry-run', is_flag=True, help='Mostrar los movimientos sin hacerlos')
+def rebalance_shards_command(user_ids, shard, dry_run):
+    """Reparte los usuarios entre ficheros y migra sus datos (con la aplicación parada)"""
+    init_app()
+    if not app.config['SHARDS_FOLDER']:
+        raise click.ClickException('Define GESTORTAXI_SHARDS_FOLDER para usar shards')
+    if not user_ids:
+        with shard_scope(app.config['DATABASE']):
+            user_ids = [row['id'] for row in execute_query('''
+                SELECT id FROM users WHERE id NOT IN (SELECT user_id FROM tenant_shards)
+            ''', fetch=True)]
+    for user_id in user_ids:
+        target = user_id if shard is None else shard
+        source = tenant_database(user_id)
+        if dry_run:
+            click.echo(f'{user_id}: {source} -> {shard_database(target)}')
+            continue
+        started = time.perf_counter()
+        copied = move_tenant(user_id, target)
+        click.echo(f'{user_id}: {source} -> {shard_database(target)} '
+                   f'({copied} filas, {time.perf_counter() - started:.1f} s)')
+
+# Arranque explícito: importar main no toca la base de datos ni lanza hilos
+def init_app(config=None):
+    """Inicializa la aplicación del módulo y la devuelve: gunicorn 'main:init_app()'
+
+    No es una factoría: app es única por proceso y esto solo aplica la configuración,
+    crea el directorio de subidas y el esquema de la base de datos. El esquema se crea
+    una vez por proceso bajo _schema_lock (ensure_schema), así que llamarlo de nuevo o
+    desde varios hilos es seguro. Los servicios en segundo plano no se arrancan aquí:
+    el worker se lanza aparte con flask --app main run-worker.
+    """
+    if config:
+        app.config.update(config)
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    ensure_schema(app.config['DATABASE'])
+    return app
+
+@app.before_request
+def ensure_app_initialized():
+    """Red de seguridad para flask --app main run: inicializa en la primera petición"""
+    if app.config['DATABASE'] not in _initialized_databases:
+        init_app()
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Crea o actualiza el esquema de la base de datos"""
+    init_app()
+    click.echo('Base de datos inicializada')
+
+@app.cli.command('import-time')
+def import_time_command():
+    """Mide el coste de importar main con -X importtime y lo compara con el presupuesto"""
+    import subprocess
+    import sys
+    
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import main'],
+        cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True
+    )
+    imports = []
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, cumulative, name = line[len('import time:'):].split('|')
+            if cumulative.strip().isdigit():
+                imports.append((int(cumulative), name.rstrip()))
+    main_time = next((cumulative for cumulative, name in imports if name.strip() == 'main'), None)
+    if result.returncode != 0 or main_time is None:
+        raise click.ClickException(result.stderr[-2000:] or 'No se pudo medir la importación')
+    
+    # Importaciones directas de main (un nivel de sangría), de más a menos costosa
+    direct = [(cumulative, name.strip()) for cumulative, name in imports
+              if name.startswith('   ') and not name.startswith('    ')]
+    for cumulative, name in sorted(direct, reverse=True)[:10]:
+        click.echo(f'{cumulative / 1000:9.1f} ms  {name}')
+    budget = app.config['IMPORT_TIME_BUDGET_MS']
+    click.echo(f'import main: {main_time / 1000:.1f} ms (presupuesto {budget} ms)')
+    if main_time / 1000 > budget:
+        raise click.ClickException('Se ha superado el presupuesto de importación')
 
 # Utilidades de autenticación
 def hash_password(password):
@@ -299,9 +1621,13 @@ def generate_jwt_token(user_id):
         'user_id': user_id,
         'exp': datetime.utcnow() + timedelta(hours=24)
     }
+    import jwt
+    
     return jwt.encode(payload, app.secret_key, algorithm='HS256')
 
 def verify_jwt_token(token):
+    import jwt
+    
     try:
         payload = jwt.decode(token, app.secret_key, algorithms=['HS256'])
         return payload['user_id']
@@ -318,121 +1644,983 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
-# Funciones de utilidad para base de datos
-def get_db_connection():
-    conn = sqlite3.connect('gestortaxi.db')
-    conn.row_factory = sqlite3.Row
-    return conn
+def conditional_get(*tables, daily=False):
+    """ETag a partir de data_versions; si nada ha cambiado responde 304 sin consultar
 
-def execute_query(query, params=None, fetch=False):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    if params:
-        cursor.execute(query, params)
-    else:
-        cursor.execute(query)
-    
-    if fetch:
-        result = cursor.fetchall()
-        conn.close()
-        return result
-    else:
-        conn.commit()
-        conn.close()
-        return cursor.lastrowid
+    Va después de login_required. No se envía Last-Modified: updated_at tiene resolución de
+    segundos y dos escrituras en el mismo segundo darían un 304 falso; la versión no. daily=True añade la fecha de hoy a la ETag para las
+    respuestas que dependen del mes en curso (analítica).
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if request.method != 'GET':
+                return f(*args, **kwargs)
+            
+            from werkzeug.http import is_resource_modified
+            
+            user_id = session['user_id']
+            versions = get_data_versions(user_id, tables)
+            state = [user_id, request.full_path, sorted(versions.items())]
+            if daily:
+                state.append(date.today().isoformat())
+            etag = hashlib.sha256(json.dumps(state).encode()).hexdigest()[:32]
+            
+            if not is_resource_modified(request.environ, etag=etag):
+                response = app.response_class(status=304)
+            else:
+                response = app.make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            # Cada petición revalida con el servidor; la respuesta es privada de cada usuario
+            response.headers['Cache-Control'] = 'private, no-cache'
+            response.vary.add('Cookie')
+            return response
+        return decorated_function
+    return decorator
 
-# Funciones de análisis y métricas
-def calculate_monthly_metrics(user_id):
-    current_month = datetime.now().strftime('%Y-%m')
+def iter_query(query, params=None, chunk_size=1000):
+    """Recorre el resultado por bloques con fetchmany, sin cargarlo entero en memoria"""
+    with _scoped_connection() as conn:
+        cursor = conn.execute(query, params or ())
+        try:
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            cursor.close()
+
+# Serialización JSON incremental desde el cursor
+STREAM_CHUNK_SIZE = 500  # filas por bloque enviado
+_json_row_encoder = None
+
+def json_row_encoder():
+    """Codificador fila -> bytes: orjson si está instalado (JSON_FAST_ENCODER), si no json"""
+    global _json_row_encoder
+    if _json_row_encoder is None:
+        encoder = None
+        if app.config['JSON_FAST_ENCODER']:
+            try:
+                import orjson
+                encoder = lambda obj: orjson.dumps(obj, default=str)
+            except ImportError:
+                pass
+        if encoder is None:
+            encoder = lambda obj: json.dumps(obj, default=str, ensure_ascii=False,
+                                             separators=(',', ':')).encode()
+        _json_row_encoder = encoder
+    return _json_row_encoder
+
+def iter_json_array_chunks(rows, chunk_size=STREAM_CHUNK_SIZE):
+    """Array JSON por bloques; en memoria solo hay un bloque de filas a la vez"""
+    encode = json_row_encoder()
+    yield b'['
+    separator = b''
+    pending = []
+    for row in rows:
+        pending.append(encode(dict(row)))
+        if len(pending) >= chunk_size:
+            yield separator + b','.join(pending)
+            separator = b','
+            pending = []
+    if pending:
+        yield separator + b','.join(pending)
+    yield b']'
+
+def iter_ndjson_chunks(rows, chunk_size=STREAM_CHUNK_SIZE):
+    encode = json_row_encoder()
+    lines = []
+    for row in rows:
+        lines.append(encode(dict(row)))
+        if len(lines) >= chunk_size:
+            yield b'\n'.join(lines) + b'\n'
+            lines = []
+    if lines:
+        yield b'\n'.join(lines) + b'\n'
+
+def wants_ndjson():
+    return (request.args.get('format') == 'ndjson'
+            or request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson')
+
+def stream_rows(query, params=None):
+    """Respuesta JSON (o NDJSON si se pide) que se codifica mientras se lee el cursor
+
+    La consulta se ejecuta al enviar el primer bloque, con la conexión de la petición.
+    """
+    rows = iter_query(query, params, chunk_size=STREAM_CHUNK_SIZE)
+    if wants_ndjson():
+        return Response(stream_with_context(iter_ndjson_chunks(rows)), mimetype='application/x-ndjson')
+    return Response(stream_with_context(iter_json_array_chunks(rows)), mimetype='application/json')
+
+# Listados paginados (keyset)
+API_DEFAULT_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 500
+_table_columns = {}
+
+def table_columns(table):
+    columns = _table_columns.get(table)
+    if columns is None:
+        columns = [row['name'] for row in execute_query(f'PRAGMA table_info({table})', fetch=True)]
+        _table_columns[table] = columns
+    return columns
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values, default=str).encode()).decode().rstrip('=')
+
+def decode_cursor(token):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except (binascii.Error, ValueError):
+        raise ValueError('Cursor no válido')
+    if not isinstance(values, list) or len(values) != 2:
+        raise ValueError('Cursor no válido')
+    return values
+
+def _keyset_condition(key, id_column, descending, cursor_key, cursor_id):
+    # Los NULL van al final en orden descendente y al principio en ascendente
+    op = '<' if descending else '>'
+    if cursor_key is None:
+        condition = f'({key} IS NULL AND {id_column} {op} ?)'
+        if not descending:
+            condition = f'({condition} OR {key} IS NOT NULL)'
+        return condition, [cursor_id]
+    condition = f'({key} {op} ? OR ({key} = ? AND {id_column} {op} ?))'
+    if descending:
+        condition = f'({condition} OR {key} IS NULL)'
+    return condition, [cursor_key, cursor_key, cursor_id]
+
+def list_records(table, alias, from_sql, where_sql, params, extra_fields, order_key, descending=True):
+    """Respuesta de listado con paginación keyset (limit/cursor), proyección (fields) y total (count)
+
+    Sin limit, cursor ni count se mantiene la respuesta clásica: la lista completa.
+    """
+    args = request.args
+    columns = {column: f'{alias}.{column}' for column in table_columns(table)}
+    columns.update(extra_fields)
+    key = f'{alias}.{order_key}'
+    id_column = f'{alias}.id'
+    direction = 'DESC' if descending else 'ASC'
     
-    # Ingresos del mes
-    income_query = '''
-        SELECT SUM(amount) as total_income FROM income 
-        WHERE user_id = ? AND strftime('%Y-%m', date) = ?
-    '''
-    income_result = execute_query(income_query, (user_id, current_month), fetch=True)
-    total_income = income_result[0][0] if income_result[0][0] else 0
+    try:
+        if args.get('fields'):
+            requested = [field.strip() for field in args['fields'].split(',') if field.strip()]
+            unknown = [field for field in requested if field not in columns]
+            if unknown:
+                raise ValueError(f"Campos no válidos: {', '.join(unknown)}")
+            select = ', '.join(f'{columns[field]} as {field}' for field in requested)
+        else:
+            select = ', '.join([f'{alias}.*'] + [f'{expr} as {name}' for name, expr in extra_fields.items()])
+        
+        paginate = 'limit' in args or 'cursor' in args
+        with_total = args.get('count', '').lower() in ('1', 'true', 'yes')
+        limit = min(max(int(args.get('limit', API_DEFAULT_PAGE_SIZE)), 1), API_MAX_PAGE_SIZE)
+        cursor = decode_cursor(args['cursor']) if args.get('cursor') else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
-    # Gastos del mes
-    expense_query = '''
-        SELECT SUM(amount) as total_expenses FROM expenses 
-        WHERE user_id = ? AND strftime('%Y-%m', date) = ?
-    '''
-    expense_result = execute_query(expense_query, (user_id, current_month), fetch=True)
-    total_expenses = expense_result[0][0] if expense_result[0][0] else 0
+    if not paginate and not with_total:
+        return stream_rows(f'''
+            SELECT {select} FROM {from_sql} WHERE {where_sql}
+            ORDER BY {key} {direction}, {id_column} {direction}
+        ''', params)
     
-    # Beneficio neto
-    net_profit = total_income - total_expenses
+    page_where = where_sql
+    page_params = list(params)
+    if cursor:
+        condition, condition_params = _keyset_condition(key, id_column, descending, *cursor)
+        page_where += f' AND {condition}'
+        page_params += condition_params
     
-    # Guardar métricas
-    today = datetime.now().date()
-    metrics = [
-        (str(uuid.uuid4()), user_id, None, today, 'monthly_income', total_income, None),
-        (str(uuid.uuid4()), user_id, None, today, 'monthly_expenses', total_expenses, None),
-        (str(uuid.uuid4()), user_id, None, today, 'monthly_profit', net_profit, None)
-    ]
+    records = execute_query(f'''
+        SELECT {select}, {key} as _cursor_key, {id_column} as _cursor_id
+        FROM {from_sql} WHERE {page_where}
+        ORDER BY {key} {direction}, {id_column} {direction}
+        LIMIT ?
+    ''', page_params + [limit + 1], fetch=True)
     
-    for metric in metrics:
-        execute_query('''
-            INSERT OR REPLACE INTO analytics 
-            (id, user_id, company_id, date, metric_type, metric_value, additional_data)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', metric)
+    items = []
+    for record in records[:limit]:
+        item = dict(record)
+        item.pop('_cursor_key')
+        item.pop('_cursor_id')
+        items.append(item)
+    next_cursor = None
+    if len(records) > limit:
+        last = records[limit - 1]
+        next_cursor = encode_cursor([last['_cursor_key'], last['_cursor_id']])
+    
+    result = {'items': items, 'next': next_cursor}
+    if with_total:
+        result['total'] = execute_query(
+            f'SELECT COUNT(*) FROM {table} {alias} WHERE {where_sql}', params, fetch=True
+        )[0][0]
+    return jsonify(result)
+
+# Configuraciones de usuario con caché LRU/TTL
+_settings_cache = OrderedDict()
+_settings_cache_lock = threading.Lock()
+
+def get_user_settings(user_id):
+    """Configuración del usuario por categorías; el dict devuelto es compartido, no modificar"""
+    now = time.monotonic()
+    with _settings_cache_lock:
+        entry = _settings_cache.get(user_id)
+        if entry and entry[0] > now:
+            _settings_cache.move_to_end(user_id)
+            return entry[1]
+    
+    organized_settings = {}
+    for setting in execute_query('''
+        SELECT category, key, value FROM settings WHERE user_id = ?
+    ''', (user_id,), fetch=True):
+        organized_settings.setdefault(setting['category'], {})[setting['key']] = setting['value']
+    
+    with _settings_cache_lock:
+        _settings_cache[user_id] = (now + app.config['SETTINGS_CACHE_TTL'], organized_settings)
+        _settings_cache.move_to_end(user_id)
+        while len(_settings_cache) > app.config['SETTINGS_CACHE_SIZE']:
+            _settings_cache.popitem(last=False)
+    return organized_settings
+
+def get_setting(user_id, category, key, default=None):
+    return get_user_settings(user_id).get(category, {}).get(key, default)
+
+def invalidate_user_settings(user_id):
+    with _settings_cache_lock:
+        _settings_cache.pop(user_id, None)
+
+# Utilidades de fechas
+def shift_month(month, months):
+    """Desplaza un mes 'YYYY-MM' un número de meses naturales"""
+    year, month_number = map(int, month.split('-'))
+    index = year * 12 + (month_number - 1) + months
+    return f"{index // 12:04d}-{index % 12 + 1:02d}"
+
+def month_range(month):
+    """Rango semiabierto [inicio, fin) de un mes 'YYYY-MM', apto para usar índices"""
+    return f"{month}-01", f"{shift_month(month, 1)}-01"
+
+TIME_SERIES_GRANULARITIES = ('day', 'week', 'month', 'quarter')
+TIME_SERIES_MAX_PERIODS = 400
+
+def period_start(day, granularity):
+    """Primer día del periodo (día, semana ISO, mes o trimestre) que contiene day"""
+    if granularity == 'day':
+        return day
+    if granularity == 'week':
+        return day - timedelta(days=day.weekday())
+    if granularity == 'month':
+        return day.replace(day=1)
+    return date(day.year, 3 * ((day.month - 1) // 3) + 1, 1)
+
+def shift_period(start, granularity, periods):
+    """Desplaza el inicio de un periodo un número de periodos naturales"""
+    if granularity == 'day':
+        return start + timedelta(days=periods)
+    if granularity == 'week':
+        return start + timedelta(weeks=periods)
+    months = periods * (3 if granularity == 'quarter' else 1)
+    return date.fromisoformat(shift_month(start.strftime('%Y-%m'), months) + '-01')
+
+def period_key(start, granularity):
+    if granularity in ('day', 'week'):
+        return start.isoformat()
+    if granularity == 'month':
+        return start.strftime('%Y-%m')
+    return f"{start.year}-Q{(start.month - 1) // 3 + 1}"
+
+def get_time_series(user_id, periods=6, granularity='month', end_date=None):
+    """Ingresos, gastos y beneficio de los últimos N periodos naturales en una sola consulta"""
+    if granularity not in TIME_SERIES_GRANULARITIES:
+        raise ValueError(f'Granularidad no válida: {granularity}')
+    periods = max(1, min(int(periods), TIME_SERIES_MAX_PERIODS))
+    last_start = period_start(end_date or datetime.now().date(), granularity)
+    first_start = shift_period(last_start, granularity, -(periods - 1))
+    range_end = shift_period(last_start, granularity, 1)
+    
+    if granularity in ('month', 'quarter'):
+        # Meses y trimestres salen del resumen mensual
+        bucket = ("month" if granularity == 'month' else
+                  "substr(month, 1, 4) || '-Q' || ((CAST(substr(month, 6, 2) AS INTEGER) + 2) / 3)")
+        rows = execute_query(f'''
+            SELECT {bucket} as period,
+                   SUM(income_total) as income, SUM(expenses_total) as expenses
+            FROM monthly_rollups
+            WHERE user_id = ? AND month >= ? AND month < ?
+            GROUP BY period
+        ''', (user_id, first_start.strftime('%Y-%m'), range_end.strftime('%Y-%m')), fetch=True)
+    else:
+        # Días y semanas se agregan sobre los libros con rango semiabierto
+        bucket = "substr(date, 1, 10)" if granularity == 'day' else "date(date, '-6 days', 'weekday 1')"
+        params = (user_id, first_start.isoformat(), range_end.isoformat())
+        rows = execute_query(f'''
+            SELECT period, SUM(income) as income, SUM(expenses) as expenses
+            FROM (
+                SELECT {bucket} as period, amount as income, 0 as expenses
+                FROM income WHERE user_id = ? AND date >= ? AND date < ?
+                UNION ALL
+                SELECT {bucket}, 0, amount
+                FROM expenses WHERE user_id = ? AND date >= ? AND date < ?
+            )
+            GROUP BY period
+        ''', params * 2, fetch=True)
+    
+    totals = {row['period']: row for row in rows}
+    series = []
+    start = first_start
+    for _ in range(periods):
+        key = period_key(start, granularity)
+        row = totals.get(key)
+        income = float(row['income'] or 0) if row else 0.0
+        expenses = float(row['expenses'] or 0) if row else 0.0
+        series.append({
+            'period': key,
+            'start': start.isoformat(),
+            'income': income,
+            'expenses': expenses,
+            'profit': income - expenses
+        })
+        start = shift_period(start, granularity, 1)
+    return series
+
+# Funciones de análisis y métricas
+def calculate_monthly_metrics(user_id, month=None):
+    """Totales del mes leídos del resumen mensual (sin recorrer los libros)"""
+    month = month or datetime.now().strftime('%Y-%m')
+    result = execute_query('''
+        SELECT COALESCE(SUM(income_total), 0) as income,
+               COALESCE(SUM(expenses_total), 0) as expenses,
+               COALESCE(SUM(income_vat), 0) as income_vat,
+               COALESCE(SUM(expenses_vat), 0) as expenses_vat
+        FROM monthly_rollups 
+        WHERE user_id = ? AND month = ?
+    ''', (user_id, month), fetch=True)
+    
+    total_income = result[0]['income']
+    total_expenses = result[0]['expenses']
+    
+    # Beneficio neto
+    net_profit = total_income - total_expenses
     
     return {
         'income': total_income,
         'expenses': total_expenses,
-        'profit': net_profit
+        'profit': net_profit,
+        'income_vat': result[0]['income_vat'],
+        'expenses_vat': result[0]['expenses_vat']
     }
 
+PNL_GROUPINGS = ('vehicle', 'driver')
+
+def compute_pnl(user_id, start_date, end_date, group_by='vehicle', breakdown=None):
+    """Cuenta de resultados por vehículo o conductor en el rango [start_date, end_date)
+
+    Cada libro se agrega por separado antes del JOIN, así que el coste es lineal
+    en el número de apuntes del rango. El conductor es el asignado al vehículo.
+    """
+    if group_by not in PNL_GROUPINGS:
+        raise ValueError(f'Agrupación no válida: {group_by}')
+    ledger_params = (user_id, start_date, end_date)
+    
+    vehicles = execute_query('''
+        WITH inc AS (
+            SELECT vehicle_id, SUM(amount) as income, SUM(vat_amount) as income_vat, COUNT(*) as income_count
+            FROM income
+            WHERE user_id = ? AND date >= ? AND date < ? AND vehicle_id IS NOT NULL
+            GROUP BY vehicle_id
+        ), exp AS (
+            SELECT vehicle_id, SUM(amount) as expenses, SUM(vat_amount) as expenses_vat, COUNT(*) as expenses_count
+            FROM expenses
+            WHERE user_id = ? AND date >= ? AND date < ? AND vehicle_id IS NOT NULL
+            GROUP BY vehicle_id
+        )
+        SELECT v.id as vehicle_id, v.plate, v.brand, v.model, v.driver_id,
+               NULLIF(TRIM(COALESCE(d.name, '') || ' ' || COALESCE(d.surname, '')), '') as driver_name,
+               COALESCE(inc.income, 0) as income,
+               COALESCE(exp.expenses, 0) as expenses,
+               COALESCE(inc.income, 0) - COALESCE(exp.expenses, 0) as profit,
+               COALESCE(inc.income_vat, 0) as income_vat,
+               COALESCE(exp.expenses_vat, 0) as expenses_vat,
+               COALESCE(inc.income_count, 0) as income_count,
+               COALESCE(exp.expenses_count, 0) as expenses_count
+        FROM vehicles v
+        LEFT JOIN inc ON inc.vehicle_id = v.id
+        LEFT JOIN exp ON exp.vehicle_id = v.id
+        LEFT JOIN employees d ON v.driver_id = d.id
+        WHERE v.user_id = ? AND v.status = 'active'
+        ORDER BY profit DESC
+    ''', ledger_params * 2 + (user_id,), fetch=True)
+    items = [dict(vehicle) for vehicle in vehicles]
+    
+    # Apuntes sin vehículo o de vehículos fuera del informe (de baja o borrados), para que
+    # los totales cuadren con los libros
+    unreported = '''NOT EXISTS (SELECT 1 FROM vehicles v
+                               WHERE v.id = vehicle_id AND v.user_id = ? AND v.status = 'active')'''
+    unassigned = execute_query(f'''
+        SELECT (SELECT COALESCE(SUM(amount), 0) FROM income
+                WHERE user_id = ? AND date >= ? AND date < ? AND {unreported}) as income,
+               (SELECT COALESCE(SUM(amount), 0) FROM expenses
+                WHERE user_id = ? AND date >= ? AND date < ? AND {unreported}) as expenses
+    ''', (ledger_params + (user_id,)) * 2, fetch=True)[0]
+    
+    if breakdown == 'category':
+        categories = {}
+        for row in execute_query('''
+            SELECT vehicle_id, COALESCE(category, 'otros') as category, SUM(amount) as total
+            FROM expenses
+            WHERE user_id = ? AND date >= ? AND date < ? AND vehicle_id IS NOT NULL
+            GROUP BY vehicle_id, COALESCE(category, 'otros')
+        ''', ledger_params, fetch=True):
+            categories.setdefault(row['vehicle_id'], {})[row['category']] = row['total']
+        for item in items:
+            item['expenses_by_category'] = categories.get(item['vehicle_id'], {})
+    
+    if group_by == 'driver':
+        drivers = {}
+        for item in items:
+            driver = drivers.setdefault(item['driver_id'], {
+                'driver_id': item['driver_id'],
+                'driver_name': item['driver_name'],
+                'vehicles': [],
+                'income': 0, 'expenses': 0, 'profit': 0,
+                'income_vat': 0, 'expenses_vat': 0,
+                'income_count': 0, 'expenses_count': 0,
+            })
+            driver['vehicles'].append(item['plate'])
+            for field in ('income', 'expenses', 'profit', 'income_vat', 'expenses_vat',
+                          'income_count', 'expenses_count'):
+                driver[field] += item[field]
+            if breakdown == 'category':
+                merged = driver.setdefault('expenses_by_category', {})
+                for category, total in item['expenses_by_category'].items():
+                    merged[category] = merged.get(category, 0) + total
+        items = sorted(drivers.values(), key=lambda driver: driver['profit'], reverse=True)
+    
+    return {
+        'items': items,
+        'unassigned': {
+            'income': unassigned['income'],
+            'expenses': unassigned['expenses'],
+            'profit': unassigned['income'] - unassigned['expenses']
+        }
+    }
+
+# Numeración de facturas
+INVOICE_SERIES = {
+    'F': '{year}-{number:04d}',   # ordinarias (formato histórico)
+    'R': 'R{year}-{number:04d}',  # rectificativas
+    'S': 'S{year}-{number:04d}',  # simplificadas (tickets)
+}
+INVOICE_MAX_RESERVATION = 1000
+INVOICE_MIN_YEAR = 2000
+
+def format_invoice_number(series, year, number):
+    return INVOICE_SERIES[series].format(year=year, number=number)
+
+def _last_invoice_number(conn, user_id, company_id, series, year):
+    # Solo la primera vez que se usa una serie: continúa desde las facturas existentes
+    prefix = format_invoice_number(series, year, 0)[:-4]
+    last_number = 0
+    for row in conn.execute('''
+        SELECT invoice_number FROM invoices
+        WHERE user_id = ? AND COALESCE(company_id, '') = ? AND invoice_number LIKE ?
+    ''', (user_id, company_id, prefix + '%')):
+        suffix = row['invoice_number'][len(prefix):]
+        if suffix.isdigit():
+            last_number = max(last_number, int(suffix))
+    return last_number
+
+def allocate_invoice_numbers(conn, user_id, company_id, series, year, count=1):
+    """Reserva count números consecutivos de la serie; debe llamarse dentro de transaction()
+
+    transaction() abre con BEGIN IMMEDIATE, así que dos peticiones concurrentes
+    nunca leen el mismo last_number.
+    """
+    company_id = company_id or ''
+    row = conn.execute('''
+        UPDATE invoice_sequences
+        SET last_number = last_number + ?, updated_at = CURRENT_TIMESTAMP
+        WHERE user_id = ? AND company_id = ? AND series = ? AND year = ?
+        RETURNING last_number
+    ''', (count, user_id, company_id, series, year)).fetchone()
+    if row is None:
+        last_number = _last_invoice_number(conn, user_id, company_id, series, year) + count
+        conn.execute('''
+            INSERT INTO invoice_sequences (user_id, company_id, series, year, last_number)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (user_id, company_id, series, year, last_number))
+    else:
+        last_number = row['last_number']
+    return [format_invoice_number(series, year, number)
+            for number in range(last_number - count + 1, last_number + 1)]
+
+def claim_invoice_number(conn, user_id, company_id, series, year, invoice_number):
+    """Acepta un número indicado a mano; debe llamarse dentro de transaction()
+
+    Tiene que ser de la serie y el año de la factura. Si va por delante de la secuencia, esta
+    avanza hasta él para que la numeración automática no lo vuelva a generar.
+    """
+    company_id = company_id or ''
+    prefix = format_invoice_number(series, year, 0)[:-4]
+    suffix = invoice_number[len(prefix):] if invoice_number.startswith(prefix) else ''
+    if not suffix.isdigit() or format_invoice_number(series, year, int(suffix)) != invoice_number:
+        raise ValueError(f'El número de factura no corresponde a la serie {series} de {year}')
+    number = int(suffix)
+    row = conn.execute('''
+        UPDATE invoice_sequences
+        SET last_number = MAX(last_number, ?), updated_at = CURRENT_TIMESTAMP
+        WHERE user_id = ? AND company_id = ? AND series = ? AND year = ?
+        RETURNING last_number
+    ''', (number, user_id, company_id, series, year)).fetchone()
+    if row is None:
+        conn.execute('''
+            INSERT INTO invoice_sequences (user_id, company_id, series, year, last_number)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (user_id, company_id, series, year,
+              max(_last_invoice_number(conn, user_id, company_id, series, year), number)))
+    return invoice_number
+
 # Sistema de notificaciones
-def send_email_notification(to_email, subject, message):
-    """Envía notificación por email si está disponible"""
-    if MimeText is None or MimeMultipart is None:
-        print(f"Email notification (fallback): {subject} - {message}")
-        return False
+def queue_email(to_email, subject, body, user_id=None):
+    """Escribe el correo en el outbox usando la conexión (y transacción) en curso"""
+    email_id = str(uuid.uuid4())
+    execute_query('''
+        INSERT INTO email_outbox (id, user_id, to_email, subject, body, next_attempt_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (email_id, user_id, to_email, subject, body, time.time()))
+    return email_id
+
+def send_email_notification(to_email, subject, message, user_id=None):
+    """Encola la notificación; el worker la entrega sin bloquear la petición"""
+    queue_email(to_email, subject, message, user_id)
+    return True
+
+class SMTPConnectionPool:
+    """Conexiones SMTP reutilizables para no repetir el saludo y el login en cada envío
+
+    Sobreviven entre ejecuciones del outbox; las que llevan más de idle_timeout segundos
+    sin usarse se cierran, antes de que lo haga el servidor.
+    """
+
+    def __init__(self, max_size, idle_timeout):
+        self._idle = queue.LifoQueue(maxsize=max_size)
+        self.idle_timeout = idle_timeout
+
+    def _connect(self):
+        import smtplib
+        
+        conn = smtplib.SMTP(app.config['MAIL_SERVER'], app.config['MAIL_PORT'], timeout=30)
+        if app.config['MAIL_USE_TLS']:
+            conn.starttls()
+        if app.config['MAIL_USERNAME']:
+            conn.login(app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
+        return conn
+
+    @staticmethod
+    def _quit(conn):
+        import smtplib
+        
+        try:
+            conn.quit()
+        except (smtplib.SMTPException, OSError):
+            conn.close()
+
+    def _acquire(self):
+        while True:
+            try:
+                conn, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            if time.monotonic() - last_used <= self.idle_timeout:
+                return conn
+            self._quit(conn)
+
+    def send(self, to_email, message):
+        import smtplib
+        
+        conn = self._acquire()
+        try:
+            conn.sendmail(app.config['MAIL_FROM'], [to_email], message)
+        except smtplib.SMTPServerDisconnected:
+            # El servidor cerró la conexión ociosa: una sola reconexión
+            conn.close()
+            conn = self._connect()
+            try:
+                conn.sendmail(app.config['MAIL_FROM'], [to_email], message)
+            except Exception:
+                conn.close()
+                raise
+        except Exception:
+            conn.close()
+            raise
+        try:
+            self._idle.put_nowait((conn, time.monotonic()))
+        except queue.Full:
+            self._quit(conn)
+
+    def close_idle(self, max_idle=None):
+        """Cierra las conexiones ociosas más de max_idle segundos (por defecto idle_timeout)"""
+        max_idle = self.idle_timeout if max_idle is None else max_idle
+        now = time.monotonic()
+        kept = []
+        while True:
+            try:
+                conn, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if now - last_used > max_idle:
+                self._quit(conn)
+            else:
+                kept.append((conn, last_used))
+        # get_nowait devuelve primero la más reciente: se reponen en orden inverso
+        for entry in reversed(kept):
+            try:
+                self._idle.put_nowait(entry)
+            except queue.Full:
+                self._quit(entry[0])
+
+    def close_all(self):
+        self.close_idle(max_idle=-1)
+
+class DomainRateLimiter:
+    """Cubo de tokens por dominio de destino"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def wait(self, domain):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                tokens, updated = self._buckets.get(domain, (self.rate, now))
+                tokens = min(self.rate, tokens + (now - updated) * self.rate)
+                if tokens >= 1:
+                    self._buckets[domain] = (tokens - 1, now)
+                    return
+                self._buckets[domain] = (tokens, now)
+                delay = (1 - tokens) / self.rate
+            time.sleep(delay)
+
+_smtp_pool = None
+_mail_rate_limiter = None
+sent_emails = []  # backend 'memory'
+
+def _mail_transport():
+    global _smtp_pool, _mail_rate_limiter
+    if _mail_rate_limiter is None:
+        _mail_rate_limiter = DomainRateLimiter(app.config['MAIL_RATE_PER_DOMAIN'])
+    if _smtp_pool is None and app.config['MAIL_BACKEND'] == 'smtp':
+        _smtp_pool = SMTPConnectionPool(app.config['MAIL_SEND_WORKERS'], app.config['MAIL_SMTP_IDLE_TIMEOUT'])
+    return _smtp_pool, _mail_rate_limiter
+
+def deliver_email(email):
+    """Entrega un correo del outbox con el backend configurado"""
+    backend = app.config['MAIL_BACKEND']
+    smtp_pool, rate_limiter = _mail_transport()
+    rate_limiter.wait(email['to_email'].rpartition('@')[2].lower())
     
+    if backend == 'memory':
+        sent_emails.append(dict(email))
+    elif backend == 'smtp':
+        from email.mime.text import MIMEText
+        
+        message = MIMEText(email['body'] or '', 'plain', 'utf-8')
+        message['Subject'] = email['subject']
+        message['From'] = app.config['MAIL_FROM']
+        message['To'] = email['to_email']
+        smtp_pool.send(email['to_email'], message.as_string())
+    else:
+        print(f"Email notification ({backend}) to {email['to_email']}: {email['subject']} - {email['body']}")
+
+def _deliver_outbox_email(email):
     try:
-        # Aquí iría la lógica de envío de email real
-        print(f"Email sent to {to_email}: {subject}")
-        return True
+        deliver_email(email)
+        return None
     except Exception as e:
-        print(f"Error sending email: {e}")
-        return False
+        return repr(e)
+
+def deliver_outbox():
+    """Entrega los correos pendientes con un pool de hilos acotado y reintentos con backoff"""
+    summary = {'sent': 0, 'retried': 0, 'failed': 0}
+    with ThreadPoolExecutor(max_workers=app.config['MAIL_SEND_WORKERS']) as pool:
+        while True:
+            now = time.time()
+            # Reclamar un lote de forma atómica; si el worker cae, vuelve a estar disponible
+            batch = execute_query('''
+                UPDATE email_outbox SET status = 'sending', next_attempt_at = ?
+                WHERE id IN (
+                    SELECT id FROM email_outbox
+                    WHERE status IN ('pending', 'sending') AND next_attempt_at <= ?
+                    ORDER BY next_attempt_at
+                    LIMIT ?
+                )
+                RETURNING id, to_email, subject, body, attempts
+            ''', (now + app.config['MAIL_SENDING_TIMEOUT'], now, app.config['MAIL_BATCH_SIZE']), fetch=True)
+            if not batch:
+                break
+            
+            sent, retries = [], []
+            for email, error in zip(batch, pool.map(_deliver_outbox_email, batch)):
+                if error is None:
+                    sent.append((datetime.now().isoformat(' ', 'seconds'), email['id']))
+                    continue
+                attempts = email['attempts'] + 1
+                delay = min(app.config['MAIL_RETRY_BASE'] * 2 ** (attempts - 1), app.config['MAIL_RETRY_MAX'])
+                status = 'failed' if attempts >= app.config['MAIL_MAX_ATTEMPTS'] else 'pending'
+                retries.append((status, attempts, time.time() + delay, error, email['id']))
+                summary['failed' if status == 'failed' else 'retried'] += 1
+            
+            with transaction() as conn:
+                conn.executemany('''
+                    UPDATE email_outbox SET status = 'sent', sent_at = ?, last_error = NULL WHERE id = ?
+                ''', sent)
+                conn.executemany('''
+                    UPDATE email_outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?
+                    WHERE id = ?
+                ''', retries)
+            summary['sent'] += len(sent)
+    
+    if _smtp_pool is not None:
+        _smtp_pool.close_idle()
+    return summary
+
+class DebuggingSMTPHandler(socketserver.StreamRequestHandler):
+    """Servidor SMTP mínimo para desarrollo y pruebas: guarda y muestra lo recibido"""
+
+    def _reply(self, line):
+        self.wfile.write(f'{line}\r\n'.encode())
+
+    def handle(self):
+        self._reply('220 gestortaxi debugging SMTP')
+        mail_from, recipients = None, []
+        for raw in self.rfile:
+            command = raw.decode('utf-8', 'replace').rstrip('\r\n')
+            verb = command[:4].upper()
+            if verb == 'EHLO':
+                self._reply('250-localhost')
+                self._reply('250 8BITMIME')
+            elif verb == 'HELO' or verb == 'NOOP':
+                self._reply('250 OK')
+            elif verb == 'MAIL':
+                mail_from, recipients = command.split(':', 1)[1].strip(), []
+                self._reply('250 OK')
+            elif verb == 'RCPT':
+                recipients.append(command.split(':', 1)[1].strip())
+                self._reply('250 OK')
+            elif verb == 'DATA':
+                self._reply('354 End data with <CR><LF>.<CR><LF>')
+                lines = []
+                for data_line in self.rfile:
+                    data_line = data_line.decode('utf-8', 'replace').rstrip('\r\n')
+                    if data_line == '.':
+                        break
+                    lines.append(data_line[1:] if data_line.startswith('..') else data_line)
+                message = {'from': mail_from, 'to': recipients, 'data': '\n'.join(lines)}
+                self.server.messages.append(message)
+                if self.server.echo:
+                    print(f"---------- MESSAGE FOLLOWS ----------\n{message['data']}\n------------ END MESSAGE ------------")
+                self._reply('250 OK: queued')
+            elif verb == 'RSET':
+                mail_from, recipients = None, []
+                self._reply('250 OK')
+            elif verb == 'QUIT':
+                self._reply('221 Bye')
+                return
+            else:
+                self._reply('502 Command not implemented')
+
+def start_debugging_smtp(host='localhost', port=1025, echo=True):
+    """Arranca el servidor SMTP de depuración en un hilo; server.messages guarda lo recibido"""
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    server = socketserver.ThreadingTCPServer((host, port), DebuggingSMTPHandler)
+    server.daemon_threads = True
+    server.messages = []
+    server.echo = echo
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+@app.cli.command('debug-smtp')
+@click.option('--host', default='localhost')
+@click.option('--port', default=1025, type=int)
+def debug_smtp_command(host, port):
+    """Servidor SMTP local que imprime los correos (MAIL_BACKEND=smtp, puerto 1025)"""
+    server = start_debugging_smtp(host, port)
+    click.echo(f'SMTP de depuración escuchando en {host}:{port}')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+def _reminder_digest(email, reminders):
+    if len(reminders) == 1:
+        subject = f"Recordatorio: {reminders[0]['title']}"
+    else:
+        subject = f"Tienes {len(reminders)} recordatorios pendientes"
+    lines = [
+        f"- {reminder['due_date']} · {reminder['title']}"
+        + (f": {reminder['description']}" if reminder['description'] else '')
+        for reminder in reminders
+    ]
+    return email, subject, '\n'.join(lines)
 
 def check_reminders():
-    today = datetime.now().date()
-    upcoming_reminders = execute_query('''
-        SELECT * FROM reminders 
-        WHERE due_date <= ? AND status = 'pending' AND notification_sent = 0
-    ''', (today,), fetch=True)
+    """Encola los recordatorios vencidos en lotes, con un resumen por usuario
+
+    Recorre los pendientes por (due_date, id) y, por cada lote, escribe los
+    resúmenes en el outbox y marca los recordatorios en la misma transacción.
+    """
+    today = datetime.now().date().isoformat()
+    batch_size = app.config['REMINDER_BATCH_SIZE']
+    last_due_date, last_id = '', ''
+    summary = {'reminders': 0, 'digests': 0}
     
-    for reminder in upcoming_reminders:
-        # Marcar como notificado
-        execute_query('''
-            UPDATE reminders SET notification_sent = 1 WHERE id = ?
-        ''', (reminder['id'],))
+    while True:
+        batch = execute_query('''
+            SELECT r.id, r.user_id, r.title, r.description, r.due_date, u.email
+            FROM reminders r
+            JOIN users u ON u.id = r.user_id
+            WHERE r.status = 'pending' AND r.notification_sent = 0 AND r.due_date <= ?
+            AND (r.due_date, r.id) > (?, ?)
+            ORDER BY r.due_date, r.id
+            LIMIT ?
+        ''', (today, last_due_date, last_id, batch_size), fetch=True)
+        if not batch:
+            break
+        last_due_date, last_id = batch[-1]['due_date'], batch[-1]['id']
         
-        # Enviar notificación
-        send_email_notification(
-            "user@example.com", 
-            f"Recordatorio: {reminder['title']}", 
-            reminder['description']
-        )
+        by_user = {}
+        for reminder in batch:
+            by_user.setdefault(reminder['user_id'], []).append(reminder)
+        
+        with transaction() as conn:
+            for user_id, reminders in by_user.items():
+                # Con los avisos desactivados se dan por tratados sin enviar nada
+                if get_setting(user_id, 'notifications', 'email_enabled', 'true').lower() != 'false':
+                    send_email_notification(*_reminder_digest(reminders[0]['email'], reminders), user_id=user_id)
+                    summary['digests'] += 1
+            conn.executemany('''
+                UPDATE reminders SET notification_sent = 1 WHERE id = ?
+            ''', [(reminder['id'],) for reminder in batch])
+        summary['reminders'] += len(batch)
+    
+    return summary
 
 # Scheduler para tareas automáticas
-def run_scheduler():
+SCHEDULED_JOBS = {}
+
+def scheduled_job(name, daily_at=None, every=None):
+    """Registra una tarea diaria ('HH:MM') o periódica (cada N segundos)"""
+    def decorator(func):
+        SCHEDULED_JOBS[name] = {'func': func, 'daily_at': daily_at, 'every': every}
+        return func
+    return decorator
+
+def next_job_run(job, after):
+    if job['every']:
+        return after + timedelta(seconds=job['every'])
+    hour, minute = map(int, job['daily_at'].split(':'))
+    candidate = after.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if candidate <= after:
+        candidate += timedelta(days=1)
+    return candidate
+
+def sync_scheduled_jobs():
+    now = datetime.now()
+    with transaction() as conn:
+        conn.executemany('''
+            INSERT OR IGNORE INTO scheduled_jobs (name, next_run_at) VALUES (?, ?)
+        ''', [(name, next_job_run(job, now).isoformat(' ', 'seconds')) for name, job in SCHEDULED_JOBS.items()])
+
+def acquire_scheduler_lease(owner):
+    """Elección de líder en SQLite: solo el dueño de un lease vigente ejecuta tareas"""
+    now = time.time()
+    return bool(execute_query('''
+        INSERT INTO worker_leases (name, owner, expires_at) VALUES ('scheduler', ?, ?)
+        ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+        WHERE worker_leases.owner = excluded.owner OR worker_leases.expires_at < ?
+        RETURNING owner
+    ''', (owner, now + app.config['JOB_LEASE_TTL'], now), fetch=True))
+
+def run_due_jobs(owner):
+    """Ejecuta las tareas vencidas; una ejecución perdida se recupera una sola vez"""
+    now = datetime.now()
+    stamp = now.isoformat(' ', 'seconds')
+    due = execute_query('''
+        SELECT name, attempts FROM scheduled_jobs
+        WHERE next_run_at <= ? AND (locked_until IS NULL OR locked_until < ?)
+        ORDER BY next_run_at
+    ''', (stamp, stamp), fetch=True)
+    
+    for row in due:
+        job = SCHEDULED_JOBS.get(row['name'])
+        if job is None:
+            continue
+        lock_until = (now + timedelta(seconds=app.config['JOB_LOCK_TIMEOUT'])).isoformat(' ', 'seconds')
+        claimed = execute_query('''
+            UPDATE scheduled_jobs SET locked_by = ?, locked_until = ?
+            WHERE name = ? AND (locked_until IS NULL OR locked_until < ?)
+            RETURNING name
+        ''', (owner, lock_until, row['name'], stamp), fetch=True)
+        if not claimed:
+            continue
+        
+        started = datetime.now().isoformat(' ', 'seconds')
+        try:
+            job['func']()
+        except Exception as e:
+            attempts = row['attempts'] + 1
+            app.logger.exception('La tarea %s ha fallado (intento %d)', row['name'], attempts)
+            if attempts >= app.config['JOB_MAX_ATTEMPTS']:
+                # Agotados los reintentos, se espera a la siguiente ejecución normal
+                next_run, attempts = next_job_run(job, datetime.now()), 0
+            else:
+                delay = min(app.config['JOB_RETRY_BASE'] * 2 ** (attempts - 1), app.config['JOB_RETRY_MAX'])
+                next_run = datetime.now() + timedelta(seconds=delay)
+            execute_query('''
+                UPDATE scheduled_jobs SET last_run_at = ?, attempts = ?, last_error = ?, next_run_at = ?,
+                                          locked_by = NULL, locked_until = NULL
+                WHERE name = ?
+            ''', (started, attempts, repr(e), next_run.isoformat(' ', 'seconds'), row['name']))
+        else:
+            finished = datetime.now()
+            execute_query('''
+                UPDATE scheduled_jobs SET last_run_at = ?, last_success_at = ?, attempts = 0, last_error = NULL,
+                                          next_run_at = ?, locked_by = NULL, locked_until = NULL
+                WHERE name = ?
+            ''', (started, finished.isoformat(' ', 'seconds'),
+                  next_job_run(job, finished).isoformat(' ', 'seconds'), row['name']))
+
+def run_worker(once=False):
+    """Bucle del worker; se lanza aparte, nunca desde los procesos web"""
+    owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+    sync_scheduled_jobs()
     while True:
-        schedule.run_pending()
-        time.sleep(60)
+        if acquire_scheduler_lease(owner):
+            run_due_jobs(owner)
+        if once:
+            break
+        time.sleep(app.config['JOB_POLL_INTERVAL'])
+
+@app.cli.command('run-worker')
+@click.option('--once', is_flag=True, help='Ejecutar las tareas vencidas una vez y salir')
+def run_worker_command(once):
+    """Lanza el worker de tareas programadas (recordatorios, copias...)"""
+    init_app()
+    run_worker(once=once)
 
 # Programar tareas
-schedule.every().day.at("09:00").do(check_reminders)
-schedule.every().day.at("23:00").do(lambda: print("Backup automático realizado"))
+def backup_job():
+    print("Backup automático realizado")
 
-# Iniciar scheduler en hilo separado
-scheduler_thread = threading.Thread(target=run_scheduler, daemon=True)
-scheduler_thread.start()
+scheduled_job('check_reminders', daily_at='09:00')(across_shards(check_reminders))
+scheduled_job('backup', daily_at='23:00')(backup_job)
+scheduled_job('deliver_outbox', every=10)(across_shards(deliver_outbox))
 
 # RUTAS PRINCIPALES
 @app.route('/')
@@ -456,24 +2644,7 @@ def dashboard():
     ''', (user_id,), fetch=True)
     
     # Datos para gráficos (últimos 6 meses)
-    chart_data = []
-    for i in range(6):
-        month_date = (datetime.now() - timedelta(days=30*i)).strftime('%Y-%m')
-        monthly_data = execute_query('''
-            SELECT 
-                COALESCE(SUM(CASE WHEN metric_type = 'monthly_income' THEN metric_value ELSE 0 END), 0) as income,
-                COALESCE(SUM(CASE WHEN metric_type = 'monthly_expenses' THEN metric_value ELSE 0 END), 0) as expenses
-            FROM analytics 
-            WHERE user_id = ? AND strftime('%Y-%m', date) = ?
-            AND metric_type IN ('monthly_income', 'monthly_expenses')
-        ''', (user_id, month_date), fetch=True)
-        
-        if monthly_data:
-            chart_data.append({
-                'month': month_date,
-                'income': float(monthly_data[0][0]) if monthly_data[0][0] else 0,
-                'expenses': float(monthly_data[0][1]) if monthly_data[0][1] else 0
-            })
+    chart_data = get_time_series(user_id, periods=6, granularity='month')
     
     return render_template('dashboard.html', 
                          metrics=metrics, 
@@ -527,16 +2698,6 @@ def register():
             password_hash = hash_password(password)
             trial_end = datetime.now() + timedelta(days=14) if plan == 'trial' else None
             
-            execute_query('''
-                INSERT INTO users (id, email, password_hash, plan, trial_end)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (user_id, email, password_hash, plan, trial_end))
-            
-            session['user_id'] = user_id
-            session['user_email'] = email
-            session.permanent = True  # Hacer la sesión permanente
-            app.permanent_session_lifetime = timedelta(days=30)  # 30 días
-            
             # Crear configuraciones por defecto
             default_settings = [
                 (str(uuid.uuid4()), user_id, 'notifications', 'email_enabled', 'true'),
@@ -544,11 +2705,22 @@ def register():
                 (str(uuid.uuid4()), user_id, 'business', 'currency', 'EUR'),
             ]
             
-            for setting in default_settings:
-                execute_query('''
-                    INSERT INTO settings (id, user_id, category, key, value)
+            # Usuario y configuraciones en un único commit (con shards, uno en su fichero nuevo)
+            with transaction() as conn:
+                conn.execute('''
+                    INSERT INTO users (id, email, password_hash, plan, trial_end)
                     VALUES (?, ?, ?, ?, ?)
-                ''', setting)
+                ''', (user_id, email, password_hash, plan, trial_end))
+                with shard_scope(place_new_tenant(user_id)), transaction() as tenant_conn:
+                    tenant_conn.executemany('''
+                        INSERT INTO settings (id, user_id, category, key, value)
+                        VALUES (?, ?, ?, ?, ?)
+                    ''', default_settings)
+            
+            session['user_id'] = user_id
+            session['user_email'] = email
+            session.permanent = True  # Hacer la sesión permanente
+            app.permanent_session_lifetime = timedelta(days=30)  # 30 días
             
             return jsonify({'success': True, 'redirect': '/dashboard'})
         else:
@@ -560,6 +2732,7 @@ def register():
 
 @app.route('/api/companies', methods=['GET', 'POST'])
 @login_required
+@conditional_get('companies')
 def companies_api():
     user_id = session['user_id']
     
@@ -578,14 +2751,13 @@ def companies_api():
         
         return jsonify({'success': True, 'company_id': company_id})
     
-    companies = execute_query('''
+    return stream_rows('''
         SELECT * FROM companies WHERE user_id = ? ORDER BY created_at DESC
-    ''', (user_id,), fetch=True)
-    
-    return jsonify([dict(company) for company in companies])
+    ''', (user_id,))
 
 @app.route('/api/employees', methods=['GET', 'POST'])
 @login_required
+@conditional_get('employees', 'companies')
 def employees_api():
     user_id = session['user_id']
     
@@ -606,18 +2778,16 @@ def employees_api():
         
         return jsonify({'success': True, 'employee_id': employee_id})
     
-    employees = execute_query('''
-        SELECT e.*, c.name as company_name 
-        FROM employees e 
-        LEFT JOIN companies c ON e.company_id = c.id 
-        WHERE e.user_id = ? AND e.status = 'active'
-        ORDER BY e.created_at DESC
-    ''', (user_id,), fetch=True)
-    
-    return jsonify([dict(employee) for employee in employees])
+    return list_records(
+        'employees', 'e',
+        'employees e LEFT JOIN companies c ON e.company_id = c.id',
+        "e.user_id = ? AND e.status = 'active'", [user_id],
+        {'company_name': 'c.name'}, 'created_at'
+    )
 
 @app.route('/api/vehicles', methods=['GET', 'POST'])
 @login_required
+@conditional_get('vehicles', 'companies', 'employees')
 def vehicles_api():
     user_id = session['user_id']
     
@@ -640,19 +2810,18 @@ def vehicles_api():
         
         return jsonify({'success': True, 'vehicle_id': vehicle_id})
     
-    vehicles = execute_query('''
-        SELECT v.*, c.name as company_name, e.name as driver_name 
-        FROM vehicles v 
+    return list_records(
+        'vehicles', 'v',
+        '''vehicles v 
         LEFT JOIN companies c ON v.company_id = c.id 
-        LEFT JOIN employees e ON v.driver_id = e.id 
-        WHERE v.user_id = ? AND v.status = 'active'
-        ORDER BY v.created_at DESC
-    ''', (user_id,), fetch=True)
-    
-    return jsonify([dict(vehicle) for vehicle in vehicles])
+        LEFT JOIN employees e ON v.driver_id = e.id''',
+        "v.user_id = ? AND v.status = 'active'", [user_id],
+        {'company_name': 'c.name', 'driver_name': 'e.name'}, 'created_at'
+    )
 
 @app.route('/api/income', methods=['GET', 'POST'])
 @login_required
+@conditional_get('income', 'vehicles', 'companies')
 def income_api():
     user_id = session['user_id']
     
@@ -662,7 +2831,7 @@ def income_api():
         
         # Calcular IVA
         amount = float(data.get('amount', 0))
-        vat_rate = float(data.get('vat_rate', 21))
+        vat_rate = float(data.get('vat_rate', get_setting(user_id, 'fiscal', 'vat_rate', 21)))
         vat_amount = amount * (vat_rate / 100)
         
         execute_query('''
@@ -684,33 +2853,31 @@ def income_api():
     end_date = request.args.get('end_date')
     vehicle_id = request.args.get('vehicle_id')
     
-    query = '''
-        SELECT i.*, v.plate as vehicle_plate, c.name as company_name 
-        FROM income i 
-        LEFT JOIN vehicles v ON i.vehicle_id = v.id 
-        LEFT JOIN companies c ON i.company_id = c.id 
-        WHERE i.user_id = ?
-    '''
+    where = 'i.user_id = ?'
     params = [user_id]
     
     if start_date:
-        query += ' AND i.date >= ?'
+        where += ' AND i.date >= ?'
         params.append(start_date)
     if end_date:
-        query += ' AND i.date <= ?'
+        where += ' AND i.date <= ?'
         params.append(end_date)
     if vehicle_id:
-        query += ' AND i.vehicle_id = ?'
+        where += ' AND i.vehicle_id = ?'
         params.append(vehicle_id)
     
-    query += ' ORDER BY i.date DESC'
-    
-    income_records = execute_query(query, params, fetch=True)
-    
-    return jsonify([dict(record) for record in income_records])
+    return list_records(
+        'income', 'i',
+        '''income i 
+        LEFT JOIN vehicles v ON i.vehicle_id = v.id 
+        LEFT JOIN companies c ON i.company_id = c.id''',
+        where, params,
+        {'vehicle_plate': 'v.plate', 'company_name': 'c.name'}, 'date'
+    )
 
 @app.route('/api/expenses', methods=['GET', 'POST'])
 @login_required
+@conditional_get('expenses', 'vehicles', 'companies')
 def expenses_api():
     user_id = session['user_id']
     
@@ -720,7 +2887,7 @@ def expenses_api():
         
         # Calcular IVA
         amount = float(data.get('amount', 0))
-        vat_rate = float(data.get('vat_rate', 21))
+        vat_rate = float(data.get('vat_rate', get_setting(user_id, 'fiscal', 'vat_rate', 21)))
         vat_amount = amount * (vat_rate / 100)
         
         execute_query('''
@@ -743,36 +2910,34 @@ def expenses_api():
     vehicle_id = request.args.get('vehicle_id')
     category = request.args.get('category')
     
-    query = '''
-        SELECT e.*, v.plate as vehicle_plate, c.name as company_name 
-        FROM expenses e 
-        LEFT JOIN vehicles v ON e.vehicle_id = v.id 
-        LEFT JOIN companies c ON e.company_id = c.id 
-        WHERE e.user_id = ?
-    '''
+    where = 'e.user_id = ?'
     params = [user_id]
     
     if start_date:
-        query += ' AND e.date >= ?'
+        where += ' AND e.date >= ?'
         params.append(start_date)
     if end_date:
-        query += ' AND e.date <= ?'
+        where += ' AND e.date <= ?'
         params.append(end_date)
     if vehicle_id:
-        query += ' AND e.vehicle_id = ?'
+        where += ' AND e.vehicle_id = ?'
         params.append(vehicle_id)
     if category:
-        query += ' AND e.category = ?'
+        where += ' AND e.category = ?'
         params.append(category)
     
-    query += ' ORDER BY e.date DESC'
-    
-    expense_records = execute_query(query, params, fetch=True)
-    
-    return jsonify([dict(record) for record in expense_records])
+    return list_records(
+        'expenses', 'e',
+        '''expenses e 
+        LEFT JOIN vehicles v ON e.vehicle_id = v.id 
+        LEFT JOIN companies c ON e.company_id = c.id''',
+        where, params,
+        {'vehicle_plate': 'v.plate', 'company_name': 'c.name'}, 'date'
+    )
 
 @app.route('/api/invoices', methods=['GET', 'POST'])
 @login_required
+@conditional_get('invoices', 'clients', 'companies')
 def invoices_api():
     user_id = session['user_id']
     
@@ -780,47 +2945,90 @@ def invoices_api():
         data = request.json
         invoice_id = str(uuid.uuid4())
         
-        # Generar número de factura automático
-        last_invoice = execute_query('''
-            SELECT invoice_number FROM invoices 
-            WHERE user_id = ? AND invoice_number LIKE ?
-            ORDER BY created_at DESC LIMIT 1
-        ''', (user_id, f"{datetime.now().year}%"), fetch=True)
+        series = data.get('series', 'F')
+        if series not in INVOICE_SERIES:
+            return jsonify({'success': False, 'message': 'Serie de facturación no válida'}), 400
+        try:
+            year = datetime.strptime(data['date'][:10], '%Y-%m-%d').year if data.get('date') else datetime.now().year
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'message': 'La fecha debe tener el formato YYYY-MM-DD'}), 400
         
-        if last_invoice:
-            last_number = int(last_invoice[0]['invoice_number'].split('-')[-1])
-            invoice_number = f"{datetime.now().year}-{last_number + 1:04d}"
-        else:
-            invoice_number = f"{datetime.now().year}-0001"
-        
-        execute_query('''
-            INSERT INTO invoices (id, user_id, company_id, client_id, invoice_number, 
-                                date, due_date, subtotal, vat_amount, total, status, 
-                                payment_method, notes, invoice_data)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            invoice_id, user_id, data.get('company_id'), data.get('client_id'),
-            invoice_number, data.get('date'), data.get('due_date'),
-            data.get('subtotal'), data.get('vat_amount'), data.get('total'),
-            data.get('status', 'draft'), data.get('payment_method'),
-            data.get('notes'), json.dumps(data.get('items', []))
-        ))
+        try:
+            with transaction() as conn:
+                # Número reservado o indicado a mano (la secuencia avanza hasta él) o el siguiente
+                # de la serie, en la misma transacción
+                if data.get('invoice_number'):
+                    invoice_number = claim_invoice_number(conn, user_id, data.get('company_id'), series, year,
+                                                          str(data['invoice_number']))
+                else:
+                    invoice_number = allocate_invoice_numbers(conn, user_id, data.get('company_id'), series, year)[0]
+                conn.execute('''
+                    INSERT INTO invoices (id, user_id, company_id, client_id, invoice_number, 
+                                        date, due_date, subtotal, vat_amount, total, status, 
+                                        payment_method, notes, invoice_data)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (
+                    invoice_id, user_id, data.get('company_id'), data.get('client_id'),
+                    invoice_number, data.get('date'), data.get('due_date'),
+                    data.get('subtotal'), data.get('vat_amount'), data.get('total'),
+                    data.get('status', 'draft'), data.get('payment_method'),
+                    data.get('notes'), json.dumps(data.get('items', []))
+                ))
+        except sqlite3.IntegrityError:
+            return jsonify({'success': False, 'message': 'El número de factura ya existe'}), 409
+        except ValueError as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
         
         return jsonify({'success': True, 'invoice_id': invoice_id, 'invoice_number': invoice_number})
     
-    invoices = execute_query('''
-        SELECT i.*, c.name as client_name, comp.name as company_name 
-        FROM invoices i 
+    return list_records(
+        'invoices', 'i',
+        '''invoices i 
         LEFT JOIN clients c ON i.client_id = c.id 
-        LEFT JOIN companies comp ON i.company_id = comp.id 
-        WHERE i.user_id = ? 
-        ORDER BY i.created_at DESC
+        LEFT JOIN companies comp ON i.company_id = comp.id''',
+        'i.user_id = ?', [user_id],
+        {'client_name': 'c.name', 'company_name': 'comp.name'}, 'created_at'
+    )
+
+@app.route('/api/invoices/sequences', methods=['GET', 'POST'])
+@login_required
+@conditional_get('invoice_sequences')
+def invoice_sequences_api():
+    user_id = session['user_id']
+    
+    if request.method == 'POST':
+        # Reserva de un bloque de números para facturación masiva
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({'error': 'Se esperaba un objeto JSON'}), 400
+        series = data.get('series', 'F')
+        try:
+            count = int(data.get('count', 1))
+            year = int(data.get('year', datetime.now().year))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'count y year deben ser números enteros'}), 400
+        if series not in INVOICE_SERIES:
+            return jsonify({'success': False, 'message': 'Serie de facturación no válida'}), 400
+        if not 1 <= count <= INVOICE_MAX_RESERVATION:
+            return jsonify({'success': False, 'message': f'Se pueden reservar entre 1 y {INVOICE_MAX_RESERVATION} números'}), 400
+        if not INVOICE_MIN_YEAR <= year <= datetime.now().year + 1:
+            return jsonify({'error': f'Año de facturación no válido: {year}'}), 400
+        
+        with transaction() as conn:
+            numbers = allocate_invoice_numbers(conn, user_id, data.get('company_id'), series, year, count)
+        return jsonify({'success': True, 'series': series, 'numbers': numbers})
+    
+    sequences = execute_query('''
+        SELECT company_id, series, year, last_number, updated_at
+        FROM invoice_sequences WHERE user_id = ?
+        ORDER BY year DESC, series
     ''', (user_id,), fetch=True)
     
-    return jsonify([dict(invoice) for invoice in invoices])
+    return jsonify([dict(sequence) for sequence in sequences])
 
 @app.route('/api/analytics/dashboard')
 @login_required
+@conditional_get('income', 'expenses', 'vehicles', 'employees', daily=True)
 def analytics_dashboard():
     user_id = session['user_id']
     
@@ -828,15 +3036,9 @@ def analytics_dashboard():
     current_metrics = calculate_monthly_metrics(user_id)
     
     # Comparación con mes anterior
-    previous_month = (datetime.now() - timedelta(days=30)).strftime('%Y-%m')
-    previous_metrics = execute_query('''
-        SELECT metric_type, metric_value 
-        FROM analytics 
-        WHERE user_id = ? AND strftime('%Y-%m', date) = ?
-        AND metric_type IN ('monthly_income', 'monthly_expenses', 'monthly_profit')
-    ''', (user_id, previous_month), fetch=True)
-    
-    previous_data = {metric['metric_type']: metric['metric_value'] for metric in previous_metrics}
+    current_month = datetime.now().strftime('%Y-%m')
+    month_start, month_end = month_range(current_month)
+    previous_metrics = calculate_monthly_metrics(user_id, shift_month(current_month, -1))
     
     # Calcular porcentajes de cambio
     def calculate_change(current, previous):
@@ -845,92 +3047,965 @@ def analytics_dashboard():
         return ((current - previous) / previous) * 100
     
     changes = {
-        'income_change': calculate_change(current_metrics['income'], previous_data.get('monthly_income', 0)),
-        'expenses_change': calculate_change(current_metrics['expenses'], previous_data.get('monthly_expenses', 0)),
-        'profit_change': calculate_change(current_metrics['profit'], previous_data.get('monthly_profit', 0))
+        'income_change': calculate_change(current_metrics['income'], previous_metrics['income']),
+        'expenses_change': calculate_change(current_metrics['expenses'], previous_metrics['expenses']),
+        'profit_change': calculate_change(current_metrics['profit'], previous_metrics['profit'])
     }
     
     # Top categorías de gastos
     top_expenses = execute_query('''
         SELECT category, SUM(amount) as total 
         FROM expenses 
-        WHERE user_id = ? AND strftime('%Y-%m', date) = ?
+        WHERE user_id = ? AND date >= ? AND date < ?
         GROUP BY category 
         ORDER BY total DESC 
         LIMIT 5
-    ''', (user_id, datetime.now().strftime('%Y-%m')), fetch=True)
+    ''', (user_id, month_start, month_end), fetch=True)
     
     # Vehículos más rentables
-    vehicle_profitability = execute_query('''
-        SELECT v.plate, v.brand, v.model,
-               COALESCE(SUM(i.amount), 0) as income,
-               COALESCE(SUM(e.amount), 0) as expenses,
-               COALESCE(SUM(i.amount), 0) - COALESCE(SUM(e.amount), 0) as profit
-        FROM vehicles v
-        LEFT JOIN income i ON v.id = i.vehicle_id AND strftime('%Y-%m', i.date) = ?
-        LEFT JOIN expenses e ON v.id = e.vehicle_id AND strftime('%Y-%m', e.date) = ?
-        WHERE v.user_id = ? AND v.status = 'active'
-        GROUP BY v.id
-        ORDER BY profit DESC
-    ''', (datetime.now().strftime('%Y-%m'), datetime.now().strftime('%Y-%m'), user_id), fetch=True)
+    vehicle_profitability = compute_pnl(user_id, month_start, month_end)['items']
     
     return jsonify({
         'current_metrics': current_metrics,
         'changes': changes,
         'top_expenses': [dict(expense) for expense in top_expenses],
-        'vehicle_profitability': [dict(vehicle) for vehicle in vehicle_profitability]
+        'vehicle_profitability': vehicle_profitability
     })
 
-@app.route('/api/reports/export/<report_type>')
+@app.route('/api/analytics/pnl')
 @login_required
-def export_report(report_type):
+@conditional_get('income', 'expenses', 'vehicles', 'employees', 'companies', daily=True)
+def analytics_pnl():
+    user_id = session['user_id']
+    
+    # Por defecto el mes en curso; end_date es inclusiva como en /api/income
+    try:
+        month_start, month_end = month_range(datetime.now().strftime('%Y-%m'))
+        start_date = date.fromisoformat(request.args.get('start_date', month_start))
+        if request.args.get('end_date'):
+            end_date = date.fromisoformat(request.args['end_date']) + timedelta(days=1)
+        else:
+            end_date = date.fromisoformat(month_end)
+        result = compute_pnl(
+            user_id, start_date.isoformat(), end_date.isoformat(),
+            group_by=request.args.get('group_by', 'vehicle'),
+            breakdown=request.args.get('breakdown')
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    result['start_date'] = start_date.isoformat()
+    result['end_date'] = (end_date - timedelta(days=1)).isoformat()
+    return jsonify(result)
+
+@app.route('/api/analytics/timeseries')
+@login_required
+@conditional_get('income', 'expenses', daily=True)
+def analytics_timeseries():
+    user_id = session['user_id']
+    granularity = request.args.get('granularity', 'month')
+    
+    try:
+        periods = int(request.args.get('periods', 6))
+        end_date = request.args.get('end_date')
+        end_date = date.fromisoformat(end_date) if end_date else None
+        series = get_time_series(user_id, periods, granularity, end_date)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    return jsonify({'granularity': granularity, 'series': series})
+
+# Modelos trimestrales (303, 130, 111). Cada resultado se guarda en fiscal_documents con el
+# sello de los datos usados (versiones por mes de los libros y de las tablas de las que
+# depende); mientras el sello no cambie se devuelve tal cual, sin volver a agregar.
+FISCAL_MODELS = ('303', '130', '111')
+FISCAL_ENGINE_VERSION = 3
+FISCAL_DUE_DATES = {1: (0, 4, 20), 2: (0, 7, 20), 3: (0, 10, 20), 4: (1, 1, 30)}
+DEDUCTIBLE_SQL = "COALESCE(deductible, 1) NOT IN (0, '0', 'false', 'False')"
+VAT_BOXES = {4.0: ('01', '02', '03'), 10.0: ('04', '05', '06'), 21.0: ('07', '08', '09')}
+
+def quarter_months(year, quarter, year_to_date=False):
+    """Meses 'YYYY-MM' del trimestre (o desde enero si year_to_date)"""
+    first = 1 if year_to_date else 3 * (quarter - 1) + 1
+    return [f"{year:04d}-{month:02d}" for month in range(first, 3 * quarter + 1)]
+
+def last_closed_quarter(today=None):
+    today = today or date.today()
+    quarter = (today.month - 1) // 3
+    return (today.year, quarter) if quarter else (today.year - 1, 4)
+
+def fiscal_data_stamp(user_id, model, year, quarter):
+    """Huella de todo lo que interviene en el cálculo del modelo"""
+    state = [FISCAL_ENGINE_VERSION, model]
+    if model in ('303', '130'):
+        months = quarter_months(year, quarter, year_to_date=model == '130')
+        rows = execute_query('''
+            SELECT month, version FROM ledger_month_versions
+            WHERE user_id = ? AND month >= ? AND month <= ?
+            ORDER BY month
+        ''', (user_id, months[0], months[-1]), fetch=True)
+        state.append([[row['month'], row['version']] for row in rows])
+    if model in ('130', '111'):
+        state.append(sorted(get_data_versions(user_id, ('employees', 'settings', 'payslips')).items()))
+    return hashlib.sha256(json.dumps(state).encode()).hexdigest()[:32]
+
+def _ledger_scope(user_id, company_id, months):
+    where = 'user_id = ? AND date >= ? AND date < ?'
+    params = [user_id, month_range(months[0])[0], month_range(months[-1])[1]]
+    if company_id:
+        where += ' AND company_id = ?'
+        params.append(company_id)
+    return where, params
+
+def payroll_totals(user_id, company_id, months):
+    """Perceptores, brutos, retenciones y coste de personal de los meses dados
+
+    Cada empleado y mes con nómina calculada (/api/laboral/nominas) usa sus importes; los que
+    no la tienen se estiman con el salario mensual (retention=None: sin calcular).
+    """
+    company_sql = ' AND company_id = ?' if company_id else ''
+    scope = [user_id] + ([company_id] if company_id else [])
+    placeholders = ', '.join('?' * len(months))
+    payslips = execute_query(f'''
+        SELECT employee_id, period, gross, irpf, total_cost FROM payslips
+        WHERE user_id = ?{company_sql} AND period IN ({placeholders})
+    ''', scope + list(months), fetch=True)
+    recipients = {row['employee_id'] for row in payslips}
+    totals = {
+        'gross': sum(float(row['gross']) for row in payslips),
+        'retention': sum(float(row['irpf']) for row in payslips),
+        'cost': sum(float(row['total_cost']) for row in payslips),
+    }
+    values = ', '.join('(?, ?, ?)' for _ in months)
+    rows = execute_query(f'''
+        WITH months (period, start, finish) AS (VALUES {values})
+        SELECT e.id, m.period, e.salary as gross
+        FROM employees e
+        JOIN months m ON (e.start_date IS NULL OR e.start_date < m.finish)
+                     AND (e.end_date IS NULL OR e.end_date >= m.start)
+        WHERE e.user_id = ?{company_sql.replace('company_id', 'e.company_id')}
+          AND (e.end_date IS NOT NULL OR COALESCE(e.status, 'active') = 'active')
+          AND NOT EXISTS (SELECT 1 FROM payslips p WHERE p.employee_id = e.id AND p.period = m.period)
+    ''', [bound for month in months for bound in (month, *month_range(month))] + scope, fetch=True)
+    recipients.update(row['id'] for row in rows)
+    estimated_months = sorted({row['period'] for row in rows})
+    totals['estimated_gross'] = sum(float(row['gross'] or 0) for row in rows)
+    totals['gross'] += totals['estimated_gross']
+    totals['cost'] += totals['estimated_gross']
+    totals['recipients'] = len(recipients)
+    totals['estimated_months'] = estimated_months
+    return totals
+
+def compute_modelo_303(user_id, company_id, year, quarter):
+    """Autoliquidación de IVA: devengado por tipo y deducible de los gastos deducibles"""
+    where, params = _ledger_scope(user_id, company_id, quarter_months(year, quarter))
+    output_rows = execute_query(f'''
+        SELECT CAST(COALESCE(vat_rate, 0) AS REAL) as rate,
+               COALESCE(SUM(amount), 0) as base, COALESCE(SUM(vat_amount), 0) as quota
+        FROM income WHERE {where}
+        GROUP BY rate ORDER BY rate
+    ''', params, fetch=True)
+    input_row = execute_query(f'''
+        SELECT COALESCE(SUM(amount), 0) as base, COALESCE(SUM(vat_amount), 0) as quota
+        FROM expenses WHERE {where} AND {DEDUCTIBLE_SQL}
+    ''', params, fetch=True)[0]
+    
+    boxes = {box: 0.0 for boxes_for_rate in VAT_BOXES.values() for box in boxes_for_rate}
+    other_rates = []
+    output_vat = 0.0
+    for row in output_rows:
+        base, quota = round(float(row['base']), 2), round(float(row['quota']), 2)
+        output_vat += quota
+        if row['rate'] in VAT_BOXES:
+            base_box, rate_box, quota_box = VAT_BOXES[row['rate']]
+            boxes.update({base_box: base, rate_box: row['rate'], quota_box: quota})
+        else:
+            other_rates.append({'rate': row['rate'], 'base': base, 'quota': quota})
+    boxes['27'] = round(output_vat, 2)
+    boxes['28'] = round(float(input_row['base']), 2)
+    boxes['29'] = round(float(input_row['quota']), 2)
+    boxes['45'] = boxes['29']
+    boxes['46'] = round(boxes['27'] - boxes['45'], 2)
+    boxes['71'] = boxes['46']
+    return {'boxes': boxes, 'other_rates': other_rates, 'result': boxes['71']}
+
+def compute_modelo_130(user_id, company_id, year, quarter):
+    """Pago fraccionado de IRPF en estimación directa (importes acumulados desde enero)"""
+    months = quarter_months(year, quarter, year_to_date=True)
+    where, params = _ledger_scope(user_id, company_id, months)
+    row = execute_query(f'''
+        SELECT (SELECT COALESCE(SUM(amount), 0) FROM income WHERE {where}) as income,
+               (SELECT COALESCE(SUM(amount), 0) FROM expenses WHERE {where} AND {DEDUCTIBLE_SQL}) as expenses
+    ''', params * 2, fetch=True)[0]
+    payroll = payroll_totals(user_id, company_id, months)['cost']
+    
+    # Pagos de los trimestres anteriores: resultados positivos ya calculados (y cacheados)
+    previous_payments = 0.0
+    if quarter > 1:
+        previous = get_fiscal_model(user_id, '130', year, quarter - 1, company_id)['data']['boxes']
+        previous_payments = previous['05'] + max(previous['07'], 0)
+    
+    boxes = {'01': round(float(row['income']), 2), '02': round(float(row['expenses']) + payroll, 2)}
+    boxes['03'] = round(boxes['01'] - boxes['02'], 2)
+    boxes['04'] = round(max(boxes['03'], 0) * 0.20, 2)
+    boxes['05'] = round(previous_payments, 2)
+    boxes['06'] = 0.0
+    boxes['07'] = round(boxes['04'] - boxes['05'] - boxes['06'], 2)
+    return {'boxes': boxes, 'payroll': round(payroll, 2), 'result': max(boxes['07'], 0.0)}
+
+def compute_modelo_111(user_id, company_id, year, quarter):
+    """Retenciones sobre rendimientos del trabajo de la plantilla activa en el trimestre
+
+    Las nóminas calculadas aportan su retención real; los meses sin nómina se estiman con
+    el tipo de la configuración fiscal/irpf_retention.
+    """
+    payroll = payroll_totals(user_id, company_id, quarter_months(year, quarter))
+    rate = float(get_setting(user_id, 'fiscal', 'irpf_retention', 15))
+    retention = payroll['retention'] + payroll['estimated_gross'] * rate / 100
+    boxes = {'01': payroll['recipients'], '02': round(payroll['gross'], 2), '03': round(retention, 2)}
+    boxes['28'] = boxes['03']
+    return {'boxes': boxes, 'retention_rate': rate, 'estimated_months': payroll['estimated_months'],
+            'result': boxes['28']}
+
+FISCAL_CALCULATORS = {'303': compute_modelo_303, '130': compute_modelo_130, '111': compute_modelo_111}
+
+def fiscal_due_date(year, quarter):
+    year_offset, month, day = FISCAL_DUE_DATES[quarter]
+    return date(year + year_offset, month, day).isoformat()
+
+def serialize_fiscal_document(document, cached):
+    return {
+        'id': document['id'],
+        'model': document['model_number'],
+        'period': document['period'],
+        'year': document['year'],
+        'company_id': document['company_id'],
+        'status': document['status'],
+        'amount': document['amount'],
+        'due_date': document['due_date'],
+        'submission_date': document['submission_date'],
+        'data': json.loads(document['data']) if document['data'] else None,
+        'cached': cached,
+    }
+
+def _find_fiscal_document(user_id, company_id, model, year, period):
+    rows = execute_query('''
+        SELECT * FROM fiscal_documents
+        WHERE user_id = ? AND COALESCE(company_id, '') = ? AND type = 'modelo'
+          AND model_number = ? AND year = ? AND period = ?
+    ''', (user_id, company_id or '', model, year, period), fetch=True)
+    return rows[0] if rows else None
+
+def get_fiscal_model(user_id, model, year, quarter, company_id=None, recalculate=False):
+    """Modelo del trimestre: el guardado si su sello coincide, si no se recalcula
+
+    Los modelos ya presentados no se sobrescriben; si los datos han cambiado se marcan
+    como 'stale' en la respuesta.
+    """
+    if model not in FISCAL_CALCULATORS:
+        raise ValueError(f'Modelo no soportado: {model}')
+    if quarter not in FISCAL_DUE_DATES:
+        raise ValueError('El trimestre debe estar entre 1 y 4')
+    period = f'{quarter}T'
+    stamp = fiscal_data_stamp(user_id, model, year, quarter)
+    document = _find_fiscal_document(user_id, company_id, model, year, period)
+    if document and document['status'] == 'submitted':
+        result = serialize_fiscal_document(document, cached=True)
+        result['stale'] = document['data_version'] != stamp
+        return result
+    if document and document['data_version'] == stamp and not recalculate:
+        return serialize_fiscal_document(document, cached=True)
+    
+    data = FISCAL_CALCULATORS[model](user_id, company_id, year, quarter)
+    data['computed_at'] = datetime.now().isoformat(timespec='seconds')
+    if document:
+        execute_query('''
+            UPDATE fiscal_documents SET amount = ?, data = ?, data_version = ?, status = 'calculated'
+            WHERE id = ? AND status != 'submitted'
+        ''', (data['result'], json.dumps(data), stamp, document['id']))
+    else:
+        try:
+            execute_query('''
+                INSERT INTO fiscal_documents (id, user_id, company_id, type, model_number, period, year,
+                                              status, amount, due_date, data, data_version)
+                VALUES (?, ?, ?, 'modelo', ?, ?, ?, 'calculated', ?, ?, ?, ?)
+            ''', (str(uuid.uuid4()), user_id, company_id, model, period, year,
+                  data['result'], fiscal_due_date(year, quarter), json.dumps(data), stamp))
+        except sqlite3.IntegrityError:
+            pass  # otra petición lo ha calculado a la vez; se devuelve el suyo
+    return serialize_fiscal_document(_find_fiscal_document(user_id, company_id, model, year, period), cached=False)
+
+def parse_quarter(value):
+    """Acepta '3', '3T' o 'Q3'"""
+    value = str(value).strip().upper().removeprefix('Q').removesuffix('T')
+    if value not in ('1', '2', '3', '4'):
+        raise ValueError(f'Trimestre no válido: {value}')
+    return int(value)
+
+@app.route('/api/fiscal/modelos', methods=['GET', 'POST'])
+@login_required
+def fiscal_models_api():
+    user_id = session['user_id']
+    
+    if request.method == 'POST':
+        # Presentación: congela el modelo calculado con los datos actuales
+        data = request.json or {}
+        model = str(data.get('modelo', ''))
+        try:
+            quarter = parse_quarter(data.get('periodo', ''))
+            year = int(data.get('ejercicio') or date.today().year)
+            document = get_fiscal_model(user_id, model, year, quarter, data.get('company_id'))
+        except ValueError as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
+        if document['status'] == 'submitted':
+            return jsonify({'success': False, 'message': 'El modelo ya está presentado'}), 409
+        execute_query('''
+            UPDATE fiscal_documents SET status = 'submitted', submission_date = ? WHERE id = ?
+        ''', (date.today().isoformat(), document['id']))
+        document.update(status='submitted', submission_date=date.today().isoformat())
+        return jsonify({'success': True, 'model': document})
+    
+    try:
+        default_year, default_quarter = last_closed_quarter()
+        year = int(request.args.get('year', default_year))
+        quarter = parse_quarter(request.args.get('quarter', default_quarter))
+        models = request.args.getlist('model') or FISCAL_MODELS
+        recalculate = request.args.get('recalculate') in ('1', 'true')
+        results = [
+            get_fiscal_model(user_id, model, year, quarter, request.args.get('company_id'), recalculate)
+            for model in models
+        ]
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    return jsonify({'year': year, 'quarter': quarter, 'models': results})
+
+# Nóminas. Una ejecución calcula de golpe las nóminas del mes de toda la plantilla activa
+# (o de una empresa) con operaciones sobre arrays de numpy y las guarda con executemany.
+# Las tablas anuales (bases y tipos de cotización, escala de retenciones) se memorizan por año.
+PAYROLL_TABLES = {
+    # año: (base mínima, base máxima, MEI trabajador %, MEI empresa %); bases mensuales en euros
+    2024: (1323.00, 4720.50, 0.12, 0.58),
+    2025: (1381.20, 4909.50, 0.13, 0.67),
+    2026: (1424.50, 5101.20, 0.15, 0.75),
+}
+# Contingencias comunes, desempleo (indefinido) y formación profesional; la empresa paga además FOGASA
+SS_EMPLOYEE_RATE = 4.70 + 1.55 + 0.10
+SS_EMPLOYER_RATE = 23.60 + 5.50 + 0.60 + 0.20
+# Escala general de retenciones (estatal + autonómica) y mínimo personal
+IRPF_BRACKETS = ((0, 12450, 19), (12450, 20200, 24), (20200, 35200, 30),
+                 (35200, 60000, 37), (60000, 300000, 45), (300000, float('inf'), 47))
+IRPF_PERSONAL_MINIMUM = 5550
+IRPF_OTHER_EXPENSES = 2000  # otros gastos deducibles de los rendimientos del trabajo
+IRPF_EXEMPT_THRESHOLD = 15876  # sin retención por debajo (contribuyente sin hijos)
+
+@lru_cache(maxsize=None)
+def payroll_tables(year):
+    """Parámetros de cotización y retención del año (el último conocido si no está en la tabla)"""
+    known = [table_year for table_year in sorted(PAYROLL_TABLES) if table_year <= year]
+    min_base, max_base, mei_employee, mei_employer = PAYROLL_TABLES[known[-1] if known else min(PAYROLL_TABLES)]
+    return {
+        'min_base': min_base,
+        'max_base': max_base,
+        'employee_rate': SS_EMPLOYEE_RATE + mei_employee,
+        'employer_rate': SS_EMPLOYER_RATE + mei_employer,
+        'brackets': IRPF_BRACKETS,
+        'personal_minimum': IRPF_PERSONAL_MINIMUM,
+        'exempt_threshold': IRPF_EXEMPT_THRESHOLD,
+    }
+
+def _work_income_reduction(np, net_income):
+    """Reducción por obtención de rendimientos del trabajo (art. 20 LIRPF)"""
+    return np.select(
+        [net_income <= 14852, net_income <= 17673.52, net_income <= 19747.5],
+        [7302, 7302 - 1.75 * (net_income - 14852), 2364.34 - 1.14 * (net_income - 17673.52)],
+        0
+    )
+
+def irpf_withholding_rates(np, annual_gross, annual_ss, tables):
+    """Tipo de retención (%) de cada empleado según el procedimiento general simplificado"""
+    lower, upper, rates = (np.array(column, dtype=float) for column in zip(*tables['brackets']))
+    
+    def scale(amounts):
+        return (np.clip(amounts[:, None] - lower, 0, upper - lower) * rates / 100).sum(axis=1)
+    
+    net_income = np.maximum(annual_gross - annual_ss - IRPF_OTHER_EXPENSES, 0)
+    taxable = np.maximum(net_income - _work_income_reduction(np, net_income), 0)
+    tax = np.maximum(scale(taxable) - scale(np.full_like(taxable, tables['personal_minimum'])), 0)
+    rates = np.where(annual_gross > 0, np.round(tax / np.maximum(annual_gross, 1) * 100, 2), 0)
+    return np.where(annual_gross <= tables['exempt_threshold'], 0, rates)
+
+def compute_payslips(employees, period, at_ep_rate, adjustments=None):
+    """Nóminas del mes para una lista de empleados (dicts con id, salary, start_date, end_date)
+
+    Todo se calcula sobre arrays: prorrateo por días (mes comercial de 30), bases de
+    cotización acotadas, cuotas, retención de IRPF anualizada, neto y coste de empresa.
+    adjustments permite fijar días, complementos y deducciones de un empleado.
+    """
+    import numpy as np
+    
+    adjustments = adjustments or {}
+    tables = payroll_tables(int(period[:4]))
+    month_start, next_month = (np.datetime64(bound) for bound in month_range(period))
+    month_end = next_month - np.timedelta64(1, 'D')
+    month_days = int((next_month - month_start) / np.timedelta64(1, 'D'))
+    
+    def dates(key, default):
+        return np.array([employee[key][:10] if employee[key] else default for employee in employees],
+                        dtype='datetime64[D]')
+    
+    first = np.maximum(dates('start_date', str(month_start)), month_start)
+    last = np.minimum(dates('end_date', str(month_end)), month_end)
+    worked = ((last - first) / np.timedelta64(1, 'D')).astype(int) + 1
+    days = np.where(worked >= month_days, 30, np.minimum(worked, 30))
+    overrides = [adjustments.get(employee['id'], {}) for employee in employees]
+    days = np.array([override.get('days', day) for override, day in zip(overrides, days)], dtype=int)
+    extras = np.array([override.get('extras', 0) for override in overrides], dtype=float)
+    deductions = np.array([override.get('deductions', 0) for override in overrides], dtype=float)
+    
+    salary = np.array([float(employee['salary'] or 0) for employee in employees])
+    factor = days / 30
+    gross = np.round(salary * factor + extras, 2)
+    ss_base = np.round(np.clip(gross, tables['min_base'] * factor, tables['max_base'] * factor), 2)
+    ss_employee = np.round(ss_base * tables['employee_rate'] / 100, 2)
+    ss_employer = np.round(ss_base * (tables['employer_rate'] + at_ep_rate) / 100, 2)
+    
+    # La retención se calcula sobre la retribución anual del salario pactado
+    annual_gross = salary * 12
+    annual_ss = np.clip(salary, tables['min_base'], tables['max_base']) * tables['employee_rate'] / 100 * 12
+    irpf_rate = irpf_withholding_rates(np, annual_gross, annual_ss, tables)
+    irpf = np.round(gross * irpf_rate / 100, 2)
+    net = np.round(gross - ss_employee - irpf - deductions, 2)
+    total_cost = np.round(gross + ss_employer, 2)
+    
+    columns = zip(days, gross, ss_base, ss_employee, irpf_rate, irpf, deductions, net, ss_employer, total_cost)
+    return [
+        {'employee_id': employee['id'], 'company_id': employee['company_id'], 'period': period,
+         'days': int(d), 'gross': float(g), 'ss_base': float(b), 'ss_employee': float(se),
+         'irpf_rate': float(r), 'irpf': float(i), 'deductions': float(dd), 'net': float(n),
+         'ss_employer': float(sc), 'total_cost': float(t)}
+        for employee, (d, g, b, se, r, i, dd, n, sc, t) in zip(employees, columns)
+    ]
+
+def run_payroll(user_id, period, company_id=None, employee_id=None, adjustments=None):
+    """Calcula y guarda las nóminas del periodo; repetirlo sustituye las anteriores"""
+    if not re.fullmatch(r'\d{4}-(0[1-9]|1[0-2])', period or ''):
+        raise ValueError('El periodo debe tener el formato YYYY-MM')
+    month_start, next_month = month_range(period)
+    where = 'user_id = ?'
+    params = [user_id]
+    for column, value in (('company_id', company_id), ('id', employee_id)):
+        if value:
+            where += f' AND {column} = ?'
+            params.append(value)
+    employees = [dict(row) for row in execute_query(f'''
+        SELECT id, company_id, salary, start_date, end_date FROM employees
+        WHERE {where} AND salary IS NOT NULL
+          AND (start_date IS NULL OR start_date < ?)
+          AND (end_date IS NULL OR end_date >= ?)
+          AND (end_date IS NOT NULL OR COALESCE(status, 'active') = 'active')
+    ''', params + [next_month, month_start], fetch=True)]
+    if employee_id and not employees:
+        raise ValueError('El empleado no está de alta en el periodo')
+    
+    at_ep_rate = float(get_setting(user_id, 'laboral', 'at_ep_rate', 3.5))
+    payslips = compute_payslips(employees, period, at_ep_rate, adjustments) if employees else []
+    run_id = str(uuid.uuid4())
+    with transaction() as conn:
+        # Repetir la ejecución sustituye las nóminas del mismo alcance
+        conn.execute(f'''
+            DELETE FROM payslips
+            WHERE user_id = ? AND period = ? AND employee_id IN (SELECT id FROM employees WHERE {where})
+        ''', [user_id, period] + params)
+        conn.executemany('''
+            INSERT INTO payslips (id, user_id, company_id, employee_id, period, days, gross, ss_base,
+                                  ss_employee, irpf_rate, irpf, deductions, net, ss_employer, total_cost, run_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [(str(uuid.uuid4()), user_id, p['company_id'], p['employee_id'], period, p['days'], p['gross'],
+               p['ss_base'], p['ss_employee'], p['irpf_rate'], p['irpf'], p['deductions'], p['net'],
+               p['ss_employer'], p['total_cost'], run_id) for p in payslips])
+    
+    totals = {key: round(sum(p[key] for p in payslips), 2)
+              for key in ('gross', 'ss_employee', 'irpf', 'net', 'ss_employer', 'total_cost')}
+    return {'run_id': run_id, 'period': period, 'payslips': len(payslips), 'totals': totals}
+
+@app.route('/api/laboral/nominas', methods=['GET', 'POST'])
+@login_required
+@conditional_get('payslips', 'employees')
+def payroll_api():
     user_id = session['user_id']
     
+    if request.method == 'POST':
+        # Admite los nombres del formulario del dashboard (periodo, empleado_id, dias_trabajados...)
+        data = request.get_json(silent=True) or {}
+        period = data.get('period') or data.get('periodo')
+        employee_id = data.get('employee_id') or data.get('empleado_id')
+        try:
+            adjustments = None
+            if employee_id:
+                adjustment = {'extras': float(data.get('complementos') or 0),
+                              'deductions': float(data.get('deducciones') or 0)}
+                if data.get('dias_trabajados'):
+                    adjustment['days'] = min(max(int(data['dias_trabajados']), 0), 30)
+                adjustments = {employee_id: adjustment}
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'message': 'Complementos, deducciones y días deben ser números'}), 400
+        try:
+            result = run_payroll(user_id, period, data.get('company_id'), employee_id, adjustments)
+        except ValueError as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
+        return jsonify({'success': True, **result})
+    
+    where = 'p.user_id = ?'
+    params = [user_id]
+    for arg, condition in (('period', 'p.period = ?'), ('employee_id', 'p.employee_id = ?'),
+                           ('company_id', 'p.company_id = ?')):
+        if request.args.get(arg):
+            where += f' AND {condition}'
+            params.append(request.args[arg])
+    
+    return list_records(
+        'payslips', 'p',
+        'payslips p LEFT JOIN employees e ON p.employee_id = e.id',
+        where, params,
+        {'employee_name': "e.name || ' ' || e.surname"}, 'period'
+    )
+
+# Búsqueda
+SEARCH_MAX_TERMS = 8
+SEARCH_MAX_LIMIT = 100
+_SEARCH_TERMS = re.compile(r'\w+', re.UNICODE)
+
+def build_search_match(user_id, text, entities):
+    """Expresión MATCH: propietario y tipo exactos y cada término como prefijo sobre title/body"""
+    terms = _SEARCH_TERMS.findall(text.lower())[:SEARCH_MAX_TERMS]
+    if not terms:
+        raise ValueError('La búsqueda necesita al menos una palabra')
+    owner = user_id.replace('-', '').replace('"', '""')
+    kinds = ' OR '.join(entities)
+    prefixes = ' '.join(f'"{term}"*' for term in terms)
+    return f'owner: "{owner}" AND kind: ({kinds}) AND {{title body}}: ({prefixes})'
+
+def _highlight(text):
+    # Las marcas de FTS son caracteres de control; se escapa el texto y luego se convierten en <mark>
+    from markupsafe import escape
+    
+    return str(escape((text or '').strip())).replace('\x02', '<mark>').replace('\x03', '</mark>')
+
+@app.route('/api/search')
+@login_required
+@conditional_get(*SEARCH_ENTITIES)
+def search_api():
+    user_id = session['user_id']
+    args = request.args
+    
+    entities = [entity.strip() for entity in args.get('entity', '').split(',') if entity.strip()]
+    entities = entities or list(SEARCH_ENTITIES)
+    unknown = [entity for entity in entities if entity not in SEARCH_ENTITIES]
+    if unknown:
+        return jsonify({'error': f"Tipos no válidos: {', '.join(unknown)}"}), 400
+    try:
+        match = build_search_match(user_id, args.get('q', ''), entities)
+        limit = min(max(int(args.get('limit', 20)), 1), SEARCH_MAX_LIMIT)
+        offset = max(int(args.get('offset', 0)), 0)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    where = 'search_index MATCH ?'
+    params = [match]
+    if args.get('start_date'):
+        where += ' AND doc_date >= ?'
+        params.append(args['start_date'])
+    if args.get('end_date'):
+        where += ' AND substr(doc_date, 1, 10) <= ?'  # clients.created_at lleva hora
+        params.append(args['end_date'])
+    
+    # bm25: el título (proveedor, origen, número, nombre) pesa más que el cuerpo
+    rows = execute_query(f'''
+        SELECT kind, record_id, doc_date,
+               highlight(search_index, 2, char(2), char(3)) as title,
+               snippet(search_index, 3, char(2), char(3), '…', 12) as snippet,
+               bm25(search_index, 0, 0, 4.0, 1.0) as score
+        FROM search_index
+        WHERE {where}
+        ORDER BY score
+        LIMIT ? OFFSET ?
+    ''', params + [limit + 1, offset], fetch=True)
+    
+    results = [{
+        'entity': row['kind'],
+        'id': row['record_id'],
+        'date': row['doc_date'],
+        'title': _highlight(row['title']),
+        'snippet': _highlight(row['snippet']),
+        'score': round(-row['score'], 4),
+    } for row in rows[:limit]]
+    
+    return jsonify({
+        'query': args.get('q', ''),
+        'results': results,
+        'next_offset': offset + limit if len(rows) > limit else None
+    })
+
+# Exportación de informes
+EXPORT_FORMATS = {
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+EXPORT_CHUNK_SIZE = 1000
+XLSX_SPOOL_SIZE = 8 * 1024 * 1024  # por encima se vuelca a disco
+
+def build_export_query(report_type, user_id, filters):
+    """Consulta de exportación con los mismos filtros que /api/income y /api/expenses"""
     if report_type == 'income':
-        data = execute_query('''
+        query = '''
             SELECT i.date, i.amount, i.type, i.source, i.description, 
                    v.plate as vehicle, c.name as company
             FROM income i
             LEFT JOIN vehicles v ON i.vehicle_id = v.id
             LEFT JOIN companies c ON i.company_id = c.id
             WHERE i.user_id = ?
-            ORDER BY i.date DESC
-        ''', (user_id,), fetch=True)
-        
-        df = pd.DataFrame([dict(row) for row in data])
-        
+        '''
+        alias = 'i'
     elif report_type == 'expenses':
-        data = execute_query('''
+        query = '''
             SELECT e.date, e.amount, e.type, e.category, e.description, 
                    e.supplier, v.plate as vehicle, c.name as company
             FROM expenses e
             LEFT JOIN vehicles v ON e.vehicle_id = v.id
             LEFT JOIN companies c ON e.company_id = c.id
             WHERE e.user_id = ?
-            ORDER BY e.date DESC
+        '''
+        alias = 'e'
+    else:
+        raise ValueError('Tipo de reporte no válido')
+    
+    params = [user_id]
+    if filters.get('start_date'):
+        query += f' AND {alias}.date >= ?'
+        params.append(filters['start_date'])
+    if filters.get('end_date'):
+        query += f' AND {alias}.date <= ?'
+        params.append(filters['end_date'])
+    if filters.get('vehicle_id'):
+        query += f' AND {alias}.vehicle_id = ?'
+        params.append(filters['vehicle_id'])
+    if report_type == 'expenses' and filters.get('category'):
+        query += ' AND e.category = ?'
+        params.append(filters['category'])
+    
+    query += f' ORDER BY {alias}.date DESC'
+    return query, params
+
+def iter_csv_chunks(rows, chunk_size=EXPORT_CHUNK_SIZE):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    header_written = False
+    pending = 0
+    for row in rows:
+        if not header_written:
+            writer.writerow(row.keys())
+            header_written = True
+        writer.writerow(tuple(row))
+        pending += 1
+        if pending >= chunk_size:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            pending = 0
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def write_xlsx(rows, fileobj, sheet_name):
+    """Escribe las filas con un libro openpyxl write-only (memoria constante)"""
+    from openpyxl import Workbook
+    
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(sheet_name)
+    header_written = False
+    for row in rows:
+        if not header_written:
+            sheet.append(list(row.keys()))
+            header_written = True
+        sheet.append(tuple(row))
+    workbook.save(fileobj)
+
+@app.route('/api/reports/export/<report_type>')
+@login_required
+def export_report(report_type):
+    user_id = session['user_id']
+    export_format = request.args.get('format', 'xlsx')
+    
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'error': 'Formato de exportación no válido'}), 400
+    try:
+        query, params = build_export_query(report_type, user_id, request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    download_name = f'{report_type}_report_{datetime.now().strftime("%Y%m%d")}.{export_format}'
+    rows = iter_query(query, params, chunk_size=EXPORT_CHUNK_SIZE)
+    
+    if export_format == 'xlsx':
+        # El xlsx es un zip: se genera en un fichero temporal y se envía por bloques
+        output = tempfile.SpooledTemporaryFile(max_size=XLSX_SPOOL_SIZE)
+        write_xlsx(rows, output, report_type.title())
+        output.seek(0)
+        return send_file(
+            output,
+            mimetype=EXPORT_FORMATS['xlsx'],
+            as_attachment=True,
+            download_name=download_name
+        )
+    
+    # CSV y NDJSON se emiten mientras se lee el cursor
+    chunks = iter_csv_chunks(rows) if export_format == 'csv' else iter_ndjson_chunks(rows)
+    return Response(
+        stream_with_context(chunks),
+        mimetype=EXPORT_FORMATS[export_format],
+        headers={'Content-Disposition': f'attachment; filename={download_name}'}
+    )
+
+# Informes en segundo plano: POST crea el trabajo, se consulta el progreso y se descarga
+# el fichero terminado (con soporte de Range). Los resultados se reutilizan mientras no
+# cambien los datos del usuario.
+REPORT_FILTERS = ('start_date', 'end_date', 'vehicle_id', 'category')
+_report_executor = None
+_report_executor_lock = threading.Lock()
+
+def get_report_executor():
+    """Pool de procesos para generar informes, creado la primera vez que se usa"""
+    global _report_executor
+    with _report_executor_lock:
+        if _report_executor is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            
+            # spawn: el hijo importa main sin efectos secundarios y no hereda conexiones abiertas
+            _report_executor = ProcessPoolExecutor(
+                max_workers=app.config['REPORT_WORKERS'],
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return _report_executor
+
+def report_cache_key(user_id, report_type, export_format, filters):
+    """Clave del informe: usuario, tipo, formato, filtros y versión de los datos implicados"""
+    payload = {
+        'user_id': user_id,
+        'report_type': report_type,
+        'format': export_format,
+        'filters': filters,
+        'versions': get_data_versions(user_id, REPORT_DATA_TABLES),
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+def serialize_report_job(job):
+    data = {
+        'id': job['id'],
+        'report_type': job['report_type'],
+        'format': job['format'],
+        'filters': json.loads(job['filters']),
+        'status': job['status'],
+        'rows_written': job['rows_written'],
+        'total_rows': job['total_rows'],
+        'progress': None,
+        'file_size': job['file_size'],
+        'error': job['error'],
+        'created_at': job['created_at'],
+        'finished_at': job['finished_at'],
+    }
+    if job['total_rows']:
+        data['progress'] = round(min(job['rows_written'] / job['total_rows'], 1.0), 4)
+    elif job['status'] == 'done':
+        data['progress'] = 1.0
+    if job['status'] == 'done':
+        data['download_url'] = url_for('download_report_job', job_id=job['id'])
+    return data
+
+def run_report_job(database, reports_folder, job_id):
+    """Genera el fichero de un trabajo. Se ejecuta en un proceso del pool de informes
+
+    La exportación se lee con conn y el estado se escribe con progress: con un cursor de
+    lectura abierto, escribir por la misma conexión falla (SQLITE_BUSY_SNAPSHOT) en cuanto
+    otra conexión confirma algo en WAL.
+    """
+    conn = open_db_connection(database)
+    progress = open_db_connection(database)
+    try:
+        job = conn.execute('SELECT * FROM report_jobs WHERE id = ?', (job_id,)).fetchone()
+        if job is None or job['status'] != 'queued':
+            return
+        conn.execute('''
+            UPDATE report_jobs SET status = 'running', started_at = CURRENT_TIMESTAMP WHERE id = ?
+        ''', (job_id,))
+        try:
+            query, params = build_export_query(job['report_type'], job['user_id'], json.loads(job['filters']))
+            total_rows = conn.execute(f'SELECT COUNT(*) FROM ({query})', params).fetchone()[0]
+            conn.execute('UPDATE report_jobs SET total_rows = ? WHERE id = ?', (total_rows, job_id))
+            
+            def tracked_rows():
+                written = 0
+                cursor = conn.execute(query, params)
+                while True:
+                    rows = cursor.fetchmany(EXPORT_CHUNK_SIZE)
+                    if not rows:
+                        break
+                    yield from rows
+                    written += len(rows)
+                    progress.execute('UPDATE report_jobs SET rows_written = ? WHERE id = ?', (written, job_id))
+            
+            user_folder = os.path.join(reports_folder, job['user_id'])
+            os.makedirs(user_folder, exist_ok=True)
+            file_path = os.path.join(user_folder, f"{job['cache_key']}.{job['format']}")
+            partial_path = f'{file_path}.{job_id}.part'
+            if job['format'] == 'xlsx':
+                with open(partial_path, 'wb') as output:
+                    write_xlsx(tracked_rows(), output, job['report_type'].title())
+            elif job['format'] == 'csv':
+                with open(partial_path, 'w', encoding='utf-8', newline='') as output:
+                    output.writelines(iter_csv_chunks(tracked_rows()))
+            else:
+                with open(partial_path, 'wb') as output:
+                    output.writelines(iter_ndjson_chunks(tracked_rows()))
+            os.replace(partial_path, file_path)
+        except Exception as e:
+            progress.execute('''
+                UPDATE report_jobs SET status = 'failed', error = ?, finished_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (str(e), job_id))
+            raise
+        progress.execute('''
+            UPDATE report_jobs SET status = 'done', file_path = ?, file_size = ?,
+                   finished_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (file_path, os.path.getsize(file_path), job_id))
+    finally:
+        progress.close()
+        conn.close()
+
+def _report_job_finished(database, job_id, future):
+    # Cubre los fallos que el propio trabajo no pudo registrar (proceso caído, pool roto...)
+    if future.cancelled() or future.exception() is None:
+        return
+    conn = open_db_connection(database)
+    try:
+        conn.execute('''
+            UPDATE report_jobs SET status = 'failed', error = ?, finished_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND status IN ('queued', 'running')
+        ''', (str(future.exception()), job_id))
+    finally:
+        conn.close()
+
+def submit_report_job(job_id):
+    database = os.path.abspath(current_database())
+    future = get_report_executor().submit(
+        run_report_job, database, os.path.abspath(app.config['REPORTS_FOLDER']), job_id
+    )
+    future.add_done_callback(lambda f: _report_job_finished(database, job_id, f))
+
+@app.route('/api/reports/jobs', methods=['GET', 'POST'])
+@login_required
+def report_jobs_api():
+    user_id = session['user_id']
+    
+    if request.method == 'GET':
+        jobs = execute_query('''
+            SELECT * FROM report_jobs WHERE user_id = ? ORDER BY created_at DESC LIMIT 50
         ''', (user_id,), fetch=True)
-        
-        df = pd.DataFrame([dict(row) for row in data])
+        return jsonify([serialize_report_job(job) for job in jobs])
     
-    else:
-        return jsonify({'error': 'Tipo de reporte no válido'}), 400
+    data = request.json or {}
+    report_type = data.get('report_type')
+    export_format = data.get('format', 'xlsx')
+    filters = {key: data[key] for key in REPORT_FILTERS if data.get(key)}
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'error': 'Formato de exportación no válido'}), 400
+    try:
+        build_export_query(report_type, user_id, filters)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
-    # Generar Excel
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, sheet_name=report_type.title(), index=False)
+    with transaction() as conn:
+        # La clave se calcula dentro de la transacción: ninguna escritura puede colarse entre medias
+        cache_key = report_cache_key(user_id, report_type, export_format, filters)
+        job = conn.execute('''
+            SELECT * FROM report_jobs WHERE cache_key = ? AND status IN ('queued', 'running', 'done')
+        ''', (cache_key,)).fetchone()
+        if job is not None:
+            # created_at es CURRENT_TIMESTAMP (UTC)
+            age = datetime.utcnow() - datetime.fromisoformat(job['created_at'])
+            stale = job['status'] != 'done' and age.total_seconds() > app.config['REPORT_JOB_TIMEOUT']
+            missing = job['status'] == 'done' and not os.path.exists(job['file_path'])
+            if not stale and not missing:
+                return jsonify(serialize_report_job(job)), 200 if job['status'] == 'done' else 202
+            conn.execute('''
+                UPDATE report_jobs SET status = ?, finished_at = CURRENT_TIMESTAMP WHERE id = ?
+            ''', ('expired' if missing else 'failed', job['id']))
+        
+        job_id = str(uuid.uuid4())
+        conn.execute('''
+            INSERT INTO report_jobs (id, user_id, report_type, format, filters, cache_key)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (job_id, user_id, report_type, export_format, json.dumps(filters, sort_keys=True), cache_key))
+        job = conn.execute('SELECT * FROM report_jobs WHERE id = ?', (job_id,)).fetchone()
     
-    output.seek(0)
+    submit_report_job(job_id)
+    return jsonify(serialize_report_job(job)), 202
+
+@app.route('/api/reports/jobs/<job_id>')
+@login_required
+def report_job_status(job_id):
+    job = execute_query('SELECT * FROM report_jobs WHERE id = ? AND user_id = ?',
+                        (job_id, session['user_id']), fetch=True)
+    if not job:
+        return jsonify({'error': 'Trabajo no encontrado'}), 404
+    return jsonify(serialize_report_job(job[0]))
+
+@app.route('/api/reports/jobs/<job_id>/download')
+@login_required
+def download_report_job(job_id):
+    job = execute_query('SELECT * FROM report_jobs WHERE id = ? AND user_id = ?',
+                        (job_id, session['user_id']), fetch=True)
+    if not job:
+        return jsonify({'error': 'Trabajo no encontrado'}), 404
+    job = job[0]
+    if job['status'] != 'done' or not os.path.exists(job['file_path']):
+        return jsonify({'error': 'El informe no está disponible', 'status': job['status']}), 409
     
+    # conditional=True: ETag/Last-Modified, 304 y peticiones Range (206) para reanudar descargas
+    download_name = f"{job['report_type']}_report_{job['finished_at'][:10].replace('-', '')}.{job['format']}"
     return send_file(
-        output,
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        os.path.abspath(job['file_path']),
+        mimetype=EXPORT_FORMATS[job['format']],
         as_attachment=True,
-        download_name=f'{report_type}_report_{datetime.now().strftime("%Y%m%d")}.xlsx'
+        download_name=download_name,
+        conditional=True,
+        etag=job['cache_key']
     )
 
+@scheduled_job('purge_report_artifacts', daily_at='03:00')
+@across_shards
+def purge_report_artifacts():
+    """Borra los informes antiguos y da por perdidos los trabajos que no terminaron"""
+    execute_query('''
+        UPDATE report_jobs SET status = 'failed', error = 'Tiempo agotado', finished_at = CURRENT_TIMESTAMP
+        WHERE status IN ('queued', 'running') AND created_at < datetime('now', ?)
+    ''', (f"-{app.config['REPORT_JOB_TIMEOUT']} seconds",))
+    expired = execute_query('''
+        SELECT id, file_path FROM report_jobs WHERE created_at < datetime('now', ?)
+    ''', (f"-{app.config['REPORT_RETENTION_DAYS']} days",), fetch=True)
+    for job in expired:
+        if job['file_path'] and os.path.exists(job['file_path']):
+            os.remove(job['file_path'])
+    execute_query('''
+        DELETE FROM report_jobs WHERE created_at < datetime('now', ?)
+    ''', (f"-{app.config['REPORT_RETENTION_DAYS']} days",))
+    return len(expired)
+
 @app.route('/api/reminders', methods=['GET', 'POST'])
 @login_required
+@conditional_get('reminders')
 def reminders_api():
     user_id = session['user_id']
     
@@ -950,45 +4025,41 @@ def reminders_api():
         
         return jsonify({'success': True, 'reminder_id': reminder_id})
     
-    reminders = execute_query('''
-        SELECT * FROM reminders 
-        WHERE user_id = ? AND status = 'pending'
-        ORDER BY due_date ASC
-    ''', (user_id,), fetch=True)
-    
-    return jsonify([dict(reminder) for reminder in reminders])
+    return list_records(
+        'reminders', 'r', 'reminders r',
+        "r.user_id = ? AND r.status = 'pending'", [user_id],
+        {}, 'due_date', descending=False
+    )
 
 @app.route('/api/settings', methods=['GET', 'POST'])
 @login_required
+@conditional_get('settings')
 def settings_api():
     user_id = session['user_id']
     
     if request.method == 'POST':
         data = request.json
         
-        for category, settings in data.items():
-            for key, value in settings.items():
-                # Actualizar o insertar configuración
-                execute_query('''
-                    INSERT OR REPLACE INTO settings (id, user_id, category, key, value, updated_at)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                ''', (str(uuid.uuid4()), user_id, category, key, str(value), datetime.now()))
+        now = datetime.now()
+        rows = [
+            (str(uuid.uuid4()), user_id, category, key, str(value), now)
+            for category, settings in data.items()
+            for key, value in settings.items()
+        ]
+        
+        # Actualizar o insertar todas las configuraciones en un único commit
+        with transaction() as conn:
+            conn.executemany('''
+                INSERT INTO settings (id, user_id, category, key, value, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (user_id, category, key) DO UPDATE SET
+                    value = excluded.value, updated_at = excluded.updated_at
+            ''', rows)
+        invalidate_user_settings(user_id)
         
         return jsonify({'success': True})
     
-    settings = execute_query('''
-        SELECT category, key, value FROM settings WHERE user_id = ?
-    ''', (user_id,), fetch=True)
-    
-    # Organizar por categorías
-    organized_settings = {}
-    for setting in settings:
-        category = setting['category']
-        if category not in organized_settings:
-            organized_settings[category] = {}
-        organized_settings[category][setting['key']] = setting['value']
-    
-    return jsonify(organized_settings)
+    return jsonify(get_user_settings(user_id))
 
 # Ruta de logout
 @app.route('/logout')
@@ -1005,6 +4076,658 @@ def not_found_error(error):
 def internal_error(error):
     return jsonify({'error': 'Error interno del servidor'}), 500
 
+# Métricas de peticiones y plantillas
+# El inicio se guarda en el environ (no en g): las subpeticiones de /api/batch comparten g
+@app.before_request
+def start_request_timer():
+    request.environ['gestortaxi.started'] = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = request.environ.pop('gestortaxi.started', None)
+    if started is not None:
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe('http_request_duration_seconds', (
+            ('route', endpoint), ('method', request.method), ('status', response.status_code)
+        ), time.perf_counter() - started)
+    return response
+
+def _template_render_started(sender, template, context, **extra):
+    g.setdefault('template_timers', []).append(time.perf_counter())
+
+def _template_rendered(sender, template, context, **extra):
+    timers = g.get('template_timers')
+    if timers:
+        metrics.observe('flask_template_render_seconds', (('template', template.name),),
+                        time.perf_counter() - timers.pop())
+
+before_render_template.connect(_template_render_started, app)
+template_rendered.connect(_template_rendered, app)
+
+def pool_gauges():
+    gauges = []
+    with _db_pools_lock:
+        pools = list(_db_pools.items())
+    for database, pool in pools:
+        labels = (('database', os.path.basename(database)),)
+        gauges.append(('db_pool_connections', labels + (('state', 'open'),), pool._created))
+        gauges.append(('db_pool_connections', labels + (('state', 'idle'),), pool._idle.qsize()))
+    # Sentencias que solo difieren en literales comparten huella: una línea por huella
+    statements = dict(_sql_fingerprints.copy().values())
+    for fingerprint, normalized in sorted(statements.items()):
+        gauges.append(('sqlite_statement_info', (('fingerprint', fingerprint), ('sql', normalized[:500])), 1))
+    return gauges
+
+def metrics_required(f):
+    """Sin METRICS_TOKEN el endpoint no existe; con él se exige el token Bearer"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        token = app.config['METRICS_TOKEN']
+        if not token:
+            return jsonify({'error': 'Recurso no encontrado'}), 404
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+            return jsonify({'error': 'No autorizado'}), 401
+        return f(*args, **kwargs)
+    return decorated_function
+
+@app.route('/metrics')
+@metrics_required
+def metrics_endpoint():
+    return Response(metrics.render(pool_gauges()), mimetype='text/plain; version=0.0.4')
+
+@app.route('/metrics/slow-queries')
+@metrics_required
+def slow_queries_endpoint():
+    return jsonify(list(reversed(slow_queries)))
+
+# Importación masiva de ingresos y gastos
+IMPORT_CHUNK_SIZE = 5000
+IMPORT_MAX_REPORTED_ERRORS = 500
+
+# Columnas reconocidas por proveedor (nombres normalizados: minúsculas, sin tildes)
+IMPORT_PROVIDERS = {
+    'uber': {
+        'vat_rate': 10, 'type': 'app',
+        'columns': {
+            'date': ['fecha', 'date', 'date_time', 'fecha_y_hora', 'trip_date', 'fecha_del_viaje'],
+            'amount': ['ganancias_totales', 'total', 'importe', 'total_earnings', 'earnings', 'amount'],
+            'reference': ['uuid_del_viaje', 'trip_uuid', 'trip_id', 'id_del_viaje'],
+            'description': ['descripcion', 'description', 'tipo', 'type'],
+        },
+    },
+    'cabify': {
+        'vat_rate': 10, 'type': 'app',
+        'columns': {
+            'date': ['fecha', 'date', 'start_date', 'fecha_inicio'],
+            'amount': ['total', 'importe', 'amount', 'precio', 'price'],
+            'reference': ['journey_id', 'id_viaje', 'id', 'reference'],
+            'description': ['descripcion', 'description', 'origen', 'pickup'],
+        },
+    },
+    'bolt': {
+        'vat_rate': 10, 'type': 'app',
+        'columns': {
+            'date': ['fecha', 'date', 'order_date', 'ride_date'],
+            'amount': ['total_fare', 'ride_price', 'total', 'importe', 'amount'],
+            'reference': ['order_id', 'ride_id', 'id_pedido', 'reference'],
+            'description': ['descripcion', 'description', 'pickup_address'],
+        },
+    },
+    'tpv': {
+        'vat_rate': 10, 'type': 'tpv', 'payment_method': 'card',
+        'columns': {
+            'date': ['fecha', 'fecha_operacion', 'date'],
+            'amount': ['importe', 'importe_operacion', 'amount', 'total'],
+            'reference': ['numero_operacion', 'n_operacion', 'no_operacion', 'referencia', 'reference', 'autorizacion'],
+            'description': ['concepto', 'descripcion', 'tarjeta', 'description'],
+        },
+    },
+    'generic': {
+        'vat_rate': 21, 'type': None,
+        'columns': {
+            'date': ['fecha', 'date', 'fecha_operacion', 'fecha_valor'],
+            'amount': ['importe', 'amount', 'total', 'cantidad'],
+            'reference': ['referencia', 'reference', 'id', 'numero_documento'],
+            'description': ['concepto', 'descripcion', 'description'],
+            'vat_rate': ['iva', 'tipo_iva', 'vat_rate', 'vat'],
+            'category': ['categoria', 'category'],
+            'supplier': ['proveedor', 'supplier', 'beneficiario'],
+            'invoice_number': ['factura', 'numero_factura', 'invoice_number'],
+        },
+    },
+}
+
+def normalize_column_name(name):
+    name = unicodedata.normalize('NFKD', str(name)).encode('ascii', 'ignore').decode().lower()
+    return '_'.join(''.join(ch if ch.isalnum() else ' ' for ch in name).split())
+
+def iter_import_frames(file_storage, chunk_size=IMPORT_CHUNK_SIZE):
+    """Lee un CSV o XLSX por bloques de DataFrame con todas las columnas como texto"""
+    import pandas as pd
+    
+    filename = (file_storage.filename or '').lower()
+    stream = file_storage.stream
+    if filename.endswith(('.xlsx', '.xlsm')):
+        from openpyxl import load_workbook
+        
+        workbook = load_workbook(stream, read_only=True, data_only=True)
+        rows = workbook.active.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        header = [str(column) if column is not None else f'col_{i}' for i, column in enumerate(header)]
+        chunk = []
+        for row in rows:
+            chunk.append(['' if value is None else str(value) for value in row])
+            if len(chunk) >= chunk_size:
+                yield pd.DataFrame(chunk, columns=header)
+                chunk = []
+        if chunk:
+            yield pd.DataFrame(chunk, columns=header)
+        workbook.close()
+        return
+    
+    # CSV: detectar separador (',' o ';' en exportaciones españolas) con la primera línea
+    sample = stream.read(8192)
+    stream.seek(0)
+    try:
+        text_sample = sample.decode('utf-8-sig')
+        encoding = 'utf-8-sig'
+    except UnicodeDecodeError:
+        text_sample = sample.decode('latin-1')
+        encoding = 'latin-1'
+    try:
+        delimiter = csv.Sniffer().sniff(text_sample.split('\n', 1)[0], delimiters=',;\t|').delimiter
+    except csv.Error:
+        delimiter = ','
+    yield from pd.read_csv(stream, sep=delimiter, dtype=str, keep_default_na=False,
+                           encoding=encoding, chunksize=chunk_size)
+
+def parse_amounts(values):
+    """Importes en texto ('1.234,56', '12.5', '€ 10') a float de forma vectorizada"""
+    import pandas as pd
+    
+    text = values.astype(str).str.replace(r'[^0-9,.\-]', '', regex=True)
+    decimal_comma = text.str.contains(',', regex=False)
+    text = text.where(~decimal_comma, text.str.replace('.', '', regex=False).str.replace(',', '.', regex=False))
+    return pd.to_numeric(text, errors='coerce')
+
+def parse_dates(values):
+    """Fechas en texto a datetime; ISO ('2024-03-05', '2024-03-05 00:00:00' de XLSX) tal cual
+
+    dayfirst solo se aplica al resto (DD/MM/YYYY): con format='mixed' también daría la vuelta
+    a día y mes en las fechas ISO.
+    """
+    import pandas as pd
+    
+    text = values.astype(str).str.strip()
+    iso_text = text.str.extract(r'^(\d{4}[-/]\d{1,2}[-/]\d{1,2})(?:$|[ T])', expand=False)
+    iso = iso_text.notna()
+    dates = pd.to_datetime(iso_text.fillna('').str.replace('/', '-', regex=False), errors='coerce', format='%Y-%m-%d')
+    if not iso.all():
+        dates = dates.where(iso, pd.to_datetime(text.where(~iso, ''), errors='coerce', dayfirst=True, format='mixed'))
+    return dates
+
+def import_ledger_file(user_id, ledger, provider, file_storage, defaults):
+    """Importa un fichero de ingresos o gastos en una transacción con executemany"""
+    import pandas as pd
+    
+    config = IMPORT_PROVIDERS[provider]
+    report = {'rows_read': 0, 'inserted': 0, 'duplicates': 0, 'errors': [], 'errors_truncated': False}
+    default_vat = float(defaults.get('vat_rate') or config['vat_rate'])
+    occurrences = {}
+    
+    with transaction() as conn:
+        offset = 0
+        for frame in iter_import_frames(file_storage):
+            frame.columns = [normalize_column_name(column) for column in frame.columns]
+            fields = {}
+            for field, candidates in config['columns'].items():
+                column = next((candidate for candidate in candidates if candidate in frame.columns), None)
+                if column is not None:
+                    fields[field] = frame[column]
+            if 'date' not in fields or 'amount' not in fields:
+                raise ValueError('El fichero no tiene columnas de fecha e importe reconocibles')
+            
+            rows = len(frame)
+            line_numbers = pd.RangeIndex(offset + 2, offset + 2 + rows)  # la línea 1 es la cabecera
+            offset += rows
+            report['rows_read'] += rows
+            
+            dates = parse_dates(fields['date'])
+            amounts = parse_amounts(fields['amount']).abs() if ledger == 'expenses' else parse_amounts(fields['amount'])
+            if 'vat_rate' in fields:
+                vat_rates = parse_amounts(fields['vat_rate']).fillna(default_vat)
+            else:
+                vat_rates = pd.Series(default_vat, index=frame.index)
+            vat_amounts = (amounts * vat_rates / 100).round(2)
+            
+            valid = dates.notna() & amounts.notna()
+            for line, bad_date in zip(line_numbers[~valid.to_numpy()], dates[~valid].isna()):
+                if len(report['errors']) >= IMPORT_MAX_REPORTED_ERRORS:
+                    report['errors_truncated'] = True
+                    break
+                report['errors'].append({'row': int(line), 'error': 'Fecha no válida' if bad_date else 'Importe no válido'})
+            
+            empty = pd.Series('', index=frame.index)
+            descriptions = fields.get('description', empty)
+            date_strings = dates.dt.strftime('%Y-%m-%d')
+            import_keys = provider + ':' + fields.get('reference', empty).str.strip()
+            # Sin referencia en la fila: fecha + importe + concepto y un ordinal dentro del fichero,
+            # para que dos carreras idénticas el mismo día no se descarten como duplicadas
+            fallback = valid & (import_keys == provider + ':')
+            if fallback.any():
+                natural_keys = (date_strings + '|' + amounts.astype(float).map('{:.2f}'.format)
+                                + '|' + descriptions.str.strip())[fallback]
+                ordinals = (natural_keys.groupby(natural_keys).cumcount() + 1
+                            + natural_keys.map(occurrences).fillna(0).astype(int))
+                for key, count in natural_keys.value_counts().items():
+                    occurrences[key] = occurrences.get(key, 0) + count
+                import_keys[fallback] = provider + ':' + natural_keys + '#' + ordinals.astype(str)
+            
+            valid_index = valid[valid].index
+            ids = [str(uuid.uuid4()) for _ in range(len(valid_index))]
+            columns = [
+                date_strings[valid_index], amounts[valid_index], vat_rates[valid_index],
+                vat_amounts[valid_index], descriptions[valid_index], import_keys[valid_index],
+            ]
+            if ledger == 'income':
+                records = [
+                    (record_id, user_id, defaults.get('company_id'), defaults.get('vehicle_id'), day, amount,
+                     config['type'], provider, description or None, rate, vat, config.get('payment_method'), key)
+                    for record_id, day, amount, rate, vat, description, key in zip(ids, *columns)
+                ]
+                cursor = conn.executemany('''
+                    INSERT OR IGNORE INTO income (id, user_id, company_id, vehicle_id, date, amount, type,
+                                                  source, description, vat_rate, vat_amount, payment_method,
+                                                  import_key)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', records)
+            else:
+                categories = fields.get('category', pd.Series(defaults.get('category') or '', index=frame.index))
+                suppliers = fields.get('supplier', empty)
+                invoice_numbers = fields.get('invoice_number', empty)
+                records = [
+                    (record_id, user_id, defaults.get('company_id'), defaults.get('vehicle_id'), day, amount,
+                     config['type'], category or None, description or None, supplier or None,
+                     invoice_number or None, rate, vat, key)
+                    for record_id, day, amount, rate, vat, description, key, category, supplier, invoice_number
+                    in zip(ids, *columns, categories[valid_index], suppliers[valid_index],
+                           invoice_numbers[valid_index])
+                ]
+                cursor = conn.executemany('''
+                    INSERT OR IGNORE INTO expenses (id, user_id, company_id, vehicle_id, date, amount, type,
+                                                    category, description, supplier, invoice_number,
+                                                    vat_rate, vat_amount, import_key)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', records)
+            report['inserted'] += cursor.rowcount
+            report['duplicates'] += len(records) - cursor.rowcount
+    
+    return report
+
+@app.route('/api/import/<ledger>', methods=['POST'])
+@login_required
+def import_api(ledger):
+    user_id = session['user_id']
+    provider = request.form.get('provider', 'generic')
+    upload = request.files.get('file')
+    
+    if ledger not in ('income', 'expenses'):
+        return jsonify({'error': 'Tipo de importación no válido'}), 400
+    if provider not in IMPORT_PROVIDERS:
+        return jsonify({'error': 'Proveedor no soportado'}), 400
+    if upload is None:
+        return jsonify({'error': 'Falta el fichero'}), 400
+    
+    try:
+        report = import_ledger_file(user_id, ledger, provider, upload, request.form)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    
+    return jsonify({'success': True, **report})
+
+# Conciliación bancaria. Los extractos se leen registro a registro (Norma 43) o por bloques
+# (CSV/XLSX) y se insertan con executemany. El emparejamiento con los libros es un hash join
+# por importe en céntimos y, dentro de cada importe, la fecha más cercana con bisect sobre
+# las fechas ordenadas: O((n + m) log m) en lugar de comparar cada movimiento con cada apunte.
+BANK_N43_EXTENSIONS = ('.n43', '.q43', '.aeb', '.txt')
+
+# Columnas reconocidas en los CSV de los bancos (nombres normalizados)
+BANK_CSV_COLUMNS = {
+    'date': ['fecha', 'fecha_operacion', 'f_operacion', 'fecha_contable', 'date'],
+    'value_date': ['fecha_valor', 'f_valor', 'value_date'],
+    'amount': ['importe', 'importe_eur', 'amount', 'cantidad'],
+    'debit': ['cargo', 'cargos', 'debe', 'debit'],
+    'credit': ['abono', 'abonos', 'haber', 'credit'],
+    'concept': ['concepto', 'descripcion', 'movimiento', 'concept', 'description'],
+    'reference': ['referencia', 'n_documento', 'documento', 'reference'],
+    'account': ['cuenta', 'iban', 'account'],
+}
+
+def _n43_date(text):
+    try:
+        return date(2000 + int(text[0:2]), int(text[2:4]), int(text[4:6])).isoformat()
+    except ValueError:
+        return None
+
+def iter_norma43_movements(stream):
+    """Movimientos de un fichero Norma 43 (AEB cuaderno 43) sin cargarlo en memoria
+
+    Registros usados: 11 (cabecera de cuenta), 22 (movimiento) y 23 (conceptos
+    complementarios, que se añaden al concepto del movimiento anterior).
+    """
+    text = io.TextIOWrapper(stream, encoding='latin-1', newline='')
+    account = None
+    movement = None
+    try:
+        for line_number, line in enumerate(text, 1):
+            line = line.rstrip('\r\n')
+            record = line[:2]
+            if record == '11':
+                account = line[2:20]
+            elif record == '22':
+                if movement:
+                    yield movement
+                digits = line[28:42]
+                amount = int(digits) / 100 if digits.isdigit() else None
+                if amount is not None and line[27:28] == '1':  # 1 = debe (cargo), 2 = haber (abono)
+                    amount = -amount
+                movement = {
+                    'line': line_number,
+                    'account': account,
+                    'date': _n43_date(line[10:16]),
+                    'value_date': _n43_date(line[16:22]),
+                    'amount': amount,
+                    'reference': ' '.join(part for part in (line[42:52].lstrip('0 '), line[52:64].strip(),
+                                                            line[64:80].strip()) if part),
+                    'concept': '',
+                }
+            elif record == '23' and movement:
+                extra = ' '.join(part for part in (line[4:42].strip(), line[42:80].strip()) if part)
+                movement['concept'] = f"{movement['concept']} {extra}".strip()
+            elif record in ('33', '88') and movement:
+                yield movement
+                movement = None
+        if movement:
+            yield movement
+    finally:
+        text.detach()  # el stream pertenece a la petición
+
+def iter_bank_csv_movements(file_storage):
+    """Movimientos de un CSV/XLSX de banco; importe único con signo o columnas cargo/abono"""
+    import pandas as pd
+    
+    offset = 0
+    for frame in iter_import_frames(file_storage):
+        frame.columns = [normalize_column_name(column) for column in frame.columns]
+        fields = {}
+        for field, candidates in BANK_CSV_COLUMNS.items():
+            column = next((candidate for candidate in candidates if candidate in frame.columns), None)
+            if column is not None:
+                fields[field] = frame[column]
+        if 'date' not in fields or not fields.keys() & {'amount', 'debit', 'credit'}:
+            raise ValueError('El extracto no tiene columnas de fecha e importe reconocibles')
+        
+        dates = parse_dates(fields['date']).dt.strftime('%Y-%m-%d')
+        value_dates = parse_dates(fields['value_date']).dt.strftime('%Y-%m-%d') if 'value_date' in fields else dates
+        if 'amount' in fields:
+            amounts = parse_amounts(fields['amount'])
+        else:
+            # Columnas separadas: el cargo resta y el abono suma
+            zero = pd.Series(0.0, index=frame.index)
+            credits = parse_amounts(fields['credit']).abs() if 'credit' in fields else zero
+            debits = parse_amounts(fields['debit']).abs() if 'debit' in fields else zero
+            amounts = credits.fillna(0) - debits.fillna(0)
+            amounts[credits.isna() & debits.isna()] = float('nan')
+        empty = pd.Series('', index=frame.index)
+        
+        for line, day, value_day, amount, concept, reference, account in zip(
+            range(offset + 2, offset + 2 + len(frame)), dates, value_dates, amounts,
+            fields.get('concept', empty), fields.get('reference', empty), fields.get('account', empty)
+        ):
+            yield {
+                'line': line,
+                'account': account.strip() or None,
+                'date': day if isinstance(day, str) else None,
+                'value_date': value_day if isinstance(value_day, str) else None,
+                'amount': None if pd.isna(amount) else round(float(amount), 2),
+                'reference': reference.strip(),
+                'concept': concept.strip(),
+            }
+        offset += len(frame)
+
+def import_bank_statement(user_id, file_storage, company_id=None):
+    """Importa un extracto en una transacción; los movimientos ya importados se ignoran"""
+    stream = file_storage.stream
+    head = stream.read(2)
+    stream.seek(0)
+    filename = (file_storage.filename or '').lower()
+    if filename.endswith(BANK_N43_EXTENSIONS) or head == b'11':
+        source, movements = 'n43', iter_norma43_movements(stream)
+    else:
+        source, movements = 'csv', iter_bank_csv_movements(file_storage)
+    
+    report = {'format': source, 'rows_read': 0, 'inserted': 0, 'duplicates': 0,
+              'errors': [], 'errors_truncated': False}
+    # Dos movimientos idénticos el mismo día son legítimos: el ordinal los distingue
+    occurrences = {}
+    
+    def records():
+        for movement in movements:
+            report['rows_read'] += 1
+            if movement['date'] is None or movement['amount'] is None:
+                if len(report['errors']) >= IMPORT_MAX_REPORTED_ERRORS:
+                    report['errors_truncated'] = True
+                else:
+                    error = 'Fecha no válida' if movement['date'] is None else 'Importe no válido'
+                    report['errors'].append({'row': movement['line'], 'error': error})
+                continue
+            natural_key = (f"{source}:{movement['account'] or ''}|{movement['date']}|{movement['amount']:.2f}"
+                           f"|{movement['reference']}|{movement['concept']}")
+            occurrences[natural_key] = occurrences.get(natural_key, 0) + 1
+            yield (
+                str(uuid.uuid4()), user_id, company_id, movement['account'], movement['date'],
+                movement['value_date'], movement['amount'], movement['concept'] or None,
+                movement['reference'] or None, source, f'{natural_key}#{occurrences[natural_key]}'
+            )
+    
+    with transaction() as conn:
+        batches = records()
+        while True:
+            batch = list(itertools.islice(batches, IMPORT_CHUNK_SIZE))
+            if not batch:
+                break
+            cursor = conn.executemany('''
+                INSERT OR IGNORE INTO bank_movements (id, user_id, company_id, account, date, value_date,
+                                                      amount, concept, reference, source, import_key)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', batch)
+            report['inserted'] += cursor.rowcount
+            report['duplicates'] += len(batch) - cursor.rowcount
+    return report
+
+def _take_nearest(bucket, day, tolerance, used):
+    """Saca del cubo (fechas ordenadas, ids) el apunte libre más cercano a day"""
+    days, record_ids = bucket
+    while days:
+        position = bisect.bisect_left(days, day)
+        best = None
+        for index in (position - 1, position):
+            if 0 <= index < len(days) and abs(days[index] - day) <= tolerance:
+                if best is None or abs(days[index] - day) < abs(days[best] - day):
+                    best = index
+        if best is None:
+            return None
+        found_day, record_id = days.pop(best), record_ids.pop(best)
+        if record_id not in used:  # ya emparejado a través del otro índice
+            used.add(record_id)
+            return record_id, day - found_day
+    return None
+
+def _ledger_buckets(user_id, ledger, start, end, company_id):
+    """Apuntes sin conciliar indexados por importe en céntimos (total con IVA y base)"""
+    company_sql = ' AND l.company_id = ?' if company_id else ''
+    params = [user_id, start, end, ledger] + ([company_id] if company_id else [])
+    gross, base = {}, {}
+    for row in iter_query(f'''
+        SELECT l.id, substr(l.date, 1, 10) as day, l.amount, COALESCE(l.vat_amount, 0) as vat_amount
+        FROM {ledger} l
+        WHERE l.user_id = ? AND l.date >= ? AND l.date < ?
+          AND NOT EXISTS (SELECT 1 FROM reconciliations r WHERE r.ledger = ? AND r.record_id = l.id)
+          {company_sql}
+        ORDER BY l.date
+    ''', params):
+        try:
+            day = date.fromisoformat(row['day']).toordinal()
+        except (TypeError, ValueError):
+            continue
+        amount = float(row['amount'] or 0)
+        total_cents = round(abs(amount + float(row['vat_amount'])) * 100)
+        base_cents = round(abs(amount) * 100)
+        for index, cents in ((gross, total_cents), (base, base_cents)):
+            if index is base and cents == total_cents:
+                continue
+            days, record_ids = index.setdefault(cents, ([], []))
+            days.append(day)  # la consulta ya viene ordenada por fecha
+            record_ids.append(row['id'])
+    return gross, base
+
+def reconcile_bank_movements(user_id, tolerance_days=None, company_id=None):
+    """Empareja los movimientos pendientes con ingresos (abonos) y gastos (cargos)
+
+    Primero por el total con IVA y, si no hay, por la base; siempre la fecha más cercana
+    dentro de la tolerancia. Devuelve el número de movimientos revisados y emparejados.
+    """
+    if tolerance_days is None:
+        tolerance_days = app.config['BANK_MATCH_TOLERANCE_DAYS']
+    company_sql = ' AND company_id = ?' if company_id else ''
+    movements = execute_query(f'''
+        SELECT id, date, amount FROM bank_movements
+        WHERE user_id = ? AND status = 'pending'{company_sql}
+        ORDER BY date
+    ''', [user_id] + ([company_id] if company_id else []), fetch=True)
+    if not movements:
+        return {'reviewed': 0, 'matched': 0, 'pending': 0}
+    
+    start = (date.fromisoformat(movements[0]['date']) - timedelta(days=tolerance_days)).isoformat()
+    end = (date.fromisoformat(movements[-1]['date']) + timedelta(days=tolerance_days + 1)).isoformat()
+    indexes = {
+        'income': _ledger_buckets(user_id, 'income', start, end, company_id),
+        'expenses': _ledger_buckets(user_id, 'expenses', start, end, company_id),
+    }
+    used = set()
+    matches = []
+    for movement in movements:
+        amount = float(movement['amount'] or 0)
+        if not amount:
+            continue
+        ledger = 'income' if amount > 0 else 'expenses'
+        cents = round(abs(amount) * 100)
+        day = date.fromisoformat(movement['date']).toordinal()
+        for index in indexes[ledger]:
+            bucket = index.get(cents)
+            match = bucket and _take_nearest(bucket, day, tolerance_days, used)
+            if match:
+                matches.append((movement['id'], user_id, ledger, match[0], match[1]))
+                break
+    
+    with transaction() as conn:
+        conn.executemany('''
+            INSERT OR IGNORE INTO reconciliations (movement_id, user_id, ledger, record_id, method, day_diff)
+            VALUES (?, ?, ?, ?, 'auto', ?)
+        ''', matches)
+        # Solo los que han quedado conciliados (otra conciliación simultánea pudo tomar el apunte)
+        matched = conn.executemany('''
+            UPDATE bank_movements SET status = 'matched'
+            WHERE id = ? AND status = 'pending'
+              AND EXISTS (SELECT 1 FROM reconciliations WHERE movement_id = ?)
+        ''', [(match[0], match[0]) for match in matches]).rowcount
+    return {'reviewed': len(movements), 'matched': matched, 'pending': len(movements) - matched}
+
+@app.route('/api/contable/extractos-bancarios', methods=['GET', 'POST'])
+@login_required
+@conditional_get('bank_movements', 'reconciliations')
+def bank_statements_api():
+    user_id = session['user_id']
+    
+    if request.method == 'POST':
+        # Con fichero: importar (y conciliar salvo reconcile=0). Sin fichero: solo conciliar.
+        upload = request.files.get('file')
+        options = request.form if upload is not None else (request.get_json(silent=True) or {})
+        try:
+            tolerance = options.get('tolerance_days')
+            tolerance = int(tolerance) if tolerance not in (None, '') else None
+            report = {}
+            if upload is not None:
+                report = import_bank_statement(user_id, upload, options.get('company_id'))
+            if str(options.get('reconcile', '1')) != '0':
+                report['reconciliation'] = reconcile_bank_movements(user_id, tolerance, options.get('company_id'))
+        except ValueError as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
+        return jsonify({'success': True, **report})
+    
+    where = 'b.user_id = ?'
+    params = [user_id]
+    for arg, condition in (('status', 'b.status = ?'), ('start_date', 'b.date >= ?'),
+                           ('end_date', 'b.date <= ?'), ('company_id', 'b.company_id = ?')):
+        if request.args.get(arg):
+            where += f' AND {condition}'
+            params.append(request.args[arg])
+    
+    return list_records(
+        'bank_movements', 'b',
+        'bank_movements b LEFT JOIN reconciliations r ON r.movement_id = b.id',
+        where, params,
+        {'ledger': 'r.ledger', 'record_id': 'r.record_id', 'match_method': 'r.method', 'day_diff': 'r.day_diff'},
+        'date'
+    )
+
+@app.route('/api/contable/extractos-bancarios/<movement_id>', methods=['POST', 'DELETE'])
+@login_required
+def bank_movement_reconciliation(movement_id):
+    """Conciliación manual (POST con ledger y record_id) o deshacerla (DELETE)"""
+    user_id = session['user_id']
+    movement = execute_query('''
+        SELECT id, date, amount, status FROM bank_movements WHERE id = ? AND user_id = ?
+    ''', (movement_id, user_id), fetch=True)
+    if not movement:
+        return jsonify({'error': 'Movimiento no encontrado'}), 404
+    
+    if request.method == 'DELETE':
+        with transaction():
+            execute_query('DELETE FROM reconciliations WHERE movement_id = ?', (movement_id,))
+            execute_query("UPDATE bank_movements SET status = 'pending' WHERE id = ?", (movement_id,))
+        return jsonify({'success': True})
+    
+    data = request.get_json(silent=True) or {}
+    ledger = data.get('ledger')
+    if ledger not in ('income', 'expenses'):
+        return jsonify({'error': 'ledger debe ser income o expenses'}), 400
+    record = execute_query(f'SELECT id, date FROM {ledger} WHERE id = ? AND user_id = ?',
+                           (data.get('record_id'), user_id), fetch=True)
+    if not record:
+        return jsonify({'error': 'Apunte no encontrado'}), 404
+    
+    day_diff = None
+    try:
+        day_diff = (date.fromisoformat(movement[0]['date'][:10]) - date.fromisoformat(record[0]['date'][:10])).days
+    except (TypeError, ValueError):
+        pass
+    try:
+        with transaction():
+            execute_query('''
+                INSERT INTO reconciliations (movement_id, user_id, ledger, record_id, method, day_diff)
+                VALUES (?, ?, ?, ?, 'manual', ?)
+                ON CONFLICT (movement_id) DO UPDATE SET
+                    ledger = excluded.ledger, record_id = excluded.record_id,
+                    method = 'manual', day_diff = excluded.day_diff
+            ''', (movement_id, user_id, ledger, record[0]['id'], day_diff))
+            execute_query("UPDATE bank_movements SET status = 'matched' WHERE id = ?", (movement_id,))
+    except sqlite3.IntegrityError:
+        return jsonify({'success': False, 'message': 'El apunte ya está conciliado con otro movimiento'}), 409
+    return jsonify({'success': True})
+
 # API Routes adicionales que faltan
 @app.route('/api/gastos/<category>')
 @login_required
@@ -1016,6 +4739,18 @@ def gastos_category(category):
         'category': category
     })
 
+@app.route('/api/ingresos/apps-ingresos', methods=['GET', 'POST'])
+@login_required
+def apps_ingresos():
+    # POST: importación de los ficheros de Uber, Cabify, Bolt...
+    if request.method == 'POST':
+        return import_api('income')
+    return jsonify({
+        'success': True,
+        'category': 'apps-ingresos',
+        'providers': sorted(IMPORT_PROVIDERS)
+    })
+
 @app.route('/api/ingresos/<category>')
 @login_required
 def ingresos_category(category):
@@ -1086,5 +4821,116 @@ def dgt_category(category):
         'category': category
     })
 
+# Peticiones agrupadas: el dashboard carga una sección entera en un solo viaje
+BATCH_MAX_REQUESTS = 25
+BATCH_FORWARDED_HEADERS = ('If-None-Match', 'If-Modified-Since', 'Accept')
+_batch_executor = None
+_batch_executor_lock = threading.Lock()
+
+def get_batch_executor():
+    global _batch_executor
+    with _batch_executor_lock:
+        if _batch_executor is None:
+            _batch_executor = ThreadPoolExecutor(max_workers=app.config['BATCH_WORKERS'],
+                                                 thread_name_prefix='batch')
+        return _batch_executor
+
+def parse_batch_request(item):
+    if not isinstance(item, dict) or not isinstance(item.get('path'), str):
+        raise ValueError('Cada subpetición necesita un path')
+    method = str(item.get('method', 'GET')).upper()
+    path = item['path']
+    if method not in ('GET', 'POST', 'PUT', 'PATCH', 'DELETE'):
+        raise ValueError(f'Método no válido: {method}')
+    # Solo la API: nada de login/logout ni lotes anidados
+    if not path.startswith('/api/') or path.split('?', 1)[0].rstrip('/') == '/api/batch':
+        raise ValueError(f'Ruta no permitida en un lote: {path}')
+    headers = {name: value for name, value in (item.get('headers') or {}).items()
+               if name in BATCH_FORWARDED_HEADERS}
+    return {'id': item.get('id'), 'method': method, 'path': path, 'body': item.get('body'), 'headers': headers}
+
+def dispatch_subrequest(sub, user_session, base_environ):
+    """Ejecuta una subpetición con la sesión ya decodificada y devuelve su resultado serializable"""
+    from flask.ctx import RequestContext
+    from werkzeug.test import EnvironBuilder
+    
+    builder = EnvironBuilder(
+        path=sub['path'], method=sub['method'], headers=sub['headers'],
+        json=sub['body'] if sub['body'] is not None else None,
+        base_url=f"{base_environ.get('wsgi.url_scheme', 'http')}://{base_environ.get('HTTP_HOST', 'localhost')}",
+        environ_base={'REMOTE_ADDR': base_environ.get('REMOTE_ADDR')},
+    )
+    try:
+        ctx = RequestContext(app, builder.get_environ(), session=user_session)
+    finally:
+        builder.close()
+    with ctx:
+        try:
+            response = app.full_dispatch_request()
+        except Exception as e:
+            response = app.make_response(app.handle_exception(e))
+        try:
+            if response.direct_passthrough:
+                # send_file: un fichero no cabe en la respuesta JSON del lote
+                return {'id': sub['id'], 'status': 400,
+                        'body': {'error': f"{sub['path']} devuelve un fichero y no se puede agrupar"}}
+            # Se consume dentro del contexto: los listados se generan en streaming desde el cursor
+            data = response.get_data()
+            body = None
+            if response.status_code != 304 and data:
+                body = json.loads(data) if response.is_json else data.decode('utf-8', 'replace')
+            if response.mimetype == 'application/x-ndjson':
+                body = [json.loads(line) for line in data.splitlines() if line.strip()]
+        except Exception:
+            # Un fallo al serializar solo afecta a su subpetición, no al lote entero
+            app.logger.exception('Subpetición %s %s no serializable', sub['method'], sub['path'])
+            return {'id': sub['id'], 'status': 500, 'body': {'error': 'Error interno del servidor'}}
+        finally:
+            response.close()
+        result = {'id': sub['id'], 'status': response.status_code, 'body': body}
+        if response.headers.get('ETag'):
+            result['etag'] = response.headers['ETag']
+        return result
+
+def _dispatch_in_app_context(sub, user_session, base_environ):
+    # Cada hilo trabaja con su propio contexto y, por tanto, su propia conexión del pool
+    with app.app_context():
+        return dispatch_subrequest(sub, user_session, base_environ)
+
+@app.route('/api/batch', methods=['POST'])
+@login_required
+def batch_api():
+    """Ejecuta varias subpeticiones de la API y devuelve sus respuestas en el mismo orden
+
+    Cuerpo: {"requests": [{"id": "...", "method": "GET", "path": "/api/...", "body": {...},
+    "headers": {"If-None-Match": "..."}}]}. Si todas son GET se resuelven en paralelo,
+    cada una con su conexión (lectores concurrentes en WAL); si hay escrituras se ejecutan
+    en orden sobre la conexión de esta petición, de modo que cada una ve las anteriores.
+    """
+    data = request.json
+    items = data.get('requests') if isinstance(data, dict) else data
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'Se esperaba una lista de subpeticiones'}), 400
+    if len(items) > BATCH_MAX_REQUESTS:
+        return jsonify({'error': f'Como máximo {BATCH_MAX_REQUESTS} subpeticiones por lote'}), 400
+    try:
+        subrequests = [parse_batch_request(item) for item in items]
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    # Sesión congelada: las subpeticiones no la decodifican ni la modifican
+    user_session = app.session_interface.session_class(dict(session))
+    base_environ = request.environ
+    
+    if len(subrequests) > 1 and all(sub['method'] == 'GET' for sub in subrequests):
+        executor = get_batch_executor()
+        futures = [executor.submit(_dispatch_in_app_context, sub, user_session, base_environ)
+                   for sub in subrequests]
+        responses = [future.result() for future in futures]
+    else:
+        responses = [dispatch_subrequest(sub, user_session, base_environ) for sub in subrequests]
+    
+    return jsonify({'responses': responses})
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    init_app().run(host='0.0.0.0', port=5000, debug=True)